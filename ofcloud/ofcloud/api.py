@@ -16,8 +16,11 @@
 import traceback
 
 from rest_framework import viewsets, status
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
 
+from ofcloud import transitions
+
 from ofcloud.models import Simulation, Instance
 from ofcloud.serializers import SimulationSerializer, InstanceSerializer
 from ofcloud.utils import destroy_simulation, create_simulation
@@ -49,6 +52,38 @@ class SimulationViewSet(viewsets.ModelViewSet):
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @detail_route(methods=['get'])
+    def phases(self, request, pk=None):
+        """
+        Time spent by the simulation and its instances in each phase (queue wait, deploy, decompose, solve,
+        reconstruct), see transitions.py.
+        """
+        return Response(transitions.simulation_phase_breakdown(self.get_object()))
+
+    @list_route(methods=['get'], url_path='phase-percentiles')
+    def phase_percentiles(self, request):
+        """
+        Percentiles of the phases and turnaround times across simulations. Optional query parameters: 'status'
+        (simulation status, COMPLETE by default, 'all' for every status) and 'percentiles' (comma separated, e.g.
+        50,90,99).
+        """
+        simulations = Simulation.objects.all()
+        simulation_status = request.query_params.get('status', Simulation.Status.COMPLETE.name)
+        if simulation_status != 'all':
+            simulations = simulations.filter(status=simulation_status)
+
+        percentiles = transitions.DEFAULT_PERCENTILES
+        if 'percentiles' in request.query_params:
+            try:
+                percentiles = [float(p) for p in request.query_params['percentiles'].split(',')]
+            except ValueError:
+                percentiles = []
+            if not percentiles or not all(0 < p <= 100 for p in percentiles):
+                return Response({'percentiles': 'Comma separated numbers in (0, 100] expected'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(transitions.phase_percentiles(simulations, percentiles))
+
 
 class InstanceViewSet(viewsets.ModelViewSet):
     queryset = Instance.objects.all()
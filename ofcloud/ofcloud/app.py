@@ -23,4 +23,7 @@ class OfcloudAppConfig(AppConfig):
     verbose_name = 'OpenFOAM cloud application'
 
     def ready(self):
+        # connect signal receivers
+        from ofcloud import signals
+
         network_utils.setup_openfoam_network()
@@ -0,0 +1,224 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Streaming tar.gz archives of instance case folders.
+
+The archive is generated while it is being sent: tar entries are written one by one, file contents are read and
+compressed chunk by chunk and every compressed chunk is handed to the caller as soon as it is produced. Memory used by
+one archive does not depend on the size of the case.
+"""
+
+import Queue
+import os
+import tarfile
+import threading
+import traceback
+
+from django.conf import settings
+
+DEFAULT_CASE_ARCHIVE_CHUNK_SIZE = 64 * 1024
+# compressed chunks the archive writer can be ahead of the client
+ARCHIVE_QUEUE_SIZE = 16
+
+_END_OF_ARCHIVE = object()
+
+
+class _ArchiveBuffer:
+    """
+    File object tarfile writes the archive into. Written data is passed to the consuming generator through a bounded
+    queue, so the archive is never further ahead of the client than a few chunks.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.cancelled = False
+
+    def write(self, data):
+        while self.queue is not None:
+            if self.cancelled:
+                raise IOError("Archive download cancelled")
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def close(self):
+        pass
+
+
+class _ChunkReader:
+    """
+    File object reading exactly size bytes from a generator of chunks, for tarfile.addfile. Files which grow while
+    they are archived are truncated to size, files which shrink are padded with zero bytes.
+    """
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.remaining = size
+        self.__buffer = ''
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        while len(self.__buffer) < size and self.chunks is not None:
+            try:
+                self.__buffer += next(self.chunks)
+            except StopIteration:
+                self.close()
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        data += tarfile.NUL * (size - len(data))
+        self.remaining -= size
+        if self.remaining == 0:
+            self.close()
+        return data
+
+    def close(self):
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+
+
+class LocalCaseSource:
+    """
+    Case folder on the local file system, e.g. the NFS copy of the instance case (Instance.local_case_location).
+    """
+
+    def __init__(self, case_location):
+        self.case_location = case_location
+
+    def iter_entries(self, tar, arcname, chunk_size):
+        return self.__walk(tar, self.case_location, arcname, chunk_size)
+
+    def __walk(self, tar, path, arcname, chunk_size):
+        try:
+            # gettarinfo also recognizes symlinks and files hardlinked within the case
+            tarinfo = tar.gettarinfo(path, arcname)
+        except OSError:
+            # files can disappear while the solver is running
+            print "Skipping %s in case archive" % path
+            print traceback.format_exc()
+            return
+        if tarinfo is None:
+            return
+
+        if tarinfo.isreg():
+            yield tarinfo, self.__read_chunks(path, chunk_size)
+        else:
+            yield tarinfo, None
+
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(path)):
+                for entry in self.__walk(tar, os.path.join(path, name), os.path.join(arcname, name), chunk_size):
+                    yield entry
+
+    @staticmethod
+    def __read_chunks(path, chunk_size):
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class VmCaseSource:
+    """
+    Case folder read from a running VM through the OSv file REST API (osv.api.File).
+    """
+
+    def __init__(self, file_api, case_location):
+        self.file_api = file_api
+        self.case_location = case_location
+
+    def iter_entries(self, tar, arcname, chunk_size):
+        prefix_length = len(self.case_location.rstrip('/'))
+        for vm_path, entry in self.file_api.walk(self.case_location):
+            tarinfo = tarfile.TarInfo(arcname + vm_path[prefix_length:])
+            tarinfo.mtime = entry.get('modificationTime', 0)
+            if 'permission' in entry:
+                tarinfo.mode = int(entry['permission'], 8)
+
+            if entry['type'] == 'DIRECTORY':
+                tarinfo.type = tarfile.DIRTYPE
+                if 'permission' not in entry:
+                    tarinfo.mode = 0755
+                yield tarinfo, None
+            elif entry['type'] == 'FILE':
+                tarinfo.size = entry.get('length', 0)
+                yield tarinfo, self.file_api.iter_file(vm_path, chunk_size)
+            else:
+                print "Skipping %s of unknown type %s in case archive" % (vm_path, entry['type'])
+
+
+def stream_tar_gz(source, arcname):
+    """
+    Generates a gzip compressed tar archive of the case folder, chunk by chunk.
+
+    The archive is written by tarfile in a background thread. The size of a file entry is taken when the entry is
+    written. Files which grow while they are archived (run.log of a running solver) are truncated to that size, files
+    which shrink are padded with zero bytes.
+
+    :param source: LocalCaseSource or VmCaseSource
+    :param arcname: name of the case folder in the archive
+    :return: generator of compressed archive chunks
+    """
+    queue = Queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+    buf = _ArchiveBuffer(queue)
+    thread = threading.Thread(target=__write_tar_gz, args=(source, arcname, buf), name='case-archive')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            data = queue.get()
+            if data is _END_OF_ARCHIVE:
+                break
+            if isinstance(data, Exception):
+                raise data
+            yield data
+    finally:
+        # the client might have gone away, stop the writer
+        buf.cancelled = True
+        try:
+            while True:
+                queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+def __write_tar_gz(source, arcname, buf):
+    chunk_size = getattr(settings, 'CASE_ARCHIVE_CHUNK_SIZE', DEFAULT_CASE_ARCHIVE_CHUNK_SIZE)
+    try:
+        # 'w|gz' writes a compressed stream, without seeking
+        tar = tarfile.open(fileobj=buf, mode='w|gz', bufsize=chunk_size)
+        for tarinfo, chunks in source.iter_entries(tar, arcname, chunk_size):
+            if chunks is None:
+                tar.addfile(tarinfo)
+                continue
+            reader = _ChunkReader(chunks, tarinfo.size)
+            try:
+                tar.addfile(tarinfo, reader)
+            finally:
+                reader.close()
+        tar.close()
+        buf.write(_END_OF_ARCHIVE)
+    except Exception as e:
+        if not buf.cancelled:
+            print traceback.format_exc()
+            buf.write(e)
+        # tarfile flushes the stream again when it is garbage collected, drop that data
+        buf.queue = None
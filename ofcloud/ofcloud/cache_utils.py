@@ -0,0 +1,139 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RefCountedLruCache:
+    """
+    Base of the local caches of built artifacts (composed images, extracted cases).
+
+    Entries in use are referenced and never evicted. When the cache is over capacity, the least recently used
+    unreferenced entries are removed. Building, reusing and removing an entry are serialized by a lock per key, so
+    concurrent requests for an entry which is not cached yet wait for a single build, and an entry is never rebuilt
+    while it is being removed. Key locks are dropped as soon as nobody holds them.
+
+    Subclasses implement _exists, _is_over_capacity and _remove.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # key -> {'refs': number of users, 'last_used': timestamp, 'evicting': bool, ...subclass fields}
+        self.__entries = {}
+        # key -> [lock, number of threads holding or waiting for the lock]
+        self.__key_locks = {}
+
+    def _exists(self, key):
+        """
+        :return: True if the artifact of the entry is still present
+        """
+        raise NotImplementedError()
+
+    def _is_over_capacity(self, entries):
+        """
+        :param entries: list of the entries which would be kept
+        :return: True if more entries should be evicted
+        """
+        raise NotImplementedError()
+
+    def _remove(self, key, entry):
+        """
+        Removes the artifact of an evicted entry. Called with the key lock held.
+        """
+        raise NotImplementedError()
+
+    def _add_existing(self, key, last_used, **fields):
+        """
+        Registers an artifact found at startup as an unreferenced entry.
+        """
+        with self.__lock:
+            entry = {'refs': 0, 'last_used': last_used, 'evicting': False}
+            entry.update(fields)
+            self.__entries[key] = entry
+
+    def acquire_entry(self, key, build):
+        """
+        References the entry, building it first if it is not cached yet. Every acquired entry must be released with
+        release_entry().
+
+        :param key: entry key
+        :param build: callable without arguments building the artifact, returns a dictionary of additional entry fields
+        :return: True if the entry was built, False if a cached entry was reused
+        """
+        with self.__key_lock(key):
+            with self.__lock:
+                entry = self.__entries.get(key)
+                if entry and self._exists(key):
+                    entry['refs'] += 1
+                    entry['last_used'] = time.time()
+                    return False
+
+            fields = build() or {}
+
+            with self.__lock:
+                entry = {'refs': 1, 'last_used': time.time(), 'evicting': False}
+                entry.update(fields)
+                self.__entries[key] = entry
+
+        self.evict()
+        return True
+
+    def release_entry(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry:
+                entry['refs'] = max(entry['refs'] - 1, 0)
+                entry['last_used'] = time.time()
+        self.evict()
+
+    def evict(self):
+        with self.__lock:
+            kept = dict((key, entry) for key, entry in self.__entries.iteritems() if not entry['evicting'])
+            unused = sorted([(entry['last_used'], key) for key, entry in kept.iteritems() if entry['refs'] == 0])
+            evicted = []
+            while self._is_over_capacity(kept.values()) and unused:
+                _, key = unused.pop(0)
+                kept[key]['evicting'] = True
+                evicted.append((key, kept.pop(key)))
+
+        for key, entry in evicted:
+            with self.__key_lock(key):
+                with self.__lock:
+                    if self.__entries.get(key) is not entry:
+                        continue
+                    if entry['refs'] > 0:
+                        # acquired again before the key lock was taken
+                        entry['evicting'] = False
+                        continue
+                    del self.__entries[key]
+
+                # still holding the key lock, the entry can not be rebuilt while it is being removed
+                self._remove(key, entry)
+
+    @contextmanager
+    def __key_lock(self, key):
+        with self.__lock:
+            key_lock = self.__key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield
+        finally:
+            with self.__lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self.__key_locks[key]
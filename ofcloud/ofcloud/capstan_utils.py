@@ -13,12 +13,141 @@
 # limitations under the License.
 
 
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
 from os import environ as env
-from subprocess import Popen
+from subprocess import PIPE, Popen
 
+from django.conf import settings
 
-def init_and_compose_capstan_package(simulation_name, capstan_package_folder, solver):
+from ofcloud.cache_utils import RefCountedLruCache
+
+# Capstan repository folder holding the cached images, relative to ~/.capstan/repository
+IMAGE_CACHE_REPOSITORY = 'ofcloud-cache'
+DEFAULT_IMAGE_CACHE_SIZE = 5
+# Boot command of the composed images, the VM idles and the openFOAM commands are started through the REST API
+OSV_BOOT_COMMAND = "--redirect=>>/run.log /bin/sleep.so -1"
+
+
+class ImageCache(RefCountedLruCache):
+    """
+    Cache of composed OSv images in the local capstan repository.
+
+    Images are keyed by the solver, its package dependencies and the capstan version, so all the instances using the
+    same solver share one composed image. An image in use is referenced and never evicted. When there are more than
+    'max_images' images cached, the least recently used unreferenced images are removed. Concurrent requests for an
+    image which is not cached yet wait for a single compose.
+    """
+
+    def __init__(self, max_images):
+        RefCountedLruCache.__init__(self)
+        self.max_images = max_images
+
+        self.__load_existing_images()
+
+    def acquire(self, solver):
+        """
+        Returns a composed image for the solver, composing it only if it is not cached yet. Every acquired image must
+        be released with release().
+
+        :param solver: Solver name, see __get_solver_config
+        :return: Tuple (capstan image name, path to the image file)
+        """
+        key = get_image_key(solver)
+        image_name, image_file = get_cached_image_location(key)
+
+        if not self.acquire_entry(key, lambda: self.__compose(key, solver)):
+            print "Using cached image %s for solver %s" % (image_name, solver)
+        return image_name, image_file
+
+    def release(self, image_name):
+        self.release_entry(os.path.basename(image_name))
+
+    def _exists(self, key):
+        return os.path.exists(get_cached_image_location(key)[1])
+
+    def _is_over_capacity(self, entries):
+        return len(entries) > self.max_images
+
+    def _remove(self, key, entry):
+        print "Evicting cached image %s" % key
+        shutil.rmtree(os.path.dirname(get_cached_image_location(key)[1]), ignore_errors=True)
+
+    def __compose(self, key, solver):
+        image_name, image_file = get_cached_image_location(key)
+        print "Composing image %s for solver %s" % (image_name, solver)
+        capstan_package_folder = tempfile.mkdtemp(prefix='ofcloud-capstan-')
+        try:
+            init_and_compose_capstan_package(solver, capstan_package_folder, solver, image_name=image_name)
+        finally:
+            shutil.rmtree(capstan_package_folder, ignore_errors=True)
+
+        if not os.path.exists(image_file):
+            raise RuntimeError("Composed image %s not found" % image_file)
+
+    def __load_existing_images(self):
+        cache_folder = os.path.join(get_capstan_repository(), IMAGE_CACHE_REPOSITORY)
+        if not os.path.isdir(cache_folder):
+            return
+
+        for key in os.listdir(cache_folder):
+            _, image_file = get_cached_image_location(key)
+            if os.path.exists(image_file):
+                self._add_existing(key, os.path.getmtime(image_file))
+
+
+__image_cache = None
+__image_cache_lock = threading.Lock()
+__capstan_version = None
+
+
+def acquire_solver_image(solver):
+    """
+    Returns a composed OSv image for the solver from the image cache. See ImageCache.acquire.
+    """
+    return __get_image_cache().acquire(solver)
+
+
+def release_solver_image(image_name):
+    """
+    Releases an image acquired with acquire_solver_image, making it eligible for eviction.
+    """
+    __get_image_cache().release(image_name)
+
+
+def get_image_key(solver):
+    key_data = json.dumps([solver, get_solver_deps(solver), get_capstan_version()])
+    return hashlib.sha1(key_data).hexdigest()[:16]
+
+
+def get_cached_image_location(key):
+    image_name = "%s/%s" % (IMAGE_CACHE_REPOSITORY, key)
+    return image_name, get_image_file(image_name)
+
+
+def get_capstan_repository():
+    return os.path.expanduser(os.path.join("~", ".capstan", "repository"))
+
+
+def get_image_file(image_name):
+    # capstan saves composed packages as <repository>/<image name>/<last part of image name>.qemu
+    return os.path.join(get_capstan_repository(), image_name, "%s.qemu" % os.path.basename(image_name))
+
+
+def get_capstan_version():
+    global __capstan_version
+    if __capstan_version is None:
+        p = Popen(["capstan", "--version"], stdout=PIPE)
+        out, _ = p.communicate()
+        __capstan_version = out.strip()
+    return __capstan_version
+
+
+def init_and_compose_capstan_package(simulation_name, capstan_package_folder, solver, image_name=None):
     # Initialise MPM package
     cmd = ["capstan", "package", "init",
            "--name", simulation_name,
@@ -34,17 +163,20 @@ def init_and_compose_capstan_package(simulation_name, capstan_package_folder, so
     cmd.append(capstan_package_folder)
     # Invoke capstan tool.
     p = Popen(cmd)
-    p.wait()
-    image_name = "temp/%s" % (os.path.basename(capstan_package_folder))
+    if p.wait() != 0:
+        raise RuntimeError("Capstan package init failed in %s" % capstan_package_folder)
+    if image_name is None:
+        image_name = "temp/%s" % (os.path.basename(capstan_package_folder))
     # Now we are ready to compose the package into a VM
     p = Popen([
         "capstan", "package", "compose",
         "--size", "500M",
-       "--run", "--redirect=>>/run.log /bin/sleep.so -1",
+        "--run", OSV_BOOT_COMMAND,
         "--pull-missing",
         image_name], cwd=capstan_package_folder)
     # Wait for the image to be built.
-    p.wait()
+    if p.wait() != 0:
+        raise RuntimeError("Capstan package compose of image %s failed" % image_name)
     return image_name
 
 
@@ -89,3 +221,11 @@ def __get_common_deps():
         "osv.nfs",
         "ompi-1.10"
     ]
+
+
+def __get_image_cache():
+    global __image_cache
+    with __image_cache_lock:
+        if __image_cache is None:
+            __image_cache = ImageCache(getattr(settings, 'CAPSTAN_IMAGE_CACHE_SIZE', DEFAULT_IMAGE_CACHE_SIZE))
+        return __image_cache
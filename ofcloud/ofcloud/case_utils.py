@@ -13,19 +13,27 @@
 # limitations under the License.
 
 
+import collections
+import hashlib
 import json
 import os
 import os.path
 import re
 import shutil
+import subprocess
 import tarfile
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 from os import path
 
 import boto
 import boto.s3.connection
+from boto.exception import S3ResponseError
 from django.conf import settings
 
+from ofcloud.cache_utils import RefCountedLruCache
+
 # Replacements dict defines keywords in decomposeParDict template to be replaced with the corresponding value
 # from decompose_dict, which is generated from the form inputs in horizon-openfoam dashboard.
 # First level defines the decomposition method used. In each dictionary entry there are mappings defined as:
@@ -56,93 +64,341 @@ DECOMPOSE_PAR_DICT_REPLACEMENTS = {
     }
 }
 
+DEFAULT_CASE_CACHE_FOLDER = path.join(tempfile.gettempdir(), 'ofcloud-case-cache')
+# 10 GiB
+DEFAULT_CASE_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+DEFAULT_PARALLEL_DOWNLOAD_WORKERS = 4
+# 256 MiB
+DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD = 256 * 1024 * 1024
+# 16 MiB
+DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
 
-def prepare_case_files(simulation, instance_cpus):
-    # Connect to s3
-    s3_conn = boto.connect_s3(
-        aws_access_key_id=settings.S3_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY,
-        host=settings.S3_HOST,
-        port=settings.S3_PORT,
-        calling_format=boto.s3.connection.OrdinaryCallingFormat(),
-    )
-    case_folder = tempfile.mkdtemp(prefix='ofcloud-case-')
-    case_path = path.join(case_folder, "case")
-    os.makedirs(case_path)
-    # Get the bucket for the input data.
-    bucket = s3_conn.get_bucket(simulation.container_name)
-    # Get the key from the bucket.
-    input_key = bucket.get_key(simulation.input_data_object)
-    casefile = path.join(case_path, os.path.basename(simulation.input_data_object))
-
-    input_key.get_contents_to_filename(casefile)
-    # Unpack the input case.
-    tar = tarfile.open(casefile, 'r')
-    tar.extractall(case_path)
-    tar.close()
-    # Remove the downloaded file
-    os.remove(casefile)
+STAGING_MODE_COPY = 'copy'
+STAGING_MODE_LINK = 'link'
+STAGING_MODE_REFLINK = 'reflink'
+DEFAULT_CASE_STAGING_MODE = STAGING_MODE_COPY
+# Case files shared between the instances of a simulation, relative to the case folder. Nothing is shared by default,
+# a solver rewriting a shared file in place would corrupt the case of every instance.
+DEFAULT_CASE_STAGING_SHARED_PATHS = []
 
-    # If any parallelisation, use the corresponding decomposeParDict
-    if instance_cpus > 1:
-        decomposition_dict = json.loads(simulation.decomposition)
-        decomposition_method = decomposition_dict['decomposition_method']
+DECOMPOSE_PAR_DICT = 'system/decomposeParDict'
+# Folder on the NFS mount holding the pristine cases instance folders are linked to
+PRISTINE_CASES_FOLDER = '.ofcloud-pristine'
+
+
+class CaseCache(RefCountedLruCache):
+    """
+    Local cache of extracted input cases.
+
+    Every input archive is downloaded and extracted only once, into a pristine case tree keyed by the bucket, key and
+    ETag of the S3 object (a changed object gets a new entry). Trees in use are referenced and never evicted. When the
+    trees take more than 'max_size' bytes, the least recently used unreferenced trees are removed. Concurrent requests
+    for an archive which is not cached yet wait for a single download.
+    """
+
+    def __init__(self, cache_folder, max_size):
+        RefCountedLruCache.__init__(self)
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+
+        self.__exports_lock = threading.Lock()
+        # entry key -> copies of the pristine case on NFS exports, removed together with the entry
+        self.__exports = {}
+
+        if not path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        self.__load_existing_entries()
+
+    def acquire(self, bucket_name, key_name):
+        """
+        Returns the pristine case tree of the input archive, downloading and extracting it only if it is not cached
+        yet. The tree must not be modified. Every acquired tree must be released with release().
+
+        :param bucket_name: S3 bucket of the input archive
+        :param key_name: S3 key of the input archive
+        :return: Tuple (entry key, path to the pristine case tree)
+        """
+        input_key = get_s3_connection().get_bucket(bucket_name).get_key(key_name)
+        if input_key is None:
+            raise RuntimeError("Input case %s/%s not found" % (bucket_name, key_name))
+
+        entry_key = hashlib.sha1("%s/%s/%s" % (bucket_name, key_name, input_key.etag)).hexdigest()
+        entry_path = path.join(self.cache_folder, entry_key)
+
+        def download():
+            print "Downloading input case %s/%s" % (bucket_name, key_name)
+            return {'size': self.__download(input_key, entry_path)}
+
+        if not self.acquire_entry(entry_key, download):
+            print "Using cached input case %s/%s" % (bucket_name, key_name)
+        return entry_key, entry_path
+
+    def release(self, entry_key):
+        self.release_entry(entry_key)
+
+    def add_export(self, entry_key, export_path):
+        """
+        Registers a copy of the pristine case of the entry, which should be removed when the entry is evicted.
+        Instance folders hold their own links to the files, so removing the copy does not affect them.
+        """
+        with self.__exports_lock:
+            self.__exports.setdefault(entry_key, set()).add(export_path)
+
+    def _exists(self, key):
+        return path.isdir(path.join(self.cache_folder, key))
+
+    def _is_over_capacity(self, entries):
+        return sum([entry['size'] for entry in entries]) > self.max_size
+
+    def _remove(self, key, entry):
+        with self.__exports_lock:
+            exports = self.__exports.pop(key, set())
+
+        print "Evicting cached input case %s" % key
+        shutil.rmtree(path.join(self.cache_folder, key), ignore_errors=True)
+        for export_path in exports:
+            shutil.rmtree(export_path, ignore_errors=True)
+
+    def __download(self, input_key, entry_path):
+        partial_path = tempfile.mkdtemp(prefix='partial-', dir=self.cache_folder)
+        try:
+            extract_s3_archive(input_key, partial_path)
+
+            if path.exists(entry_path):
+                shutil.rmtree(entry_path)
+            os.rename(partial_path, entry_path)
+        except:
+            shutil.rmtree(partial_path, ignore_errors=True)
+            raise
+        return get_tree_size(entry_path)
+
+    def __load_existing_entries(self):
+        for entry_key in os.listdir(self.cache_folder):
+            entry_path = path.join(self.cache_folder, entry_key)
+            if entry_key.startswith('partial-'):
+                # left over from an interrupted download
+                shutil.rmtree(entry_path, ignore_errors=True)
+            elif path.isdir(entry_path):
+                self._add_existing(entry_key, path.getmtime(entry_path), size=get_tree_size(entry_path))
+
+
+__case_cache = None
+__case_cache_lock = threading.Lock()
+__export_lock = threading.Lock()
+__export_locks = {}
+__s3 = threading.local()
+
+
+def get_case_cache():
+    global __case_cache
+    with __case_cache_lock:
+        if __case_cache is None:
+            __case_cache = CaseCache(getattr(settings, 'CASE_CACHE_FOLDER', DEFAULT_CASE_CACHE_FOLDER),
+                                     getattr(settings, 'CASE_CACHE_SIZE', DEFAULT_CASE_CACHE_SIZE))
+        return __case_cache
+
+
+def get_s3_connection():
+    """
+    Returns the S3 connection of the current thread. boto connections are not thread safe, so each thread opens its
+    own connection and reuses it.
+    """
+    if getattr(__s3, 'connection', None) is None:
+        __s3.connection = boto.connect_s3(
+            aws_access_key_id=settings.S3_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+            host=settings.S3_HOST,
+            port=settings.S3_PORT,
+            calling_format=boto.s3.connection.OrdinaryCallingFormat(),
+        )
+    return __s3.connection
+
+
+class RangedS3Reader:
+    """
+    Read-only file-like object over an S3 object, fetching consecutive chunks of the object with parallel ranged GET
+    requests. At most 2 * workers chunks are downloaded ahead of the reader. Every request is conditional on the ETag
+    of the object, so the chunks can not come from different versions of an object replaced during the download.
+    """
+
+    def __init__(self, bucket_name, key_name, etag, size, chunk_size, workers):
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        self.etag = etag
+        self.size = size
+        self.chunk_size = chunk_size
+
+        self.__pool = ThreadPool(workers)
+        self.__pending_chunks = collections.deque()
+        self.__next_chunk_offset = 0
+        self.__chunk = ''
+        self.__chunk_offset = 0
+
+        for _ in range(2 * workers):
+            self.__schedule_chunk()
+
+    def read(self, size=-1):
+        data = []
+        remaining = size
+        while remaining != 0:
+            if self.__chunk_offset >= len(self.__chunk):
+                if not self.__pending_chunks:
+                    break
+                self.__chunk = self.__pending_chunks.popleft().get()
+                self.__chunk_offset = 0
+                self.__schedule_chunk()
+
+            if remaining < 0:
+                end = len(self.__chunk)
+            else:
+                end = min(self.__chunk_offset + remaining, len(self.__chunk))
+                remaining -= end - self.__chunk_offset
+            data.append(self.__chunk[self.__chunk_offset:end])
+            self.__chunk_offset = end
+        return ''.join(data)
+
+    def close(self):
+        self.__pool.terminate()
+        self.__pending_chunks.clear()
+
+    def __schedule_chunk(self):
+        if self.__next_chunk_offset >= self.size:
+            return
+        start = self.__next_chunk_offset
+        end = min(start + self.chunk_size, self.size) - 1
+        self.__pending_chunks.append(self.__pool.apply_async(self.__get_range, (start, end)))
+        self.__next_chunk_offset = end + 1
+
+    def __get_range(self, start, end):
+        # each worker thread uses its own connection
+        key = get_s3_connection().get_bucket(self.bucket_name, validate=False).new_key(self.key_name)
+        try:
+            return key.get_contents_as_string(headers={'Range': 'bytes=%d-%d' % (start, end), 'If-Match': self.etag})
+        except S3ResponseError as e:
+            if e.status == 412:
+                raise RuntimeError("Input case %s/%s changed during the download" % (self.bucket_name, self.key_name))
+            raise
+
+
+def extract_s3_archive(input_key, destination):
+    """
+    Extracts a (compressed) tar archive stored in S3 into the destination folder. The archive is decompressed and
+    extracted while it is being downloaded, without storing it on disk. Archives of at least
+    CASE_PARALLEL_DOWNLOAD_THRESHOLD bytes are downloaded with parallel ranged requests.
+
+    :param input_key: boto S3 key of the archive
+    :param destination: Folder to extract the archive into
+    """
+    workers = getattr(settings, 'CASE_PARALLEL_DOWNLOAD_WORKERS', DEFAULT_PARALLEL_DOWNLOAD_WORKERS)
+    threshold = getattr(settings, 'CASE_PARALLEL_DOWNLOAD_THRESHOLD', DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD)
+
+    if workers > 1 and input_key.size >= threshold:
+        stream = RangedS3Reader(input_key.bucket.name, input_key.name, input_key.etag, input_key.size,
+                                getattr(settings, 'CASE_PARALLEL_DOWNLOAD_CHUNK_SIZE',
+                                        DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE),
+                                workers)
+    else:
+        stream = input_key
+
+    try:
+        # 'r|*' reads the archive as a stream of blocks, with transparent decompression
+        tar = tarfile.open(fileobj=stream, mode='r|*')
+        tar.extractall(destination)
+        tar.close()
+    finally:
+        stream.close()
+
+
+def get_tree_size(tree_path):
+    size = 0
+    for dir_path, _, file_names in os.walk(tree_path):
+        for file_name in file_names:
+            file_path = path.join(dir_path, file_name)
+            if not path.islink(file_path):
+                size += path.getsize(file_path)
+    return size
 
-        decompose_par_dict_path = path.join(case_path, "system/decomposeParDict")
-        os.remove(decompose_par_dict_path)
 
-        with open("ofcloud/templates/decomposeParDict_%s" % decomposition_method, ) as infile, open(
-                decompose_par_dict_path, "w") as outfile:
-            for line in infile:
-                for src, target in DECOMPOSE_PAR_DICT_REPLACEMENTS[decomposition_method].iteritems():
-                    # if the parameter is defined as optional we have to remove comment annotations from those lines
-                    is_optional = target[1]
-                    target = decomposition_dict[target[0]]
-                    line = line.replace(str(src), str(target))
-                    if is_optional and len(target) > 0:
-                        line = line.replace("//", "")
-                outfile.write(line)
-    return case_folder
-
-
-def copy_case_files_to_nfs_location(simulation_instance,
-                                    case_folder,
-                                    local_nfs_mount_location,
-                                    nfs_server_mount_folder):
+def stage_case_files(simulation, simulation_instance, local_nfs_mount_location, nfs_server_mount_folder):
+    """
+    Creates the case folder of the simulation instance on the NFS mount.
+
+    The case is written directly into the NFS folder of the instance. Depending on CASE_STAGING_MODE, files under
+    CASE_STAGING_SHARED_PATHS are hardlinked ('link') or reflinked ('reflink') from a pristine copy of the case on the
+    same export instead of copied, files modified for the instance (case updates, decomposeParDict) are always real
+    copies. With 'copy' (default) or without shared paths every file is copied.
+
+    :param simulation: Simulation of the instance
+    :param simulation_instance: Instance to stage the case for
+    :param local_nfs_mount_location: Location of the locally mounted NFS folder
+    :param nfs_server_mount_folder: Location of the same folder on the NFS server
+    :return: Local path of the instance case folder
+    """
     simulation_instance_id = simulation_instance.id
     local_instance_files_location = "%s/%s" % (
         local_nfs_mount_location, str(simulation_instance_id))
+    local_case_location = '%s/case' % local_instance_files_location
 
     if os.path.exists(local_instance_files_location):
         shutil.rmtree(local_instance_files_location)
 
-    print "Copying src=%s, dst=%s" % (case_folder, local_instance_files_location)
-    shutil.copytree(src=case_folder, dst=local_instance_files_location)
+    staging_mode = getattr(settings, 'CASE_STAGING_MODE', DEFAULT_CASE_STAGING_MODE)
+    shared_paths = getattr(settings, 'CASE_STAGING_SHARED_PATHS', DEFAULT_CASE_STAGING_SHARED_PATHS)
+
+    # files which will be modified for this instance must not share data with the pristine case
+    private_files = set(__get_case_update_files(json.loads(simulation_instance.config or '{}')).keys())
+    if simulation_instance.multicore:
+        private_files.add(DECOMPOSE_PAR_DICT)
+
+    case_cache = get_case_cache()
+    entry_key, pristine_case_path = case_cache.acquire(simulation.container_name, simulation.input_data_object)
+    try:
+        if staging_mode != STAGING_MODE_COPY and shared_paths:
+            pristine_case_path = __get_export_pristine_case(case_cache, entry_key, pristine_case_path,
+                                                            local_nfs_mount_location)
+
+        print "Staging case src=%s, dst=%s, mode=%s" % (pristine_case_path, local_case_location, staging_mode)
+        os.makedirs(local_case_location)
+        __stage_tree(pristine_case_path, local_case_location, '', staging_mode, shared_paths, private_files)
+    finally:
+        case_cache.release(entry_key)
+
+    # If any parallelisation, use the corresponding decomposeParDict
+    if simulation_instance.multicore:
+        write_decompose_par_dict(local_case_location, simulation)
 
-    # TODO maybe just return the data, and save outside this function?
     # Save storage information to model
-    simulation_instance.local_case_location = '%s/case' % local_instance_files_location
+    simulation_instance.local_case_location = local_case_location
     simulation_instance.nfs_case_location = '%s/%s/case' % (
         nfs_server_mount_folder, str(simulation_instance_id))
     simulation_instance.save()
 
-    # Delete temporary case data
-    shutil.rmtree(case_folder)
+    return local_case_location
 
 
-def update_case_files(case_path, case_updates):
-    input_files = {}
+def write_decompose_par_dict(case_path, simulation):
+    decomposition_dict = json.loads(simulation.decomposition)
+    decomposition_method = decomposition_dict['decomposition_method']
 
-    # First, get a list of files that need to be modified
-    for key in case_updates:
-        file_end_index = key.rfind('/')
-        file_path = key[0:file_end_index]
-        variable = key[file_end_index + 1:]
+    decompose_par_dict_path = path.join(case_path, DECOMPOSE_PAR_DICT)
+    if path.exists(decompose_par_dict_path):
+        os.remove(decompose_par_dict_path)
 
-        if file_path not in input_files:
-            input_files[file_path] = {}
+    with open("ofcloud/templates/decomposeParDict_%s" % decomposition_method, ) as infile, open(
+            decompose_par_dict_path, "w") as outfile:
+        for line in infile:
+            for src, target in DECOMPOSE_PAR_DICT_REPLACEMENTS[decomposition_method].iteritems():
+                # if the parameter is defined as optional we have to remove comment annotations from those lines
+                is_optional = target[1]
+                target = decomposition_dict[target[0]]
+                line = line.replace(str(src), str(target))
+                if is_optional and len(target) > 0:
+                    line = line.replace("//", "")
+            outfile.write(line)
 
-        input_files[file_path][variable] = case_updates[key]
+
+def update_case_files(case_path, case_updates):
+    input_files = __get_case_update_files(case_updates)
     output_files = {}
 
     # Now loop through files and update them.
@@ -158,8 +414,97 @@ def update_case_files(case_path, case_updates):
 
         output_files[input_file] = file_path
 
-        f = open(file_path, 'w')
+        # Replace the file instead of writing into it, so a file sharing its data with the pristine case (hardlink)
+        # never modifies the pristine case.
+        f = open(file_path + '.ofcloud-tmp', 'w')
         f.write(data)
         f.close()
+        os.rename(file_path + '.ofcloud-tmp', file_path)
 
     return output_files
+
+
+def __get_case_update_files(case_updates):
+    """
+    Groups case updates by the file they modify.
+
+    :param case_updates: Dictionary of case updates, key - '<file path>/<variable>', value - new variable value
+    :return: Dictionary, key - file path relative to the case folder, value - dictionary of variables and values
+    """
+    input_files = {}
+
+    for key in case_updates:
+        file_end_index = key.rfind('/')
+        file_path = key[0:file_end_index]
+        variable = key[file_end_index + 1:]
+
+        if file_path not in input_files:
+            input_files[file_path] = {}
+
+        input_files[file_path][variable] = case_updates[key]
+    return input_files
+
+
+def __get_export_pristine_case(case_cache, entry_key, pristine_case_path, local_nfs_mount_location):
+    """
+    Returns a pristine copy of the cached case on the NFS export, creating it if needed. Files can only be linked
+    within one file system, so the instance folders link to this copy.
+    """
+    export_pristine_path = path.join(local_nfs_mount_location, PRISTINE_CASES_FOLDER, entry_key)
+
+    with __export_lock:
+        export_lock = __export_locks.setdefault(export_pristine_path, threading.Lock())
+
+    with export_lock:
+        if not path.isdir(export_pristine_path):
+            print "Creating pristine case copy %s" % export_pristine_path
+            partial_path = export_pristine_path + '.partial'
+            if path.exists(partial_path):
+                shutil.rmtree(partial_path)
+            os.makedirs(partial_path)
+            # link whole tree when the cache is on the same file system, copy otherwise
+            __stage_tree(pristine_case_path, partial_path, '', STAGING_MODE_LINK, [''], set())
+            os.rename(partial_path, export_pristine_path)
+        case_cache.add_export(entry_key, export_pristine_path)
+
+    return export_pristine_path
+
+
+def __stage_tree(src_root, dst_root, rel_dir, staging_mode, shared_paths, private_files):
+    src_dir = path.join(src_root, rel_dir)
+    for name in os.listdir(src_dir):
+        rel_path = path.join(rel_dir, name) if rel_dir else name
+        src = path.join(src_root, rel_path)
+        dst = path.join(dst_root, rel_path)
+
+        if path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        elif path.isdir(src):
+            os.mkdir(dst)
+            shutil.copystat(src, dst)
+            __stage_tree(src_root, dst_root, rel_path, staging_mode, shared_paths, private_files)
+        elif rel_path not in private_files and __is_shared_path(rel_path, shared_paths):
+            __share_file(src, dst, staging_mode)
+        else:
+            shutil.copy2(src, dst)
+
+
+def __is_shared_path(rel_path, shared_paths):
+    for shared_path in shared_paths:
+        if not shared_path or rel_path == shared_path or rel_path.startswith(shared_path.rstrip('/') + '/'):
+            return True
+    return False
+
+
+def __share_file(src, dst, staging_mode):
+    if staging_mode == STAGING_MODE_LINK:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # different file system, or links not supported
+            pass
+    elif staging_mode == STAGING_MODE_REFLINK:
+        if subprocess.call(["cp", "--reflink=always", "--preserve=all", src, dst]) == 0:
+            return
+    shutil.copy2(src, dst)
@@ -0,0 +1,236 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Early termination of converged simulation instances.
+
+Simulation.convergence holds an optional JSON policy, e.g.
+
+    {"residuals": {"Ux": 1e-5, "Uy": 1e-5, "p": 1e-4},
+     "plateau_window": 50, "plateau_tolerance": 0.01,
+     "max_wall_clock_seconds": 7200}
+
+The policy triggers when
+    - the initial residuals of all the fields in 'residuals' are below their thresholds, or
+    - the initial residuals of the watched fields changed by less than 'plateau_tolerance' (relative) over the last
+      'plateau_window' time steps, or
+    - the solver has been running for more than 'max_wall_clock_seconds'.
+Every part is optional. The watched fields are the fields in 'residuals', or all the collected fields if there are no
+thresholds. When the policy triggers, 'stopAt writeNow;' is written into system/controlDict of the NFS copy of the
+case, the solver writes the current time step and exits, and the instance completes through the normal shutdown phase.
+
+The residuals are provided by the built-in residual collector (RESIDUAL_COLLECTOR = 'builtin').
+"""
+
+import calendar
+import json
+import time
+import traceback
+from collections import deque
+
+from django.db.models import Max
+
+from ofcloud import case_utils
+from ofcloud.models import Instance, InstanceTransition
+
+CONTROL_DICT_STOP_AT = 'system/controlDict/stopAt'
+STOP_AT_WRITE_NOW = 'writeNow'
+
+SOLVER_STATUSES = [Instance.Status.RUNNING.name, Instance.Status.RUNNING_MPI.name]
+
+
+class ConvergencePolicy:
+    def __init__(self, residuals=None, plateau_window=None, plateau_tolerance=None, max_wall_clock_seconds=None):
+        self.residuals = residuals or {}
+        self.plateau_window = plateau_window
+        self.plateau_tolerance = plateau_tolerance
+        self.max_wall_clock_seconds = max_wall_clock_seconds
+
+    @staticmethod
+    def parse(convergence):
+        """
+        Parses Simulation.convergence.
+
+        :param convergence: JSON string, may be empty
+        :return: ConvergencePolicy or None if the simulation has no policy
+        :raises ValueError: when the policy is not valid
+        """
+        if not convergence:
+            return None
+
+        policy_dict = json.loads(convergence)
+        if not isinstance(policy_dict, dict):
+            raise ValueError("Convergence policy should be a JSON object")
+        unknown_keys = set(policy_dict) - {'residuals', 'plateau_window', 'plateau_tolerance', 'max_wall_clock_seconds'}
+        if unknown_keys:
+            raise ValueError("Unknown convergence policy keys: %s" % ', '.join(sorted(unknown_keys)))
+
+        residuals = policy_dict.get('residuals') or {}
+        if not isinstance(residuals, dict):
+            raise ValueError("Convergence 'residuals' should map field names to thresholds")
+        residuals = dict((field, float(threshold)) for field, threshold in residuals.iteritems())
+
+        plateau_window = policy_dict.get('plateau_window')
+        plateau_tolerance = policy_dict.get('plateau_tolerance')
+        if (plateau_window is None) != (plateau_tolerance is None):
+            raise ValueError("Convergence 'plateau_window' and 'plateau_tolerance' should be set together")
+        if plateau_window is not None and int(plateau_window) < 2:
+            raise ValueError("Convergence 'plateau_window' should be at least 2 time steps")
+
+        max_wall_clock_seconds = policy_dict.get('max_wall_clock_seconds')
+
+        return ConvergencePolicy(residuals=residuals,
+                                 plateau_window=int(plateau_window) if plateau_window is not None else None,
+                                 plateau_tolerance=float(plateau_tolerance) if plateau_tolerance is not None else None,
+                                 max_wall_clock_seconds=float(max_wall_clock_seconds)
+                                 if max_wall_clock_seconds is not None else None)
+
+
+class ConvergenceMonitor:
+    """
+    Evaluates the policy of one instance on its stream of residual samples.
+    """
+
+    def __init__(self, policy, started_at):
+        self.policy = policy
+        self.started_at = started_at
+        # field -> initial residual of the first solution of the field in the latest time step
+        self.__latest = {}
+        # field -> simulation time of the latest time step
+        self.__latest_time = {}
+        # field -> initial residuals of the last plateau_window time steps
+        self.__history = {}
+
+    def update(self, samples, now):
+        """
+        :param samples: new ResidualSample of the instance, in log order
+        :param now: current time
+        :return: Reason for stopping the instance or None if the policy did not trigger
+        """
+        for sample in samples:
+            # the initial residual of the first solution in a time step is the usual convergence measure, later
+            # correctors of the same time step are skipped
+            if sample.field in self.__latest_time and self.__latest_time[sample.field] == sample.time:
+                continue
+            self.__latest_time[sample.field] = sample.time
+            self.__latest[sample.field] = sample.initial
+            if self.policy.plateau_window:
+                self.__history.setdefault(sample.field, deque(maxlen=self.policy.plateau_window)).append(
+                    sample.initial)
+
+        if self.policy.residuals and all(field in self.__latest and self.__latest[field] < threshold
+                                         for field, threshold in self.policy.residuals.iteritems()):
+            return "residuals below thresholds (%s)" % ', '.join(
+                ["%s %g" % (field, self.__latest[field]) for field in sorted(self.policy.residuals)])
+
+        if self.policy.plateau_window and self.__is_plateau():
+            return "residuals flat for %d time steps" % self.policy.plateau_window
+
+        if self.policy.max_wall_clock_seconds and now - self.started_at > self.policy.max_wall_clock_seconds:
+            return "wall clock limit of %d seconds reached" % self.policy.max_wall_clock_seconds
+
+        return None
+
+    def __is_plateau(self):
+        fields = self.policy.residuals.keys() or self.__history.keys()
+        if not fields:
+            return False
+        for field in fields:
+            history = self.__history.get(field)
+            if not history or len(history) < self.policy.plateau_window:
+                return False
+            highest = max(history)
+            if highest > 0 and (highest - min(history)) / highest > self.policy.plateau_tolerance:
+                return False
+        return True
+
+
+class ConvergenceWatcher:
+    """
+    Listener of the residual collector, applies the convergence policy of its simulation to every running instance.
+    """
+
+    def __init__(self):
+        # instance id -> ConvergenceMonitor, None for instances without a policy
+        self.__monitors = {}
+
+    def update(self, instance, samples):
+        if instance.id not in self.__monitors:
+            self.__monitors[instance.id] = self.__create_monitor(instance)
+        monitor = self.__monitors[instance.id]
+        if monitor is None:
+            return
+
+        reason = monitor.update(samples, time.time())
+        if reason and request_stop(instance, reason):
+            # stop once, the instance keeps running until the solver writes the current time step
+            self.__monitors[instance.id] = None
+
+    def forget(self, instance_id):
+        self.__monitors.pop(instance_id, None)
+
+    @staticmethod
+    def __create_monitor(instance):
+        try:
+            policy = ConvergencePolicy.parse(instance.simulation.convergence)
+        except ValueError:
+            print "Invalid convergence policy of simulation %s" % instance.simulation_id
+            print traceback.format_exc()
+            return None
+        if policy is None:
+            return None
+        if not instance.local_case_location:
+            print "Instance %s has no local case folder, it can not be stopped early" % instance.id
+            return None
+        return ConvergenceMonitor(policy, get_solver_started_at(instance))
+
+
+def get_solver_started_at(instance):
+    """
+    :return: Time the solver of the instance was started, from its transition history, or now if there is none
+    """
+    started = (InstanceTransition.objects
+               .filter(instance_id=instance.id, to_status__in=SOLVER_STATUSES)
+               .aggregate(Max('timestamp'))['timestamp__max'])
+    if started is None:
+        return time.time()
+    return calendar.timegm(started.utctimetuple()) + started.microsecond / 1e6
+
+
+def request_stop(instance, reason):
+    """
+    Asks the solver of the instance to write the current time step and exit, by setting stopAt to writeNow in the
+    controlDict of the NFS copy of the case. The solver re-reads controlDict while running (runTimeModifiable).
+
+    :param instance: Instance
+    :param reason: Reason for stopping, saved to Instance.stop_reason
+    :return: True if the stop was requested, False if it could not be requested (no local case folder, or controlDict
+    could not be written)
+    """
+    print "Stopping instance %s: %s" % (instance.id, reason)
+    if not instance.local_case_location:
+        print "Instance %s has no local case folder, it can not be stopped early" % instance.id
+        return False
+
+    try:
+        case_utils.update_case_files(instance.local_case_location, {CONTROL_DICT_STOP_AT: STOP_AT_WRITE_NOW})
+    except (IOError, OSError):
+        print "Could not write controlDict of instance %s" % instance.id
+        print traceback.format_exc()
+        return False
+
+    instance.stop_reason = reason[:200]
+    instance.save(update_fields=['stop_reason'])
+    return True
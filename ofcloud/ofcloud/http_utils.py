@@ -0,0 +1,195 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Conditional (ETag, Last-Modified) and ranged (Range, If-Range) responses for file downloads.
+"""
+
+import hashlib
+import os
+import re
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(size, mtime):
+    return quote_etag('%x-%x' % (int(mtime), size))
+
+
+def tree_etag_and_last_modified(tree_path):
+    """
+    Computes a validator of a directory tree from the names, sizes and modification times of its files. The ETag is
+    weak, archives of the same tree generated on the fly are equivalent but not byte-identical (e.g. the gzip header
+    holds the compression time).
+
+    :param tree_path: path of the directory
+    :return: (etag, last_modified) tuple, last_modified is the latest modification time in the tree
+    """
+    digest = hashlib.md5()
+    last_modified = int(os.stat(tree_path).st_mtime)
+    for dir_path, dir_names, file_names in os.walk(tree_path):
+        dir_names.sort()
+        for name in sorted(file_names):
+            file_path = os.path.join(dir_path, name)
+            try:
+                file_stat = os.lstat(file_path)
+            except OSError:
+                continue
+            last_modified = max(last_modified, int(file_stat.st_mtime))
+            digest.update('%s\0%x\0%x\0' % (os.path.relpath(file_path, tree_path), file_stat.st_size,
+                                            int(file_stat.st_mtime)))
+    return 'W/' + quote_etag(digest.hexdigest()), last_modified
+
+
+def not_modified_response(request, etag=None, last_modified=None):
+    """
+    Evaluates the conditional headers of the request (If-None-Match, If-Modified-Since, If-Match, ...).
+
+    :return: 304 or 412 response, or None if the full response should be sent
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+
+def parse_range(request, size, etag, last_modified):
+    """
+    Parses a single byte range of the Range header. Multiple ranges are not supported, the whole content is sent.
+
+    :return: (start, end) tuple with inclusive end, None if the whole content should be sent
+    :raises ValueError: when the range can not be satisfied
+    """
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+
+    # If-Range: the range only applies if the content did not change
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != etag:
+                return None
+        else:
+            if_range_date = parse_http_date_safe(if_range)
+            if if_range_date is None or last_modified is None or int(last_modified) > if_range_date:
+                return None
+
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if size == 0:
+        raise ValueError('Range %s not satisfiable for empty content' % header)
+
+    if not first:
+        # suffix range, last N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - suffix, 0), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range %s not satisfiable for size %d' % (header, size))
+    return start, end
+
+
+def ranged_file_response(request, file_path, content_type):
+    """
+    Sends the local file, honouring conditional and Range requests.
+
+    :param request: Django request
+    :param file_path: path of the local file
+    :param content_type: content type of the response
+    :return: 200, 206, 304, 412 or 416 response
+    """
+    file_stat = os.stat(file_path)
+    size = file_stat.st_size
+    etag = file_etag(size, file_stat.st_mtime)
+    last_modified = int(file_stat.st_mtime)
+
+    response = not_modified_response(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    try:
+        byte_range = parse_range(request, size, etag, last_modified)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    start, end = byte_range if byte_range else (0, size - 1)
+    response = StreamingHttpResponse(read_file_range(file_path, start, end - start + 1),
+                                     content_type=content_type, status=206 if byte_range else 200)
+    response['Content-Length'] = str(max(end - start + 1, 0))
+    if byte_range:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Accept-Ranges'] = 'bytes'
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def read_file_range(file_path, offset, length, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generator of at most length bytes of the file, starting at offset.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_content_response(request, content, content_type):
+    """
+    Sends content held in memory, honouring Range requests. Used when the content has no stable validators.
+    """
+    size = len(content)
+    try:
+        byte_range = parse_range(request, size, None, None)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if byte_range is None:
+        response = HttpResponse(content, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = HttpResponse(content[start:end + 1], content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
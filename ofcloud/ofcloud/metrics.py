@@ -0,0 +1,302 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Instrumentation of the scheduler daemon.
+
+Counters, gauges and histograms are kept in memory of the daemon and exposed in the Prometheus text format on
+SCHEDULER_METRICS_ADDRESS (http://<host>:<port>/metrics). The REST API proxies them on /metrics/. Updating a
+metric only takes a lock and a few additions, so instrumented code does not slow down noticeably.
+"""
+
+import threading
+import time
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Count
+
+from ofcloud.models import Instance, Simulation
+
+DEFAULT_METRICS_ADDRESS = ('127.0.0.1', 8010)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from quick REST calls up to VM launches
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def get_metrics_address():
+    return getattr(settings, 'SCHEDULER_METRICS_ADDRESS', DEFAULT_METRICS_ADDRESS)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = zip(labelnames, labelvalues)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, _escape_label_value(value)) for name, value in pairs])
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Metric %s has labels %s, got %s" % (self.name, self.labelnames, sorted(labels)))
+        return tuple([str(labels[name]) for name in self.labelnames])
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.metric_type)]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))
+                for key, value in values]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Gauge set by the instrumented code, or computed at exposition time by callback, which returns a dictionary with
+    tuples of label values as keys.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.callback:
+            values = self.callback()
+            with self._lock:
+                self._values = dict(values)
+        return _Metric._samples(self)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # [bucket counts..., sum, count]
+                self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            counts = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted([(key, list(counts)) for key, counts in self._values.items()])
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.labelnames, key,
+                                                                           ('le', _format_value(bound))), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(counts[-2])))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, key), counts[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = []
+
+    def register(self, metric):
+        with self.__lock:
+            self.__metrics.append(metric)
+        return metric
+
+    def expose(self):
+        with self.__lock:
+            registered = list(self.__metrics)
+        lines = []
+        for metric in registered:
+            try:
+                lines.extend(metric.expose())
+            except:
+                print "Could not expose metric %s" % metric.name
+                print traceback.format_exc()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def __count_by_status(model):
+    return dict(((row['status'],), row['count'])
+                for row in model.objects.values('status').annotate(count=Count('id')).order_by())
+
+
+def count_instances_by_status():
+    return __count_by_status(Instance)
+
+
+def count_simulations_by_status():
+    return __count_by_status(Simulation)
+
+
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    'ofcloud_scheduler_phase_seconds', 'Duration of scheduler phase runs.', ['phase']))
+PHASE_ERRORS = REGISTRY.register(Counter(
+    'ofcloud_scheduler_phase_errors_total', 'Scheduler phase runs which raised an exception.', ['phase']))
+PREPARE_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'ofcloud_prepare_stage_seconds', 'Duration of instance preparation stages (case files, image, launch ...).',
+    ['stage']))
+PROVIDER_CALLS = REGISTRY.register(Counter(
+    'ofcloud_provider_calls_total', 'Calls to providers.', ['provider', 'operation']))
+PROVIDER_CALL_ERRORS = REGISTRY.register(Counter(
+    'ofcloud_provider_call_errors_total', 'Calls to providers which raised an exception.', ['provider', 'operation']))
+PROVIDER_CALL_SECONDS = REGISTRY.register(Histogram(
+    'ofcloud_provider_call_seconds', 'Duration of calls to providers.', ['provider', 'operation']))
+PREPARE_IN_FLIGHT = REGISTRY.register(Gauge(
+    'ofcloud_prepare_in_flight', 'Instances being prepared by the preparation pool.'))
+INSTANCES = REGISTRY.register(Gauge(
+    'ofcloud_instances', 'Instances per status.', ['status'], callback=count_instances_by_status))
+SIMULATIONS = REGISTRY.register(Gauge(
+    'ofcloud_simulations', 'Simulations per status.', ['status'], callback=count_simulations_by_status))
+
+
+@contextmanager
+def provider_call(provider, operation):
+    """
+    Counts and times the enclosed call to the provider, exceptions are counted as errors and re-raised.
+
+    :param provider: Provider instance
+    :param operation: name of the called operation, e.g. 'prepare_instances'
+    """
+    provider_id = provider.get_provider_id()
+    PROVIDER_CALLS.inc(provider=provider_id, operation=operation)
+    start = time.time()
+    try:
+        yield
+    except:
+        PROVIDER_CALL_ERRORS.inc(provider=provider_id, operation=operation)
+        raise
+    finally:
+        PROVIDER_CALL_SECONDS.observe(time.time() - start, provider=provider_id, operation=operation)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = REGISTRY.expose()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the daemon log
+        pass
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server():
+    """
+    Serves the metrics of this process on SCHEDULER_METRICS_ADDRESS in a background thread. Should only be called by
+    the scheduler daemon. Setting SCHEDULER_METRICS_ADDRESS to None disables the endpoint.
+
+    :return: The HTTP server or None
+    """
+    address = get_metrics_address()
+    if not address:
+        return None
+
+    try:
+        server = _MetricsServer(tuple(address), _MetricsHandler)
+    except Exception:
+        print "Could not serve metrics on %s:%d" % tuple(address)
+        print traceback.format_exc()
+        return None
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    print "Serving metrics on http://%s:%d/metrics" % tuple(address)
+    return server
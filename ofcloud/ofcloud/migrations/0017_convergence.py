@@ -0,0 +1,39 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ofcloud', '0016_simulation_decomposition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simulation',
+            name='convergence',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='stop_reason',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ofcloud', '0017_convergence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceTransition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(blank=True, max_length=100)),
+                ('to_status', models.CharField(max_length=100)),
+                ('timestamp', models.DateTimeField()),
+                ('provider', models.CharField(blank=True, max_length=100)),
+                ('duration', models.FloatField(null=True)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transitions',
+                                               to='ofcloud.Instance')),
+            ],
+            options={
+                'ordering': ('timestamp',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='instancetransition',
+            index=models.Index(fields=['instance', 'timestamp'], name='ofcloud_tr_instance_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instancetransition',
+            index=models.Index(fields=['to_status', 'timestamp'], name='ofcloud_tr_status_time_idx'),
+        ),
+    ]
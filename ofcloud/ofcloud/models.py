@@ -54,6 +54,8 @@ class Simulation(models.Model):
 
     status = models.CharField(max_length=100, default=Status.PENDING.name)
     decomposition = models.TextField(blank=True)
+    # JSON convergence policy for early termination of the instances, see convergence.py
+    convergence = models.TextField(blank=True)
 
 
 class Instance(models.Model):
@@ -115,9 +117,34 @@ class Instance(models.Model):
 
     parallelisation = models.IntegerField(default=1)
 
+    # why the solver was stopped before its endTime, see convergence.py
+    stop_reason = models.CharField(max_length=200, blank=True)
+
     @property
     def multicore(self):
         return self.parallelisation > 1
 
     class Meta:
         ordering = ('name',)
+
+
+class InstanceTransition(models.Model):
+    """
+    Append-only log of the status changes of instances, see transitions.py. Every change from from_status to
+    to_status is recorded with the provider of the instance at that time and the duration in seconds the instance
+    spent in from_status. The first transition of an instance has an empty from_status and no duration.
+    """
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE, related_name='transitions')
+
+    from_status = models.CharField(max_length=100, blank=True)
+    to_status = models.CharField(max_length=100)
+    timestamp = models.DateTimeField()
+    provider = models.CharField(max_length=100, blank=True)
+    duration = models.FloatField(null=True)
+
+    class Meta:
+        ordering = ('timestamp',)
+        indexes = [
+            models.Index(fields=['instance', 'timestamp'], name='ofcloud_tr_instance_time_idx'),
+            models.Index(fields=['to_status', 'timestamp'], name='ofcloud_tr_status_time_idx'),
+        ]
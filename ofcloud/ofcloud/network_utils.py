@@ -16,9 +16,6 @@
 from os import environ as env
 
 from django.conf import settings
-from keystoneauth1 import session
-from keystoneauth1.identity import v2
-from neutronclient.v2_0 import client as ntclient
 
 
 def get_openfoam_network_id():
@@ -164,13 +161,6 @@ def __get_public_networks(neutron):
 
 
 def __get_neutron_client():
-    auth = v2.Password(
-        auth_url=env['OS_AUTH_URL'],
-        username=env['OS_USERNAME'],
-        password=env['OS_PASSWORD'],
-        tenant_id=env['OS_TENANT_ID'])
-    # Open auth session
-    sess = session.Session(auth=auth)
-
-    # Authenticate against required services
-    return ntclient.Client(session=sess)
+    # openstack_utils depends on models, which are not loaded yet when this module is imported by the app config
+    from ofcloud import openstack_utils
+    return openstack_utils.get_neutron_client()
@@ -13,39 +13,96 @@
 # limitations under the License.
 
 
+import threading
 from os import environ as env
 
+import glanceclient.v2.client as glclient
 import neutronclient.v2_0.client as neutron_client
 import novaclient.client as nvclient
-import glanceclient.v2.client as glclient
+import requests
+from django.conf import settings
 from keystoneauth1 import session
 from keystoneauth1.identity import v2
 
-from models import Simulation
+DEFAULT_TOKEN_REFRESH_MARGIN_SECONDS = 300
+DEFAULT_CONNECTION_POOL_SIZE = 16
+
+__registry_lock = threading.RLock()
+# credentials -> keystone session
+__sessions = {}
+# (keystone session, service name) -> client
+__clients = {}
+
+
+class ResourceSet:
+    """
+    Amounts of the resources the scheduler keeps track of.
+    """
+
+    def __init__(self, cores, instances, ram, floating_ips):
+        self.cores = cores
+        self.instances = instances
+        self.ram = ram
+        self.floating_ips = floating_ips
+
+    @classmethod
+    def from_quota_set(cls, quota_set):
+        return cls(cores=quota_set.cores,
+                   instances=quota_set.instances,
+                   ram=quota_set.ram,
+                   floating_ips=quota_set.floating_ips)
+
+    def __str__(self):
+        return "cores=%s, instances=%s, ram=%s, floating_ips=%s" % (self.cores, self.instances, self.ram,
+                                                                    self.floating_ips)
 
 
 def authenticate():
-    # Authenticate using ENV variables
-    auth = v2.Password(
-        auth_url=env['OS_AUTH_URL'],
-        username=env['OS_USERNAME'],
-        password=env['OS_PASSWORD'],
-        tenant_id=env['OS_TENANT_ID'])
-    # Open auth session
-    sess = session.Session(auth=auth)
+    """
+    Returns the keystone session for the OpenStack credentials in the environment.
+
+    Sessions are shared by the whole process, one per set of credentials. A session keeps its token until it is about
+    to expire (see OPENSTACK_TOKEN_REFRESH_MARGIN_SECONDS), then it is refreshed proactively. HTTP connections of the
+    session are pooled and kept alive.
+
+    :return: keystoneauth1 Session
+    """
+    credentials = (env['OS_AUTH_URL'], env['OS_USERNAME'], env['OS_PASSWORD'], env['OS_TENANT_ID'])
+
+    with __registry_lock:
+        sess = __sessions.get(credentials)
+        if sess is None:
+            # Authenticate using ENV variables
+            auth = v2.Password(
+                auth_url=credentials[0],
+                username=credentials[1],
+                password=credentials[2],
+                tenant_id=credentials[3])
+
+            pool_size = getattr(settings, 'OPENSTACK_CONNECTION_POOL_SIZE', DEFAULT_CONNECTION_POOL_SIZE)
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            http_session.mount('http://', adapter)
+            http_session.mount('https://', adapter)
+
+            # Open auth session
+            sess = session.Session(auth=auth, session=http_session)
+            __sessions[credentials] = sess
+
+        __refresh_token_if_expiring(sess)
     return sess
 
 
 def get_nova_client():
-    return nvclient.Client("2", session=authenticate())
+    return __get_client('nova', lambda sess: nvclient.Client("2", session=sess))
 
 
 def get_neutron_client():
-    return neutron_client.Client(session=authenticate())
+    return __get_client('neutron', lambda sess: neutron_client.Client(session=sess))
 
 
 def get_glance_client():
-    return glclient.Client(session=authenticate())
+    return __get_client('glance', lambda sess: glclient.Client(session=sess))
 
 
 def get_available_resources(quotas_set, servers_list, deploying_simulation_instances, flavor_dict, floating_ips):
@@ -58,7 +115,7 @@ def get_available_resources(quotas_set, servers_list, deploying_simulation_insta
     :param servers_list: a list of running nova servers
     :type servers_list: List
     :param deploying_simulation_instances: List of Instance models representing simulation instances currently being
-    deployed
+    deployed. Their simulations should be fetched along with them, e.g. with select_related('simulation')
     :type deploying_simulation_instances: List
     :param flavor_dict: a dictionary of available nova flavors. Keys in the dict must be flavor_ids, values
     must be flavor objects
@@ -78,9 +135,7 @@ def get_available_resources(quotas_set, servers_list, deploying_simulation_insta
     quotas_set.floating_ips -= len(floating_ips)
 
     for simulation_instance in deploying_simulation_instances:
-        simulation = Simulation.objects.get(id=simulation_instance.simulation_id)
-        # instance_num = len(Instance.objects.filter(simulation_id=simulation.id))
-        simulation_flavor = flavor_dict[simulation.flavor]
+        simulation_flavor = flavor_dict[simulation_instance.simulation.flavor]
 
         quotas_set.cores -= simulation_flavor.vcpus
         # Here we actually do not know, how many of these instances will have a floating ip assigned,
@@ -107,3 +162,22 @@ def build_flavor_dict(flavor_list):
         flavor_dict[flavor.id] = flavor
 
     return flavor_dict
+
+
+def __get_client(service, create_client):
+    sess = authenticate()
+    with __registry_lock:
+        client = __clients.get((sess, service))
+        if client is None:
+            client = create_client(sess)
+            __clients[(sess, service)] = client
+        return client
+
+
+def __refresh_token_if_expiring(sess):
+    auth_ref = sess.auth.auth_ref
+    margin = getattr(settings, 'OPENSTACK_TOKEN_REFRESH_MARGIN_SECONDS', DEFAULT_TOKEN_REFRESH_MARGIN_SECONDS)
+    if auth_ref is not None and auth_ref.will_expire_soon(margin):
+        print "Keystone token expires soon, refreshing"
+        sess.auth.invalidate()
+        sess.auth.get_access(sess)
@@ -0,0 +1,193 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Instance pipelines of the scheduler daemon.
+
+With OPENFOAM_PIPELINE_MODE enabled, every prepared instance gets a pipeline thread which chains the openFOAM stages of
+the instance: decomposePar -> solver -> reconstructPar. The pipeline watches only the thread of its own instance, every
+OPENFOAM_PIPELINE_POLL_INTERVAL_SECONDS, and starts the next stage as soon as the previous one terminates, instead of
+waiting for the run and reconstruct phases of the scheduler. Instance.status still reflects the current stage. When the
+last stage terminates, the instance is handed over to the shutdown phase.
+"""
+
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+from ofcloud import metrics
+from ofcloud import scheduler_events
+from ofcloud import transitions
+from ofcloud import utils
+from ofcloud.models import Instance
+
+DEFAULT_PIPELINE_MODE = False
+DEFAULT_POLL_INTERVAL_SECONDS = 1
+# consecutive failed thread probes after which the instance is left to the scheduler phases
+DEFAULT_MAX_PROBE_ERRORS = 30
+
+# Statuses of instances a pipeline can take over
+PIPELINE_STATUSES = [Instance.Status.READY.name,
+                     Instance.Status.DECOMPOSING.name,
+                     Instance.Status.RUNNING.name,
+                     Instance.Status.RUNNING_MPI.name,
+                     Instance.Status.RECONSTRUCTING.name]
+
+
+def is_pipeline_mode():
+    return getattr(settings, 'OPENFOAM_PIPELINE_MODE', DEFAULT_PIPELINE_MODE)
+
+
+class PipelineManager:
+    """
+    Keeps track of the instances with a running pipeline. The scheduler phases leave these instances alone. Instances
+    whose pipeline ended are not taken over again, the scheduler phases finish them and then forget them.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__managed = set()
+        self.__ended = set()
+
+    def start(self, instance, provider):
+        """
+        Starts the pipeline of the instance, unless it already has one.
+
+        :param instance: Instance in one of PIPELINE_STATUSES
+        :param provider: Provider of the instance
+        :return: True if a pipeline was started
+        """
+        with self.__lock:
+            if instance.id in self.__managed or instance.id in self.__ended:
+                return False
+            self.__managed.add(instance.id)
+
+        thread = threading.Thread(target=self.__run, args=(instance, provider), name='pipeline-%s' % instance.id)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def is_managed(self, instance_id):
+        with self.__lock:
+            return instance_id in self.__managed
+
+    def can_start(self, instance_id):
+        with self.__lock:
+            return instance_id not in self.__managed and instance_id not in self.__ended
+
+    def is_ended(self, instance_id):
+        with self.__lock:
+            return instance_id in self.__ended
+
+    def forget(self, instance_ids):
+        """
+        Drops finished instances, which will not be seen by the scheduler phases again.
+        """
+        with self.__lock:
+            self.__ended.difference_update(instance_ids)
+
+    def __run(self, instance, provider):
+        try:
+            InstancePipeline(instance, provider).run()
+        except:
+            print "Pipeline of instance %s failed, leaving the instance to the scheduler" % instance.id
+            print traceback.format_exc()
+        finally:
+            with self.__lock:
+                self.__managed.discard(instance.id)
+                if instance.status not in transitions.FINAL_STATUSES:
+                    self.__ended.add(instance.id)
+            # the instance either finished its last stage or is left to the scheduler phases
+            scheduler_events.notify(scheduler_events.PHASE_SHUTDOWN)
+            scheduler_events.notify(scheduler_events.PHASE_RECONSTRUCT)
+
+
+class InstancePipeline:
+    def __init__(self, instance, provider):
+        self.instance = instance
+        self.provider = provider
+        self.poll_interval = getattr(settings, 'OPENFOAM_PIPELINE_POLL_INTERVAL_SECONDS',
+                                     DEFAULT_POLL_INTERVAL_SECONDS)
+        self.max_probe_errors = getattr(settings, 'OPENFOAM_PIPELINE_MAX_PROBE_ERRORS', DEFAULT_MAX_PROBE_ERRORS)
+        self.timings = []
+
+    def run(self):
+        self.__reload()
+        instance = self.instance
+        print "Pipeline of instance %s started in state %s" % (instance.id, instance.status)
+
+        if instance.status == Instance.Status.DECOMPOSING.name:
+            if not self.__wait_for_thread('decompose'):
+                return
+            utils.update_instance_status([instance], Instance.Status.READY.name)
+            self.__reload()
+
+        if instance.status == Instance.Status.READY.name:
+            with metrics.provider_call(self.provider, 'run_simulation'):
+                self.provider.run_simulation(instance)
+            if instance.status == Instance.Status.FAILED.name:
+                instance.save(update_fields=['status'])
+                return
+
+        if instance.status in [Instance.Status.RUNNING.name, Instance.Status.RUNNING_MPI.name]:
+            if not self.__wait_for_thread('solve'):
+                return
+            self.__reload()
+
+        if instance.status == Instance.Status.RUNNING_MPI.name:
+            with metrics.provider_call(self.provider, 'run_reconstruction'):
+                self.provider.run_reconstruction(instance)
+
+        if instance.status == Instance.Status.RECONSTRUCTING.name:
+            if not self.__wait_for_thread('reconstruct'):
+                return
+
+        print "Pipeline of instance %s finished, stage timings: %s" % (
+            instance.id, ", ".join(["%s %.2fs" % (stage, duration) for stage, duration in self.timings]))
+
+    def __reload(self):
+        # other threads save fields of the instance while a stage runs, e.g. stop_reason of the convergence watcher
+        self.instance.refresh_from_db()
+        transitions.set_recorded_status(self.instance, self.instance.status)
+
+    def __wait_for_thread(self, stage):
+        """
+        Waits until the openFOAM thread of the instance terminates.
+
+        :return: True if the thread terminated, False if the pipeline should stop
+        """
+        started = time.time()
+        errors = 0
+        while True:
+            thread_list, error = utils.probe_instance_threads([self.instance])[0]
+            if error:
+                errors += 1
+                if errors >= self.max_probe_errors:
+                    print "Could not probe instance %s %d times: %s" % (self.instance.id, errors, error)
+                    return False
+            else:
+                errors = 0
+                if utils.is_openfoam_thread_finished(self.instance, thread_list):
+                    self.timings.append((stage, time.time() - started))
+                    return True
+
+            # the instance might have been completed or removed by someone else in the meantime
+            if not Instance.objects.filter(id=self.instance.id, status=self.instance.status).exists():
+                print "Instance %s left state %s, stopping its pipeline" % (self.instance.id, self.instance.status)
+                return False
+
+            time.sleep(self.poll_interval)
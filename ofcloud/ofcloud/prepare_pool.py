@@ -0,0 +1,148 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from ofcloud import utils
+
+
+class PreparePool:
+    """
+    Bounded pool of worker threads preparing simulation instances.
+
+    Admission (quota check and claiming of the instance) is done serially by the dispatching thread, so the quota
+    checks of the providers always see the instances claimed before. Only the slow part of the preparation (case files,
+    OSv image, launching the VM and configuring it) is executed by the pool workers.
+
+    Claimed instances of the same simulation and provider are prepared in batches of up to batch_size instances, so
+    the provider can launch them together. The number of instances being prepared at once is limited to
+    pool_size * batch_size and, per provider, by the 'MAX_CONCURRENT_PREPARATIONS' provider setting.
+    """
+
+    def __init__(self, pool_size, simulation_providers, batch_size=1, pipeline_manager=None):
+        self.pool_size = pool_size
+        self.simulation_providers = simulation_providers
+        self.batch_size = batch_size
+        # starts the pipelines of the prepared instances in OPENFOAM_PIPELINE_MODE
+        self.pipeline_manager = pipeline_manager
+
+        self.__pool = ThreadPool(pool_size)
+        self.__lock = threading.Lock()
+        # instance id -> provider id of all the instances currently being prepared
+        self.__in_flight = {}
+
+    def dispatch(self, pending_instances):
+        """
+        Claims as many of the provided pending instances as the pool and the providers allow and submits them to the
+        pool workers.
+
+        :param pending_instances: Instances in Instance.Status.PENDING state
+        :return: Number of instances submitted for preparation
+        """
+        submitted = 0
+        # (simulation id, provider id) -> (provider, claimed instances) of batches not submitted yet
+        batches = OrderedDict()
+        for instance in pending_instances:
+            if self.is_in_flight(instance):
+                continue
+
+            available_providers = self.__get_available_providers()
+            if not available_providers:
+                print "Preparation pool is full, %d instances are being prepared" % self.in_flight_count()
+                break
+
+            provider = utils.claim_simulation_instance(instance, available_providers)
+            if provider is None:
+                continue
+
+            with self.__lock:
+                self.__in_flight[instance.id] = provider.get_provider_id()
+            submitted += 1
+
+            key = (instance.simulation_id, provider.get_provider_id())
+            _, batch = batches.setdefault(key, (provider, []))
+            batch.append(instance)
+            if len(batch) >= self.batch_size:
+                self.__submit(*batches.pop(key))
+
+        for provider, batch in batches.values():
+            self.__submit(provider, batch)
+
+        return submitted
+
+    def is_in_flight(self, instance):
+        with self.__lock:
+            return instance.id in self.__in_flight
+
+    def in_flight_count(self, provider_id=None):
+        with self.__lock:
+            if provider_id is None:
+                return len(self.__in_flight)
+            return len([p_id for p_id in self.__in_flight.values() if p_id == provider_id])
+
+    def submit_recycled(self, instance, finished_instance, provider):
+        """
+        Submits a pending instance, already claimed for the VM of the finished instance, to the pool workers.
+        """
+        with self.__lock:
+            self.__in_flight[instance.id] = provider.get_provider_id()
+        print "Submitting instance %s for preparation on the VM of instance %s" % (instance.id, finished_instance.id)
+        self.__pool.apply_async(self.__prepare_recycled, (instance, finished_instance, provider))
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+
+    def __submit(self, provider, instances):
+        print "Submitting instances %s for preparation with provider %s" % (
+            ", ".join([str(instance.id) for instance in instances]), provider.get_provider_id())
+        self.__pool.apply_async(self.__prepare, (instances, provider))
+
+    def __get_available_providers(self):
+        if self.in_flight_count() >= self.pool_size * self.batch_size:
+            return []
+
+        available_providers = []
+        for provider in self.simulation_providers:
+            limit = provider.max_concurrent_preparations
+            if limit is None or self.in_flight_count(provider.get_provider_id()) < limit:
+                available_providers.append(provider)
+        return available_providers
+
+    def __prepare_recycled(self, instance, finished_instance, provider):
+        try:
+            if utils.prepare_recycled_instance(instance, finished_instance, provider) and self.pipeline_manager:
+                self.pipeline_manager.start(instance, provider)
+        except:
+            print traceback.format_exc()
+        finally:
+            with self.__lock:
+                self.__in_flight.pop(instance.id, None)
+
+    def __prepare(self, instances, provider):
+        try:
+            prepared_instances = utils.prepare_simulation_instances(instances, provider)
+            if self.pipeline_manager:
+                for instance in prepared_instances:
+                    self.pipeline_manager.start(instance, provider)
+        except:
+            print traceback.format_exc()
+        finally:
+            with self.__lock:
+                for instance in instances:
+                    self.__in_flight.pop(instance.id, None)
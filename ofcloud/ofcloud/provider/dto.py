@@ -13,9 +13,34 @@
 # limitations under the License.
 
 
+import time
+from collections import OrderedDict
+
+
 class ProviderLaunchDto:
-    def __init__(self, simulation_instance, image_name, capstan_package_folder):
+    def __init__(self, simulation_instance, image_name, image_file):
         self.simulation_instance = simulation_instance
         self.image_name = image_name
-        self.capstan_package_folder = capstan_package_folder
-        self.unique_server_name = None
\ No newline at end of file
+        self.image_file = image_file
+        self.unique_server_name = None
+        # stage name -> duration of the stage in seconds
+        self.timings = OrderedDict()
+
+
+class ProviderInventoryDto:
+    """
+    Snapshot of the resources of one provider, shared by all scheduler phases until it expires.
+
+    servers - list of servers (VMs) currently existing on the provider
+    flavors - dictionary of available flavors, key - flavor id, value - flavor object
+    floating_ips - list of floating IPs currently in use
+    quotas - quota set of the provider
+    """
+
+    def __init__(self, servers, flavors=None, floating_ips=None, quotas=None):
+        self.servers = servers
+        self.flavors = flavors if flavors is not None else {}
+        self.floating_ips = floating_ips if floating_ips is not None else []
+        self.quotas = quotas
+        self.server_ids = {server.id: True for server in servers}
+        self.created_at = time.time()
@@ -0,0 +1,97 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+
+from ofcloud.openstack_utils import ResourceSet
+
+
+class ResourceLedger:
+    """
+    In-memory account of the resources of one provider, used for admission of simulation instances.
+
+    The ledger is reconciled against a provider inventory snapshot: the available resources are the quotas minus the
+    resources used by existing servers and floating IPs, minus the reservations of instances whose servers do not exist
+    yet. Between reconciliations, reservations and releases only update the in-memory account, so admission decisions
+    need no remote calls.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__inventory = None
+        # resources available without the reservations
+        self.__available = None
+        # instance id -> ResourceSet reserved for the instance
+        self.__reservations = {}
+
+    def is_reconciled_with(self, inventory):
+        with self.__lock:
+            return self.__inventory is inventory
+
+    def reconcile(self, inventory, available, reservations):
+        """
+        Resets the account.
+
+        :param inventory: ProviderInventoryDto the account is computed from
+        :param available: ResourceSet of resources not used by any server or floating IP
+        :param reservations: dictionary, key - instance id, value - ResourceSet reserved for instances without a server
+        :return:
+        """
+        with self.__lock:
+            self.__inventory = inventory
+            self.__available = available
+            self.__reservations = dict(reservations)
+
+    def try_reserve(self, instance_id, demand):
+        """
+        Reserves the demanded resources for the instance if they are available.
+
+        :param instance_id: id of the instance the resources are reserved for
+        :param demand: ResourceSet of demanded resources
+        :return: True if the resources were reserved, False otherwise
+        """
+        with self.__lock:
+            if instance_id in self.__reservations:
+                return True
+
+            remaining = self.__get_remaining()
+            if remaining.cores < demand.cores \
+                    or remaining.instances < demand.instances \
+                    or remaining.ram < demand.ram \
+                    or remaining.floating_ips < demand.floating_ips:
+                return False
+
+            self.__reservations[instance_id] = demand
+            return True
+
+    def release(self, instance_id):
+        with self.__lock:
+            self.__reservations.pop(instance_id, None)
+
+    def get_remaining(self):
+        with self.__lock:
+            return self.__get_remaining()
+
+    def __get_remaining(self):
+        remaining = ResourceSet(cores=self.__available.cores,
+                                instances=self.__available.instances,
+                                ram=self.__available.ram,
+                                floating_ips=self.__available.floating_ips)
+        for demand in self.__reservations.itervalues():
+            remaining.cores -= demand.cores
+            remaining.instances -= demand.instances
+            remaining.ram -= demand.ram
+            remaining.floating_ips -= demand.floating_ips
+        return remaining
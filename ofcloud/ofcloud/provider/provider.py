@@ -15,6 +15,8 @@
 
 import abc
 import json
+import threading
+import time
 import traceback
 from os import environ as env
 
@@ -22,11 +24,17 @@ import requests
 
 from ofcloud import capstan_utils
 from ofcloud import case_utils
+from ofcloud import metrics
 from ofcloud import utils
 from ofcloud.models import Instance, Simulation
+from osv import api as osv_api
 from snap import api as snap_api
 
 SIMULATION_INSTANCE_CASE_FOLDER = "/case"
+# solver log in the case folder of the instance
+SIMULATION_INSTANCE_LOG_FILE = "run.log"
+
+DEFAULT_INVENTORY_TTL_SECONDS = 10
 
 
 class Provider:
@@ -41,17 +49,47 @@ class Provider:
         self.nfs_address = provider_config.get('NFS_ADDRESS')
         self.max_cpu_usage = provider_config.get('MAX_CPU_USAGE')
         self.max_instance_usage = provider_config.get('MAX_INSTANCE_USAGE')
+        self.max_concurrent_preparations = provider_config.get('MAX_CONCURRENT_PREPARATIONS')
+        self.inventory_ttl = provider_config.get('INVENTORY_TTL_SECONDS', DEFAULT_INVENTORY_TTL_SECONDS)
+
+        self.__inventory = None
+        self.__inventory_generation = 0
+        self.__inventory_lock = threading.Lock()
+        self.__inventory_build_lock = threading.Lock()
 
     @abc.abstractmethod
     def prepare_instance(self, simulation_launch_dto):
         raise NotImplementedError(self.NOT_IMPLEMENTED_MSG)
 
+    def prepare_instances(self, launch_dtos):
+        """
+        Launches a batch of instances of the same simulation. Providers able to launch several servers at once should
+        override this, by default the instances are launched one after another.
+
+        :param launch_dtos: List of ProviderLaunchDto
+        :return: List of (launch_dto, error) tuples, error is None if the instance was launched
+        """
+        results = []
+        for launch_dto in launch_dtos:
+            try:
+                self.prepare_instance(launch_dto)
+                results.append((launch_dto, None))
+            except Exception as e:
+                print traceback.format_exc()
+                results.append((launch_dto, e))
+        return results
+
     @abc.abstractmethod
     def is_simulation_instance_runnable(self, simulation_instance):
         raise NotImplementedError(self.NOT_IMPLEMENTED_MSG)
 
     @abc.abstractmethod
-    def get_running_server_ids(self):
+    def build_inventory(self):
+        """
+        Queries the provider for its current resources.
+
+        :return: ProviderInventoryDto
+        """
         raise NotImplementedError(self.NOT_IMPLEMENTED_MSG)
 
     @abc.abstractmethod
@@ -62,12 +100,70 @@ class Provider:
     def get_instance_cpus(self, instance_simulation):
         raise NotImplementedError(self.NOT_IMPLEMENTED_MSG)
 
+    def reserve_resources(self, simulation_instance):
+        """
+        Reserves the resources required by the simulation instance, if the provider can run it at this moment.
+        Providers without their own resource accounting only check whether the instance is runnable.
+
+        :param simulation_instance: instance object
+        :return: Boolean, True if the resources were reserved
+        """
+        return self.is_simulation_instance_runnable(simulation_instance)
+
+    def release_resources(self, simulation_instance):
+        """
+        Releases the resources reserved for a simulation instance which will not be launched after all.
+
+        :param simulation_instance: instance object
+        """
+        pass
+
     def get_provider_id(self):
         return self.id
 
     def get_local_nfs_mount_location(self):
         return self.local_nfs_mount_location
 
+    def get_inventory(self):
+        """
+        Returns the inventory snapshot of this provider. The snapshot is rebuilt only when it is older than
+        'INVENTORY_TTL_SECONDS' or was invalidated, otherwise all the callers share the same snapshot.
+
+        :return: ProviderInventoryDto
+        """
+        inventory = self.__get_fresh_inventory()
+        if inventory:
+            return inventory
+
+        with self.__inventory_build_lock:
+            # another thread might have built it while we were waiting
+            inventory = self.__get_fresh_inventory()
+            if inventory:
+                return inventory
+
+            with self.__inventory_lock:
+                generation = self.__inventory_generation
+
+            with metrics.provider_call(self, 'build_inventory'):
+                inventory = self.build_inventory()
+
+            with self.__inventory_lock:
+                # do not cache a snapshot which was invalidated while being built
+                if generation == self.__inventory_generation:
+                    self.__inventory = inventory
+            return inventory
+
+    def invalidate_inventory(self):
+        """
+        Drops the inventory snapshot. Should be called after creating or deleting servers.
+        """
+        with self.__inventory_lock:
+            self.__inventory = None
+            self.__inventory_generation += 1
+
+    def get_running_server_ids(self):
+        return self.get_inventory().server_ids
+
     def split_running_and_orphaned_instances(self, instances):
         server_ids = self.get_running_server_ids()
         running_instances = []
@@ -79,12 +175,20 @@ class Provider:
                 orphaned_instances.append(instance)
         return running_instances, orphaned_instances
 
+    def __get_fresh_inventory(self):
+        with self.__inventory_lock:
+            inventory = self.__inventory
+        if inventory and time.time() - inventory.created_at < self.inventory_ttl:
+            return inventory
+        return None
+
     def prepare_instance_env(self, launch_dto):
         # START modifying the running server, setup nfs mount, snap collector, some ENV variables and
         # start the simulation
 
         print "Customising simulations"
         instance_api = utils.rest_api_for(launch_dto.simulation_instance.ip)
+        api_session = osv_api.get_session(launch_dto.simulation_instance.ip)
         # Request input case update given the provided customisations.
         case_utils.update_case_files(launch_dto.simulation_instance.local_case_location,
                                      json.loads(launch_dto.simulation_instance.config))
@@ -97,24 +201,27 @@ class Provider:
         print "\t\tsetting up the execution environment"
 
         # Now we need to setup some env variables.
-        requests.post("%s/env/OPENFOAM_CASE" % instance_api,
-                      data={"val": '%s-%s' % (
-                          launch_dto.unique_server_name, launch_dto.simulation_instance.name)})
-        requests.post("%s/env/TENANT" % instance_api, data={"val": env['OS_TENANT_NAME']})
-        requests.post("%s/env/WM_PROJECT_DIR" % instance_api, data={"val": '/openfoam'})
+        api_session.post("%s/env/OPENFOAM_CASE" % instance_api,
+                         data={"val": '%s-%s' % (
+                             launch_dto.unique_server_name, launch_dto.simulation_instance.name)})
+        api_session.post("%s/env/TENANT" % instance_api, data={"val": env.get('OS_TENANT_NAME', '')})
+        api_session.post("%s/env/WM_PROJECT_DIR" % instance_api, data={"val": '/openfoam'})
 
-        requests.post("%s/env/LD_LIBRARY_PATH" % instance_api, data={"val": '/usr/bin/'})
-        requests.post("%s/env/PATH" % instance_api, data={"val": '/usr/bin/'})
+        api_session.post("%s/env/LD_LIBRARY_PATH" % instance_api, data={"val": '/usr/bin/'})
+        api_session.post("%s/env/PATH" % instance_api, data={"val": '/usr/bin/'})
 
-        requests.post("%s/env/MPI_BUFFER_SIZE" % instance_api, data={"val": '1000000'})
+        api_session.post("%s/env/MPI_BUFFER_SIZE" % instance_api, data={"val": '1000000'})
 
-        self.start_snap_collector(launch_dto)
+        # circular dependency import, residual_collector uses the case folder constants of this module
+        from ofcloud import residual_collector
+        if residual_collector.get_collector_type() == residual_collector.COLLECTOR_SNAP:
+            self.start_snap_collector(launch_dto)
 
         if launch_dto.simulation_instance.multicore:
             # if we plan running on multiple cpus run decomposePar first
             decompose_command = "/usr/bin/decomposePar -case %s" % SIMULATION_INSTANCE_CASE_FOLDER
             launch_dto.simulation_instance.status = Instance.Status.DECOMPOSING.name
-            req = requests.put("%s/app/" % instance_api, data={"command": decompose_command}, timeout=30)
+            req = api_session.put("%s/app/" % instance_api, data={"command": decompose_command}, timeout=30)
             # strip double quotes, because request returns '"200"' which fails when parsing to int
             launch_dto.simulation_instance.thread_id = int(req.text.strip('"'))
         else:
@@ -126,6 +233,10 @@ class Provider:
 
         return launch_dto
 
+    def unmount_instance_case_folder(self, simulation_instance):
+        instance_api = utils.rest_api_for(simulation_instance.ip)
+        utils.unmount_instance_case_folder(instance_api, simulation_instance, SIMULATION_INSTANCE_CASE_FOLDER)
+
     def run_simulation(self, simulation_instance):
         print "Starting OpenFOAM simulations"
         instance_api = utils.rest_api_for(simulation_instance.ip)
@@ -141,19 +252,24 @@ class Provider:
 
         print 'Sending request with solver command: %s' % solver_command
         try:
-            req = requests.put("%s/app/" % instance_api, data={"command": solver_command}, timeout=30)
+            req = osv_api.get_session(simulation_instance.ip).put("%s/app/" % instance_api,
+                                                                  data={"command": solver_command},
+                                                                  timeout=30)
             simulation_instance.thread_id = int(req.text.strip('"'))
-            simulation_instance.save()
+            # only the fields set here, other fields (e.g. stop_reason) might have been saved by other threads
+            simulation_instance.save(update_fields=['status', 'thread_id'])
         except requests.ConnectionError:
             simulation_instance.status = Instance.Status.FAILED.name
 
     def run_reconstruction(self, simulation_instance):
         instance_api = utils.rest_api_for(simulation_instance.ip)
         reconstruct_command = "/usr/bin/reconstructPar -case %s" % SIMULATION_INSTANCE_CASE_FOLDER
-        req = requests.put("%s/app/" % instance_api, data={"command": reconstruct_command}, timeout=30)
+        req = osv_api.get_session(simulation_instance.ip).put("%s/app/" % instance_api,
+                                                              data={"command": reconstruct_command},
+                                                              timeout=30)
         simulation_instance.thread_id = int(req.text.strip('"'))
         simulation_instance.status = Instance.Status.RECONSTRUCTING.name
-        simulation_instance.save()
+        simulation_instance.save(update_fields=['status', 'thread_id'])
 
     def start_snap_collector(self, simulation_launch_dto):
         try:
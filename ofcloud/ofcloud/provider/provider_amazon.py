@@ -18,6 +18,7 @@ import time
 import boto.ec2
 
 from ofcloud.models import Instance
+from ofcloud.provider.dto import ProviderInventoryDto
 from provider import Provider
 
 
@@ -44,6 +45,8 @@ class AmazonProvider(Provider):
         # TODO try using IP
         print "Amazon instance IP = %s" % instance.ip_address
 
+        self.invalidate_inventory()
+
         launch_dto.simulation_instance.instance_id = instance.id
         launch_dto.simulation_instance.ip = instance.ip_address
         launch_dto.unique_server_name = self.AMI_ID
@@ -69,20 +72,14 @@ class AmazonProvider(Provider):
 
         return amazon_simulation_instances < self.max_instance_usage
 
-    def get_running_server_ids(self):
-        server_ids = {}
-
+    def build_inventory(self):
         conn = boto.ec2.connect_to_region(self.region)
         of_instances_running = conn.get_only_instances(
             filters={"tag:type": "simpleFoam", "instance-state-code": 16})
         of_instances_pending = conn.get_only_instances(
             filters={"tag:type": "simpleFoam", "instance-state-code": 0})
 
-        of_instances = of_instances_pending + of_instances_running
-        for instance in of_instances:
-            server_ids[instance.id] = True
-
-        return server_ids
+        return ProviderInventoryDto(servers=of_instances_pending + of_instances_running)
 
     def shutdown_instances(self, instances):
         """
@@ -99,6 +96,7 @@ class AmazonProvider(Provider):
                 conn.terminate_instances(server_ids)
             except Exception as ex:
                 print "Failed shutting down instances %s, msg: %s" % (instances, ex.message)
+            self.invalidate_inventory()
 
     def get_instance_cpus(self, instance_simulation):
         """
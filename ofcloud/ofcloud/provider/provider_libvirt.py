@@ -0,0 +1,161 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import traceback
+from collections import namedtuple
+
+import libvirt
+
+from ofcloud import capstan_utils, readiness
+from ofcloud.models import Instance
+from ofcloud.provider.dto import ProviderInventoryDto
+from osv import settings as osv_settings
+from osv.vm import VM
+from provider import Provider
+
+# VMs started by osv.vm are named 'osv-<number>'
+OSV_VM_NAME_PREFIX = 'osv-'
+
+DEFAULT_INSTANCE_CPUS = 1
+DEFAULT_INSTANCE_MEMORY = 2048
+DEFAULT_IP_DEADLINE_SECONDS = 120
+
+LibvirtServer = namedtuple('LibvirtServer', ['id', 'name'])
+
+
+class LibvirtProvider(Provider):
+    """
+    Runs simulation instances as OSv VMs on the local libvirt/QEMU hypervisor (qemu:///system) of the scheduler host.
+
+    VMs boot straight from the image in the capstan repository, every VM runs on its own copy of the image, so nothing
+    is uploaded anywhere. The libvirt domain name of the VM is used as the instance id.
+    """
+
+    def __init__(self, provider_id, provider_config):
+        super(LibvirtProvider, self).__init__(provider_id, provider_config)
+        self.instance_cpus = provider_config.get('INSTANCE_CPUS', DEFAULT_INSTANCE_CPUS)
+        self.instance_memory = provider_config.get('INSTANCE_MEMORY', DEFAULT_INSTANCE_MEMORY)
+        self.bridge = provider_config.get('BRIDGE', osv_settings.OSV_BRIDGE)
+        self.ip_deadline = provider_config.get('IP_DEADLINE_SECONDS', DEFAULT_IP_DEADLINE_SECONDS)
+
+    def prepare_instance(self, launch_dto):
+        # VM.run sets the command line of the image with imgedit.py, it must stay the one of the composed image
+        vm = VM(command=capstan_utils.OSV_BOOT_COMMAND,
+                image=launch_dto.image_file,
+                use_image_copy=True,
+                cpus=self.instance_cpus,
+                memory=self.instance_memory,
+                bridge=self.bridge,
+                net_mac='rand')
+
+        print "Starting libvirt VM from image %s" % launch_dto.image_file
+        with readiness.timed_stage(launch_dto.timings, 'boot'):
+            vm.run()
+        self.invalidate_inventory()
+
+        vm_name = vm.name()
+        launch_dto.simulation_instance.instance_id = vm_name
+        launch_dto.unique_server_name = vm_name
+        launch_dto.simulation_instance.save()
+
+        try:
+            # The IP is assigned by DHCP and reported on the VM console
+            with readiness.timed_stage(launch_dto.timings, 'ip'):
+                readiness.wait_until(lambda: vm.wait_ip(Td=1)[0], self.ip_deadline, "IP of VM %s" % vm_name)
+        finally:
+            vm.close_console_log()
+
+        launch_dto.simulation_instance.ip = vm.ip()
+        launch_dto.simulation_instance.status = Instance.Status.UP.name
+        launch_dto.simulation_instance.save()
+
+        print "\tInstance %s accessible at %s" % (vm_name, vm.ip())
+        return launch_dto
+
+    def is_simulation_instance_runnable(self, simulation_instance):
+        """
+        Checks whether another VM fits within MAX_INSTANCE_USAGE and MAX_CPU_USAGE of this host.
+
+        :param simulation_instance: instance object
+        :return: Boolean
+        """
+        inventory = self.get_inventory()
+
+        # Instances being deployed which do not have a running VM yet
+        deploying_instances = Instance.objects.filter(
+            status__in=[Instance.Status.DEPLOYING.name, Instance.Status.UP.name],
+            provider=self.id).exclude(instance_id__in=inventory.server_ids.keys()).count()
+
+        instances = len(inventory.servers) + deploying_instances + 1
+
+        if self.max_instance_usage is not None and instances > self.max_instance_usage:
+            return False
+        if self.max_cpu_usage is not None and instances * self.instance_cpus > self.max_cpu_usage:
+            return False
+        return True
+
+    def build_inventory(self):
+        conn = VM._libvirt_conn()
+        try:
+            servers = [LibvirtServer(id=domain.name(), name=domain.name())
+                       for domain in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+                       if domain.name().startswith(OSV_VM_NAME_PREFIX)]
+        finally:
+            conn.close()
+
+        return ProviderInventoryDto(servers=servers)
+
+    def shutdown_instances(self, instances):
+        """
+        Destroys and undefines the libvirt domains of the provided instances and removes their image copies.
+
+        :param instances: A list of instances
+        :return:
+        """
+        if not instances:
+            return
+
+        conn = VM._libvirt_conn()
+        try:
+            for instance in instances:
+                print "Shutting down libvirt VM %s" % instance.instance_id
+                try:
+                    domain = conn.lookupByName(instance.instance_id)
+                    if domain.isActive():
+                        domain.destroy()
+                    domain.undefine()
+                except libvirt.libvirtError:
+                    print "Could not shutdown libvirt VM %s" % instance.instance_id
+                    print traceback.format_exc()
+
+                self.__remove_image_copy(instance.instance_id)
+        finally:
+            conn.close()
+
+        self.invalidate_inventory()
+
+    def get_instance_cpus(self, instance_simulation):
+        return self.instance_cpus
+
+    def __remove_image_copy(self, vm_name):
+        # see osv.vm.VMParam
+        image_copy = '%s/%s-usr.img' % (osv_settings.OSV_WORK_DIR, vm_name)
+        try:
+            if os.path.exists(image_copy):
+                os.remove(image_copy)
+        except OSError:
+            print "Could not remove image %s" % image_copy
+            print traceback.format_exc()
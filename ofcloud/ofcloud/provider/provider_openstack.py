@@ -13,96 +13,137 @@
 # limitations under the License.
 
 
-import os
-import time
+import threading
 import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from os import environ as env
 
-import glanceclient.v2.client as glclient
-import novaclient.client as nvclient
-from keystoneauth1 import session
-from keystoneauth1.identity import v2
+from django.conf import settings
 
 from ofcloud import network_utils
 from ofcloud import openstack_utils
-from ofcloud.models import Instance, Simulation
+from ofcloud import readiness
+from ofcloud import utils
+from ofcloud.models import Instance
+from ofcloud.provider.dto import ProviderInventoryDto
+from ofcloud.provider.ledger import ResourceLedger
 from provider import Provider
 
+DEFAULT_LAUNCH_CONCURRENCY = 10
+
 
 class OpenstackProvider(Provider):
     def __init__(self, provider_id, provider_config):
         # TODO validation, raise errors if properties missing from config
         super(OpenstackProvider, self).__init__(provider_id, provider_config)
+        self.__ledger = ResourceLedger()
+        self.__ledger_lock = threading.Lock()
+        # batches are prepared concurrently, listing free floating IPs and associating them must not interleave
+        self.__floating_ip_lock = threading.Lock()
 
     def prepare_instance(self, launch_dto):
-        sess = self.__authenticate()
-
-        # Authenticate against required services
-        glance_client = glclient.Client(session=sess)
-        nova_client = nvclient.Client("2", session=sess)
-
-        # TODO see if already there, import build and import if necessary
-        image, unique_image_name = self.__import_image_into_glance(
-            glance_client,
-            launch_dto.image_name,
-            launch_dto.simulation_instance.simulation,
-            launch_dto.capstan_package_folder)
+        launch_dto, error = self.prepare_instances([launch_dto])[0]
+        if error is not None:
+            raise error
 
-        # Get data for the new server we are about to create.
-        of_image = nova_client.images.get(image.id)
-
-        flavor = nova_client.flavors.find(id=launch_dto.simulation_instance.simulation.flavor)
-
-        unique_server_name = '%s-%s' % (
-            launch_dto.simulation_instance.name, str(launch_dto.simulation_instance.id))
+    def prepare_instances(self, launch_dtos):
+        """
+        Launches all the instances of a batch together. The OSv image is uploaded to Glance once, the servers are
+        created in a concurrent burst of up to OPENSTACK_LAUNCH_CONCURRENCY requests and then awaited as a set.
 
-        print "Creating required instance %s" % unique_server_name
+        :param launch_dtos: List of ProviderLaunchDto of instances of the same simulation
+        :return: List of (launch_dto, error) tuples, error is None if the instance was launched
+        """
+        # Authenticate against required services
+        glance_client = openstack_utils.get_glance_client()
+        nova_client = openstack_utils.get_nova_client()
 
-        openfoam_network = network_utils.get_openfoam_network_id()
-        nics = [{'net-id': openfoam_network}]
+        simulation = launch_dtos[0].simulation_instance.simulation
+        batch_timings = OrderedDict()
+        errors = {}
 
-        nova_client.servers.create(name=unique_server_name,
-                                   image=of_image,
-                                   flavor=flavor,
-                                   nics=nics
-                                   )
+        # TODO see if already there, import build and import if necessary
+        with readiness.timed_stage(batch_timings, 'image_upload'):
+            image, unique_image_name = self.__import_image_into_glance(
+                glance_client,
+                launch_dtos[0].image_name,
+                simulation,
+                launch_dtos[0].image_file)
 
-        nova_server_list = nova_client.servers.list(search_opts={'name': unique_server_name})
-        if len(nova_server_list) != 1:
-            raise RuntimeError("Expected 1 server with unique name '%s', instead found %d" % (
-                unique_server_name, len(nova_server_list)))
+        try:
+            # Get data for the new servers we are about to create.
+            of_image = nova_client.images.get(image.id)
 
-        launch_dto.simulation_instance.instance_id = nova_server_list[0].id
-        launch_dto.unique_server_name = unique_server_name
+            flavor = nova_client.flavors.find(id=simulation.flavor)
 
-        # Wait for the instance to become active
-        while True:
-            nova_server = nova_client.servers.get(launch_dto.simulation_instance.instance_id)
+            openfoam_network = network_utils.get_openfoam_network_id()
+            nics = [{'net-id': openfoam_network}]
 
-            if nova_server.status == 'ACTIVE':
-                launch_dto.simulation_instance.status = Instance.Status.UP.name
-                launch_dto.simulation_instance.instance_id = nova_server.id
+            pool = ThreadPool(min(len(launch_dtos),
+                                  getattr(settings, 'OPENSTACK_LAUNCH_CONCURRENCY', DEFAULT_LAUNCH_CONCURRENCY)))
+            try:
+                with readiness.timed_stage(batch_timings, 'create_servers'):
+                    created = pool.map(lambda launch_dto: self.__create_server(nova_client, launch_dto, of_image,
+                                                                               flavor, nics),
+                                       launch_dtos)
+            finally:
+                pool.close()
+            self.invalidate_inventory()
+
+            launched_dtos = []
+            for launch_dto, (server_id, error) in zip(launch_dtos, created):
+                if error is not None:
+                    errors[launch_dto] = error
+                    continue
+                launch_dto.simulation_instance.instance_id = server_id
                 launch_dto.simulation_instance.save()
-                break
-            time.sleep(0.5)
+                launched_dtos.append(launch_dto)
+
+            # Wait for the instances to become active
+            with readiness.timed_stage(batch_timings, 'active'):
+                servers = readiness.wait_for_servers_active(
+                    nova_client, [launch_dto.simulation_instance.instance_id for launch_dto in launched_dtos])
+        finally:
+            # Remove the uploaded image as it is no longer required
+            glance_client.images.delete(image.id)
+
+        active_servers = []
+        for launch_dto in launched_dtos:
+            launch_dto.timings.update(batch_timings)
+            nova_server, error = servers[launch_dto.simulation_instance.instance_id]
+            if error is not None:
+                errors[launch_dto] = error
+            else:
+                launch_dto.simulation_instance.status = Instance.Status.UP.name
+                active_servers.append((launch_dto, nova_server))
 
-        # Remove the uploaded image as it is no longer required
-        glance_client.images.delete(image.id)
+        utils.update_instance_status([launch_dto.simulation_instance for launch_dto, _ in active_servers],
+                                     Instance.Status.UP.name)
 
         # should return something like an address (in nova case this would be the floating ip), and associate
         # that with an instance
         print "Associating floating IPs"
-        nova_server = nova_client.servers.get(launch_dto.simulation_instance.instance_id)
-        floating_ip = self.__get_floating_ip(nova_client)
-        nova_server.add_floating_ip(floating_ip.ip)
-
-        launch_dto.simulation_instance.ip = floating_ip.ip
-        launch_dto.simulation_instance.save()
-
-        print "\tInstance %s accessible at %s" % (nova_server.name, floating_ip.ip)
-
-        print "Wait 5s for the router to setup floating IPs"
-        time.sleep(5)
+        with self.__floating_ip_lock:
+            free_floating_ips = self.__get_free_floating_ips(nova_client)
+            for launch_dto, nova_server in active_servers:
+                try:
+                    with readiness.timed_stage(launch_dto.timings, 'floating_ip'):
+                        if free_floating_ips:
+                            floating_ip = free_floating_ips.pop(0)
+                        else:
+                            floating_ip = nova_client.floating_ips.create('external_network')
+                        nova_server.add_floating_ip(floating_ip.ip)
+
+                    launch_dto.simulation_instance.ip = floating_ip.ip
+                    launch_dto.simulation_instance.save()
+
+                    print "\tInstance %s accessible at %s" % (nova_server.name, floating_ip.ip)
+                except Exception as e:
+                    print traceback.format_exc()
+                    errors[launch_dto] = e
+
+        return [(launch_dto, errors.get(launch_dto)) for launch_dto in launch_dtos]
 
     def is_simulation_instance_runnable(self, simulation_instance):
         """
@@ -112,57 +153,43 @@ class OpenstackProvider(Provider):
         :type simulation_instance: Instance object ofcloud.models.Instance
         :return: Boolean
         """
+        inventory = self.get_inventory()
+        demand = self.__get_instance_demand(simulation_instance.simulation, inventory.flavors)
+        remaining = self.__get_ledger(inventory).get_remaining()
+
+        return \
+            remaining.cores >= demand.cores \
+            and remaining.floating_ips >= demand.floating_ips \
+            and remaining.instances >= demand.instances \
+            and remaining.ram >= demand.ram
+
+    def reserve_resources(self, simulation_instance):
+        """
+        Reserves the resources of the simulation instance in the resource ledger of this provider. The ledger is only
+        reconciled with nova when the inventory snapshot is rebuilt, otherwise no remote calls are made.
+
+        :param simulation_instance: instance object
+        :type simulation_instance: Instance object ofcloud.models.Instance
+        :return: Boolean, True if the resources were reserved
+        """
+        inventory = self.get_inventory()
+        demand = self.__get_instance_demand(simulation_instance.simulation, inventory.flavors)
+        return self.__get_ledger(inventory).try_reserve(simulation_instance.id, demand)
 
-        print "Checking if instance is runnable on OPENSTACK/NOVA"
-        # get nova client
+    def release_resources(self, simulation_instance):
+        self.__ledger.release(simulation_instance.id)
+
+    def build_inventory(self):
         nova = openstack_utils.get_nova_client()
         neutron = openstack_utils.get_neutron_client()
 
-        # get required data
+        servers = nova.servers.list()
         flavor_dict = openstack_utils.build_flavor_dict(nova.flavors.list())
-
         floating_ips = filter(lambda f_ip: f_ip['fixed_ip_address'] is not None,
                               neutron.list_floatingips(retrieve_all=True)['floatingips'])
+        quotas = nova.quotas.get(tenant_id=env['OS_TENANT_ID'])
 
-        deploying_simulation_instances = Instance.objects.filter(status=Instance.Status.DEPLOYING.name,
-                                                                 provider=self.id)
-        simulation = Simulation.objects.get(id=simulation_instance.simulation_id)
-        simulation_flavor = flavor_dict[simulation.flavor]
-
-        servers = nova.servers.list()
-        total_quotas = nova.quotas.get(tenant_id=env['OS_TENANT_ID'])
-
-        # Check which limits are stricter, and use those
-        total_quotas.cores = min(self.max_cpu_usage, total_quotas.cores)
-        total_quotas.instances = min(self.max_instance_usage, total_quotas.instances)
-
-        # build our own quotas and usages, because nova can not do this at the moment
-        available_resources = openstack_utils.get_available_resources(total_quotas,
-                                                                      servers,
-                                                                      deploying_simulation_instances,
-                                                                      flavor_dict,
-                                                                      floating_ips)
-
-        available_resources.cores -= simulation_flavor.vcpus
-        # Here we actually do not know, how many of these instances will have a floating ip assigned,
-        # so to be safe we assume they will all have one
-        available_resources.floating_ips -= 1
-        available_resources.instances -= 1
-        available_resources.ram -= simulation_flavor.ram
-
-        # Configure logging in the future
-        # logging.debug(str(available_resources))
-
-        return \
-            available_resources.cores >= 0 \
-            and available_resources.floating_ips >= 0 \
-            and available_resources.instances >= 0 \
-            and available_resources.ram >= 0
-
-    def get_running_server_ids(self):
-        nova = openstack_utils.get_nova_client()
-        nova_server_ids = {nova_server.id: True for nova_server in nova.servers.list()}
-        return nova_server_ids
+        return ProviderInventoryDto(servers=servers, flavors=flavor_dict, floating_ips=floating_ips, quotas=quotas)
 
     def shutdown_instances(self, instances):
         """
@@ -182,6 +209,9 @@ class OpenstackProvider(Provider):
                 print "Could not shutdown nova server %s" % instance.instance_id
                 print traceback.format_exc()
 
+        if instances:
+            self.invalidate_inventory()
+
     def get_instance_cpus(self, instance_simulation):
         """
         Returns number of cpus this simulation instance will have/does have
@@ -189,21 +219,68 @@ class OpenstackProvider(Provider):
         :param instance_simulation: Instance simulation
         :return:
         """
-        nova = openstack_utils.get_nova_client()
-
         try:
-            return nova.flavors.get(instance_simulation.flavor).vcpus
+            return self.get_inventory().flavors[instance_simulation.flavor].vcpus
         except:
             print "Could not get flavor VCPUs for flavor_id %s, using single threaded mode" % instance_simulation.flavor
             return 1
 
-    def __import_image_into_glance(self, glance_client, image_name, simulation, capstan_package_folder):
+    def __get_ledger(self, inventory):
+        with self.__ledger_lock:
+            if not self.__ledger.is_reconciled_with(inventory):
+                self.__reconcile_ledger(inventory)
+        return self.__ledger
+
+    def __reconcile_ledger(self, inventory):
+        """
+        Recomputes the resource ledger from the inventory snapshot and the instances being deployed.
+
+        Resources of existing servers and used floating IPs are taken from the inventory. Instances being deployed
+        reserve all of their resources until their server appears in the inventory, and their floating IP until it is
+        associated.
+        """
+        # Check which limits are stricter, and use those
+        total_quotas = openstack_utils.ResourceSet.from_quota_set(inventory.quotas)
+        total_quotas.cores = min(self.max_cpu_usage, total_quotas.cores)
+        total_quotas.instances = min(self.max_instance_usage, total_quotas.instances)
+
+        # build our own quotas and usages, because nova can not do this at the moment
+        available_resources = openstack_utils.get_available_resources(total_quotas,
+                                                                      inventory.servers,
+                                                                      [],
+                                                                      inventory.flavors,
+                                                                      inventory.floating_ips)
+
+        deploying_simulation_instances = Instance.objects.filter(
+            status__in=[Instance.Status.DEPLOYING.name, Instance.Status.UP.name],
+            provider=self.id).select_related('simulation')
+
+        reservations = {}
+        for simulation_instance in deploying_simulation_instances:
+            if simulation_instance.instance_id not in inventory.server_ids:
+                reservations[simulation_instance.id] = self.__get_instance_demand(simulation_instance.simulation,
+                                                                                  inventory.flavors)
+            elif not simulation_instance.ip:
+                reservations[simulation_instance.id] = openstack_utils.ResourceSet(cores=0, instances=0, ram=0,
+                                                                                   floating_ips=1)
+
+        self.__ledger.reconcile(inventory, available_resources, reservations)
+        print "Resource ledger of provider %s reconciled, %d reservations, available: %s" % (
+            self.id, len(reservations), str(available_resources))
+
+    def __get_instance_demand(self, simulation, flavor_dict):
+        simulation_flavor = flavor_dict[simulation.flavor]
+        # Here we actually do not know, how many of these instances will have a floating ip assigned,
+        # so to be safe we assume they will all have one
+        return openstack_utils.ResourceSet(cores=simulation_flavor.vcpus,
+                                           instances=1,
+                                           ram=simulation_flavor.ram,
+                                           floating_ips=1)
+
+    def __import_image_into_glance(self, glance_client, image_name, simulation, mpm_image):
         # Import image into Glance
-        mpm_image = os.path.expanduser(os.path.join("~", ".capstan", "repository",
-                                                    image_name, "%s.qemu" % (os.path.basename(capstan_package_folder))))
         print str(mpm_image)
         print "Image name = %s" % str(image_name)
-        print "Capstan package folder = %s" % str(capstan_package_folder)
 
         unique_image_name = simulation.image + '_' + str(simulation.id)
         print "Uploading image %s to Glance" % unique_image_name
@@ -211,22 +288,29 @@ class OpenstackProvider(Provider):
         glance_client.images.upload(image.id, open(mpm_image, 'rb'))
         return image, unique_image_name
 
-    def __get_floating_ip(self, nova):
-        # Find the first available floating IP
-        for fip in nova.floating_ips.list():
-            if fip.instance_id is None:
-                return fip
-
-        # If there was no available floating IP, create and return new
-        return nova.floating_ips.create('external_network')
-
-    def __authenticate(self):
-        # Authenticate using ENV variables
-        auth = v2.Password(
-            auth_url=env['OS_AUTH_URL'],
-            username=env['OS_USERNAME'],
-            password=env['OS_PASSWORD'],
-            tenant_id=env['OS_TENANT_ID'])
-        # Open auth session
-        sess = session.Session(auth=auth)
-        return sess
+    def __create_server(self, nova_client, launch_dto, of_image, flavor, nics):
+        """
+        Creates the nova server of one instance, runs in the launch pool.
+
+        :return: (server_id, error) tuple, exactly one of the values is None
+        """
+        try:
+            unique_server_name = '%s-%s' % (
+                launch_dto.simulation_instance.name, str(launch_dto.simulation_instance.id))
+
+            print "Creating required instance %s" % unique_server_name
+
+            server = nova_client.servers.create(name=unique_server_name,
+                                                image=of_image,
+                                                flavor=flavor,
+                                                nics=nics
+                                                )
+            launch_dto.unique_server_name = unique_server_name
+            return server.id, None
+        except Exception as e:
+            print traceback.format_exc()
+            return None, e
+
+    def __get_free_floating_ips(self, nova):
+        # Floating IPs which are allocated, but not associated with any instance
+        return [fip for fip in nova.floating_ips.list() if fip.instance_id is None]
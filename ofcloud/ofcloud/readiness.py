@@ -0,0 +1,140 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Readiness probing of launched simulation instances.
+
+Instead of sleeping for worst-case intervals, the launch waits for the actual readiness of every stage, polling with
+an exponential backoff (from READINESS_INITIAL_POLL_INTERVAL_SECONDS up to READINESS_MAX_POLL_INTERVAL_SECONDS) until
+the stage deadline expires.
+"""
+
+import time
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+
+from ofcloud import metrics
+
+DEFAULT_ACTIVE_DEADLINE_SECONDS = 600
+DEFAULT_API_DEADLINE_SECONDS = 300
+DEFAULT_INITIAL_POLL_INTERVAL_SECONDS = 0.25
+DEFAULT_MAX_POLL_INTERVAL_SECONDS = 5
+# (connect, read) timeout in seconds of a single OSv REST API probe
+DEFAULT_API_PROBE_TIMEOUT = (2, 5)
+
+
+@contextmanager
+def timed_stage(timings, stage):
+    """
+    Records the duration of the enclosed block in seconds as timings[stage] and in the stage histogram of the metrics.
+
+    :param timings: dictionary of stage durations, e.g. ProviderLaunchDto.timings
+    :param stage: name of the stage
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = time.time() - start
+        metrics.PREPARE_STAGE_SECONDS.observe(timings[stage], stage=stage)
+
+
+def format_timings(timings):
+    return ", ".join(["%s %.2fs" % (stage, duration) for stage, duration in timings.iteritems()])
+
+
+def wait_until(check, deadline_seconds, description):
+    """
+    Calls check until it returns a truthy value, backing off exponentially between the calls.
+
+    :param check: callable without arguments
+    :param deadline_seconds: maximum time to wait in seconds
+    :param description: description of the awaited condition, used in the error message
+    :return: The truthy value returned by check
+    :raises RuntimeError: when the condition is not met before the deadline
+    """
+    interval = getattr(settings, 'READINESS_INITIAL_POLL_INTERVAL_SECONDS', DEFAULT_INITIAL_POLL_INTERVAL_SECONDS)
+    max_interval = getattr(settings, 'READINESS_MAX_POLL_INTERVAL_SECONDS', DEFAULT_MAX_POLL_INTERVAL_SECONDS)
+    deadline = time.time() + deadline_seconds
+
+    while True:
+        result = check()
+        if result:
+            return result
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError("Timed out after %s seconds waiting for %s" % (deadline_seconds, description))
+
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
+def wait_for_servers_active(nova_client, server_ids):
+    """
+    Waits until all the nova servers are ACTIVE. The servers are awaited as a set, each poll lists the servers once.
+
+    :param nova_client: nova client
+    :param server_ids: ids of the nova servers
+    :return: Dictionary, key - server id, value - (server, error) tuple, exactly one of the tuple values is None. Servers
+    which went to ERROR state or are not ACTIVE before READINESS_ACTIVE_DEADLINE_SECONDS have an error.
+    """
+    results = {}
+    pending = set(server_ids)
+
+    def check():
+        for server in nova_client.servers.list():
+            if server.id not in pending:
+                continue
+            if server.status == 'ACTIVE':
+                results[server.id] = (server, None)
+                pending.discard(server.id)
+            elif server.status == 'ERROR':
+                results[server.id] = (None, RuntimeError("Server %s failed to launch: %s" % (
+                    server.id, getattr(server, 'fault', 'ERROR'))))
+                pending.discard(server.id)
+        return not pending
+
+    try:
+        wait_until(check,
+                   getattr(settings, 'READINESS_ACTIVE_DEADLINE_SECONDS', DEFAULT_ACTIVE_DEADLINE_SECONDS),
+                   "%d servers to become ACTIVE" % len(pending))
+    except RuntimeError as e:
+        for server_id in pending:
+            results[server_id] = (None, e)
+    return results
+
+
+def wait_for_osv_api(instance_api):
+    """
+    Waits until the OSv REST API of an instance answers on /os/uptime, which means the floating IP is routed and the
+    instance has booted.
+
+    :param instance_api: base url of the OSv REST API, see utils.rest_api_for
+    :raises RuntimeError: when the API does not answer before READINESS_API_DEADLINE_SECONDS
+    """
+    timeout = getattr(settings, 'READINESS_API_PROBE_TIMEOUT', DEFAULT_API_PROBE_TIMEOUT)
+
+    def check():
+        try:
+            return requests.get("%s/os/uptime" % instance_api, timeout=timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    wait_until(check,
+               getattr(settings, 'READINESS_API_DEADLINE_SECONDS', DEFAULT_API_DEADLINE_SECONDS),
+               "OSv REST API at %s" % instance_api)
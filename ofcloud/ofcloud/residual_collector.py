@@ -0,0 +1,272 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Residual collector of the scheduler daemon.
+
+With RESIDUAL_COLLECTOR = 'builtin' the scheduler follows run.log of every running instance itself instead of creating
+a Snap task per instance. Every RESIDUAL_COLLECTOR_INTERVAL_SECONDS only the bytes appended to each log since the
+previous pass are read (from the NFS copy of the case, or from the VM if there is none), the residual lines are parsed
+and all the new samples are written to the RESIDUAL_SINKS in one batch.
+"""
+
+import os
+import re
+import threading
+import time
+import traceback
+from collections import namedtuple
+from importlib import import_module
+
+import requests
+from django.conf import settings
+
+from ofcloud.convergence import ConvergenceWatcher
+from ofcloud.models import Instance
+from ofcloud.provider.provider import SIMULATION_INSTANCE_CASE_FOLDER, SIMULATION_INSTANCE_LOG_FILE
+from osv.api import FileTail
+from osv.vm import VM
+
+COLLECTOR_BUILTIN = 'builtin'
+COLLECTOR_SNAP = 'snap'
+
+DEFAULT_COLLECTOR = COLLECTOR_BUILTIN
+DEFAULT_INTERVAL_SECONDS = 10
+DEFAULT_FIELDS = ['Ux', 'Uy', 'Uz', 'p']
+DEFAULT_SINKS = ['ofcloud.residual_collector.InfluxDbSink']
+# (connect, read) timeout in seconds of InfluxDB writes
+DEFAULT_INFLUX_DB_TIMEOUT = (3, 10)
+
+# Statuses of instances running a solver
+COLLECTED_STATUSES = [Instance.Status.RUNNING.name, Instance.Status.RUNNING_MPI.name]
+
+# smoothSolver:  Solving for Ux, Initial residual = 1, Final residual = 0.00437, No Iterations 3
+SOLVING_RE = re.compile(r'Solving for (\w+), Initial residual = ([-+.\deE]+), Final residual = ([-+.\deE]+), '
+                        r'No Iterations (\d+)')
+# Time = 0.005
+TIME_RE = re.compile(r'^Time = ([-+.\deE]+)\s*$')
+
+ResidualSample = namedtuple('ResidualSample', ['instance_id', 'source', 'time', 'field', 'initial', 'final',
+                                               'iterations', 'timestamp'])
+
+
+def get_collector_type():
+    return getattr(settings, 'RESIDUAL_COLLECTOR', DEFAULT_COLLECTOR)
+
+
+class ResidualParser:
+    """
+    Parses residual lines of an OpenFOAM solver log, line by line. The parser keeps the simulation time of the current
+    time step, so it has to be fed all the lines of one log in order.
+    """
+
+    def __init__(self, instance_id, source, fields):
+        self.instance_id = instance_id
+        self.source = source
+        self.fields = set(fields) if fields else None
+        self.time = None
+
+    def parse(self, line, timestamp):
+        """
+        :param line: log line without the line terminator
+        :param timestamp: collection time of the line
+        :return: ResidualSample or None if the line is not a residual of a collected field
+        """
+        # cheap check first, most lines are neither
+        if 'Solving for' in line:
+            match = SOLVING_RE.search(line)
+            if match and (self.fields is None or match.group(1) in self.fields):
+                return ResidualSample(instance_id=self.instance_id,
+                                      source=self.source,
+                                      time=self.time,
+                                      field=match.group(1),
+                                      initial=float(match.group(2)),
+                                      final=float(match.group(3)),
+                                      iterations=int(match.group(4)),
+                                      timestamp=timestamp)
+        elif line.startswith('Time = '):
+            match = TIME_RE.match(line)
+            if match:
+                self.time = float(match.group(1))
+        return None
+
+
+class InfluxDbSink:
+    """
+    Writes samples to InfluxDB (INFLUX_DB_* settings) in line protocol, with the measurement names and the 'source'
+    tag used by the Snap OpenFOAM collector (intel/openfoam/<field>/<initial|final>), so existing dashboards keep
+    working.
+    """
+
+    def __init__(self):
+        self.url = 'http://%s:%s/write' % (settings.INFLUX_DB_HOST, settings.INFLUX_DB_PORT)
+        self.params = {'db': settings.INFLUX_DB_NAME, 'u': settings.INFLUX_DB_USER, 'p': settings.INFLUX_DB_PASS,
+                       'precision': 'ns'}
+        self.timeout = getattr(settings, 'INFLUX_DB_TIMEOUT', DEFAULT_INFLUX_DB_TIMEOUT)
+        self.session = requests.Session()
+
+    def write(self, samples):
+        lines = []
+        for i, sample in enumerate(samples):
+            # distinct timestamps, points with equal measurement, tags and timestamp overwrite each other
+            timestamp = int(sample.timestamp * 1e9) + i
+            for kind, value in (('initial', sample.initial), ('final', sample.final)):
+                lines.append('intel/openfoam/%s/%s,source=%s value=%r %d' % (
+                    sample.field, kind, sample.source, value, timestamp))
+
+        r = self.session.post(self.url, params=self.params, data='\n'.join(lines), timeout=self.timeout)
+        if r.status_code >= 400:
+            raise requests.RequestException("Error writing to InfluxDB, status_code = %s" % r.status_code, r.content)
+
+
+class FileSink:
+    """
+    Appends samples to RESIDUAL_FILE_SINK_PATH, one tab separated line per sample: collection timestamp, instance id,
+    source, simulation time, field, initial residual, final residual, iterations.
+    """
+
+    def __init__(self):
+        self.path = settings.RESIDUAL_FILE_SINK_PATH
+
+    def write(self, samples):
+        with open(self.path, 'a') as f:
+            for sample in samples:
+                f.write('%.3f\t%s\t%s\t%s\t%s\t%r\t%r\t%d\n' % (
+                    sample.timestamp, sample.instance_id, sample.source, sample.time, sample.field, sample.initial,
+                    sample.final, sample.iterations))
+
+
+class ResidualCollector:
+    """
+    Follows the logs of all running instances, see the module documentation.
+    """
+
+    def __init__(self, sinks, fields=None, interval=None, listeners=None):
+        self.sinks = sinks
+        # objects with update(instance, samples) and forget(instance_id) methods, called on every pass
+        self.listeners = listeners or []
+        self.fields = fields if fields is not None else getattr(settings, 'RESIDUAL_FIELDS', DEFAULT_FIELDS)
+        self.interval = interval or getattr(settings, 'RESIDUAL_COLLECTOR_INTERVAL_SECONDS', DEFAULT_INTERVAL_SECONDS)
+        # instance id -> (FileTail, ResidualParser)
+        self.__followed = {}
+
+    def run_forever(self):
+        while True:
+            started = time.time()
+            try:
+                self.collect()
+            except:
+                print traceback.format_exc()
+            time.sleep(max(self.interval - (time.time() - started), 0))
+
+    def collect(self):
+        """
+        Reads the new log lines of all running instances and writes the parsed samples to the sinks.
+
+        :return: List of the new ResidualSample
+        """
+        instances = Instance.objects.filter(status__in=COLLECTED_STATUSES).select_related('simulation')
+
+        running_ids = set()
+        samples = []
+        for instance in instances:
+            running_ids.add(instance.id)
+            try:
+                instance_samples = self.__collect_instance(instance)
+            except:
+                print "Could not collect residuals of instance %s" % instance.id
+                print traceback.format_exc()
+                instance_samples = []
+            samples.extend(instance_samples)
+            self.__notify(instance, instance_samples)
+
+        # stop following the logs of instances which are not running anymore, after reading their last lines
+        for instance_id in set(self.__followed) - running_ids:
+            try:
+                samples.extend(self.__read_samples(instance_id))
+            except:
+                print "Could not collect last residuals of instance %s" % instance_id
+                print traceback.format_exc()
+            del self.__followed[instance_id]
+            for listener in self.listeners:
+                listener.forget(instance_id)
+
+        if samples:
+            self.__write(samples)
+        return samples
+
+    def __collect_instance(self, instance):
+        if instance.id not in self.__followed:
+            self.__followed[instance.id] = (self.__get_tail(instance),
+                                            ResidualParser(instance.id, instance.ip, self.fields))
+        return self.__read_samples(instance.id)
+
+    def __read_samples(self, instance_id):
+        tail, parser = self.__followed[instance_id]
+
+        now = time.time()
+        samples = []
+        for line in tail.lines():
+            sample = parser.parse(line, now)
+            if sample:
+                samples.append(sample)
+        return samples
+
+    @staticmethod
+    def __get_tail(instance):
+        log_path = os.path.join(SIMULATION_INSTANCE_CASE_FOLDER, SIMULATION_INSTANCE_LOG_FILE)
+        if instance.local_case_location and os.path.isdir(instance.local_case_location):
+            # the case folder of the VM is mounted from NFS
+            return FileTail(None, log_path, local_path=os.path.join(instance.local_case_location,
+                                                                    SIMULATION_INSTANCE_LOG_FILE))
+
+        return VM.connect_to_existing(instance.ip).file_api().tail(log_path)
+
+    def __notify(self, instance, samples):
+        for listener in self.listeners:
+            try:
+                listener.update(instance, samples)
+            except:
+                print "Residual listener %s failed for instance %s" % (listener.__class__.__name__, instance.id)
+                print traceback.format_exc()
+
+    def __write(self, samples):
+        for sink in self.sinks:
+            try:
+                sink.write(samples)
+            except:
+                print "Residual sink %s failed" % sink.__class__.__name__
+                print traceback.format_exc()
+
+
+def create_sinks():
+    sinks = []
+    for sink_type in getattr(settings, 'RESIDUAL_SINKS', DEFAULT_SINKS):
+        package, name = sink_type.rsplit('.', 1)
+        sinks.append(getattr(import_module(package), name)())
+    return sinks
+
+
+def start_collector():
+    """
+    Starts the built-in residual collector in a background thread of the scheduler daemon.
+
+    :return: The ResidualCollector
+    """
+    collector = ResidualCollector(create_sinks(), listeners=[ConvergenceWatcher()])
+    thread = threading.Thread(target=collector.run_forever, name='residual-collector')
+    thread.daemon = True
+    thread.start()
+    return collector
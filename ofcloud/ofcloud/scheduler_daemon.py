@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import Queue
 import os
 import signal
 import threading
@@ -25,7 +26,17 @@ import daemon.pidfile
 from django.conf import settings
 
 import utils
+from ofcloud import metrics
+from ofcloud import pipeline
+from ofcloud import residual_collector
+from ofcloud import scheduler_events
 from ofcloud.models import Instance
+from ofcloud.pipeline import PipelineManager
+from ofcloud.prepare_pool import PreparePool
+
+DEFAULT_PREPARE_POOL_SIZE = 4
+DEFAULT_LAUNCH_BATCH_SIZE = 10
+DEFAULT_THREAD_WATCH_INTERVAL = 5
 
 
 def do_work(sleep_interval):
@@ -41,41 +52,126 @@ def do_work(sleep_interval):
         provider = getattr(mod, module)
         simulation_providers.append(provider(provider_config.get('NAME'), provider_config))
 
-    threads = {
-        'shutdown': None,
-        'reconstruct': None,
-        'run': None,
-        'prepare': None
+    pipeline_manager = PipelineManager() if pipeline.is_pipeline_mode() else None
+
+    prepare_pool = PreparePool(getattr(settings, 'SCHEDULER_PREPARE_POOL_SIZE', DEFAULT_PREPARE_POOL_SIZE),
+                               simulation_providers,
+                               getattr(settings, 'SCHEDULER_LAUNCH_BATCH_SIZE', DEFAULT_LAUNCH_BATCH_SIZE),
+                               pipeline_manager)
+
+    phases = {
+        scheduler_events.PHASE_SHUTDOWN: (__poll_for_shutdown, (simulation_providers, pipeline_manager, prepare_pool)),
+        scheduler_events.PHASE_RECONSTRUCT: (__poll_for_reconstruction, (simulation_providers, pipeline_manager)),
+        scheduler_events.PHASE_RUN: (__poll_for_run, (simulation_providers, pipeline_manager)),
+        scheduler_events.PHASE_PREPARE: (__poll_for_prepare, (prepare_pool,)),
+        scheduler_events.PHASE_WATCH: (__watch_openfoam_threads, (pipeline_manager,)),
     }
+    threads = {phase: None for phase in phases}
+
+    watch_interval = getattr(settings, 'SCHEDULER_THREAD_WATCH_INTERVAL_SECONDS', DEFAULT_THREAD_WATCH_INTERVAL)
+
+    event_queue = scheduler_events.start_listener()
+
+    metrics.PREPARE_IN_FLIGHT.callback = lambda: {(): prepare_pool.in_flight_count()}
+    metrics.start_server()
+
+    if residual_collector.get_collector_type() == residual_collector.COLLECTOR_BUILTIN:
+        residual_collector.start_collector()
+
+    # All phases run on start and then every sleep_interval seconds as a fallback reconciliation, in between they
+    # only run when an event for them arrives.
+    pending_phases = set(phases)
+    next_reconciliation = time.time() + sleep_interval
+    next_watch = time.time() + watch_interval
 
     while True:
-        if not threads['shutdown'] or not threads['shutdown'].isAlive():
-            threads['shutdown'] = threading.Thread(target=__poll_for_shutdown, args=(simulation_providers,))
-            threads['shutdown'].start()
+        for phase in list(pending_phases):
+            if not threads[phase] or not threads[phase].isAlive():
+                target, args = phases[phase]
+                threads[phase] = threading.Thread(target=__run_phase, args=(phase, target, args))
+                threads[phase].start()
+                pending_phases.discard(phase)
+            # else the phase is already running, it will be started again as soon as it finishes
+
+        now = time.time()
+        timeout = max(min(next_reconciliation, next_watch) - now, 0)
+        try:
+            pending_phases.add(event_queue.get(timeout=timeout))
+            # coalesce all the events which are already waiting
+            while True:
+                pending_phases.add(event_queue.get_nowait())
+        except Queue.Empty:
+            pass
+        pending_phases.discard(scheduler_events.WAKE_UP)
+
+        now = time.time()
+        if now >= next_reconciliation:
+            pending_phases.update(phases)
+            next_reconciliation = now + sleep_interval
+        if now >= next_watch:
+            pending_phases.add(scheduler_events.PHASE_WATCH)
+            next_watch = now + watch_interval
+
+
+def __run_phase(phase, target, args):
+    try:
+        with metrics.PHASE_SECONDS.time(phase=phase):
+            target(*args)
+    except:
+        metrics.PHASE_ERRORS.inc(phase=phase)
+        print traceback.format_exc()
+    finally:
+        # let the scheduler loop restart the phase if more events arrived in the meantime
+        scheduler_events.notify(scheduler_events.WAKE_UP)
+
+
+def __watch_openfoam_threads(pipeline_manager):
+    """
+    Checks the openFOAM threads of all instances currently executing an openFOAM command and publishes events for the
+    phases which have to act on instances with a terminated thread. Instances with a pipeline are watched by their
+    pipeline.
+
+    :return:
+    """
+    instances = list(Instance.objects.filter(status__in=scheduler_events.THREAD_FINISHED_PHASES.keys()))
+    if pipeline_manager and [instance for instance in instances if pipeline_manager.can_start(instance.id)]:
+        # let the run phase start pipelines for these instances
+        scheduler_events.notify(scheduler_events.PHASE_RUN)
 
-        if not threads['reconstruct'] or not threads['reconstruct'].isAlive():
-            threads['reconstruct'] = threading.Thread(target=__poll_for_reconstruction, args=(simulation_providers,))
-            threads['reconstruct'].start()
+    watched_instances = __exclude_managed(instances, pipeline_manager)
+    if not watched_instances:
+        return
 
-        if not threads['run'] or not threads['run'].isAlive():
-            threads['run'] = threading.Thread(target=__poll_for_run, args=(simulation_providers,))
-            threads['run'].start()
+    finished_instances = utils.get_instances_with_finished_openfoam_thread(watched_instances)
+    for phase in set([scheduler_events.THREAD_FINISHED_PHASES[instance.status] for instance in finished_instances]):
+        scheduler_events.notify(phase)
 
-        if not threads['prepare'] or not threads['prepare'].isAlive():
-            threads['prepare'] = threading.Thread(target=__poll_for_prepare, args=(simulation_providers,))
-            threads['prepare'].start()
 
-        time.sleep(sleep_interval)
+def __exclude_managed(instances, pipeline_manager):
+    if not pipeline_manager:
+        return list(instances)
+    # Only instances whose pipeline ended are left to the phases. Instances without a pipeline yet might be getting
+    # one from the preparation pool right now, they are adopted by the run phase otherwise.
+    return [instance for instance in instances if pipeline_manager.is_ended(instance.id)]
 
 
-def __poll_for_shutdown(simulation_providers):
+def __forget_finished(instances, pipeline_manager):
+    if pipeline_manager:
+        pipeline_manager.forget([instance.id for instance in instances])
+
+
+def __poll_for_shutdown(simulation_providers, pipeline_manager, prepare_pool):
     """
     Polls instances ready for shutdown. 
     
     Instances qualify for shutdown if they are either in Instance.Status.RUNNING or Instance.Status.RECONSTRUCTING
     state and the openFOAM thread is terminated. Orphaned instances are sent to Instance.Status.COMPLETE state.
+    With VM_RECYCLING_ENABLED, VMs of finished instances are handed over to pending instances of the same simulation
+    instead of being shut down, the instances taking over the VMs are prepared by the preparation pool.
     
     :param simulation_providers: 
+    :param pipeline_manager: PipelineManager or None if the pipeline mode is disabled
+    :param prepare_pool: PreparePool preparing the instances taking over recycled VMs
     :return: 
     """
 
@@ -84,16 +180,21 @@ def __poll_for_shutdown(simulation_providers):
         provider_id = provider.get_provider_id()
         print "Using provider %s" % provider_id
 
-        running_instances, orphans_1 = provider.split_running_and_orphaned_instances(
-            Instance.objects.filter(status=Instance.Status.RUNNING.name, provider=provider_id))
+        # Both splits use the same inventory snapshot of the provider
+        running_instances, orphans_1 = provider.split_running_and_orphaned_instances(__exclude_managed(
+            Instance.objects.filter(status=Instance.Status.RUNNING.name, provider=provider_id), pipeline_manager))
 
-        reconstructing_instances, orphans_2 = provider.split_running_and_orphaned_instances(
-            Instance.objects.filter(status=Instance.Status.RECONSTRUCTING.name, provider=provider_id))
+        reconstructing_instances, orphans_2 = provider.split_running_and_orphaned_instances(__exclude_managed(
+            Instance.objects.filter(status=Instance.Status.RECONSTRUCTING.name, provider=provider_id),
+            pipeline_manager))
 
         orphaned_instances = orphans_1 + orphans_2
 
         # Mark any orphaned instance objects as complete
+        utils.stop_snap_collectors(orphaned_instances)
+        utils.close_api_sessions(orphaned_instances)
         utils.update_instance_status(orphaned_instances, Instance.Status.COMPLETE.name)
+        __forget_finished(orphaned_instances, pipeline_manager)
 
         finished_instances = utils.get_instances_with_finished_openfoam_thread(
             running_instances + reconstructing_instances)
@@ -102,11 +203,19 @@ def __poll_for_shutdown(simulation_providers):
             print "Running/Finished/Orphaned: %d/%d/%d" % (
                 len(running_instances), len(finished_instances), len(orphaned_instances))
 
-        provider.shutdown_instances(finished_instances)
+        # VMs handed over to pending instances keep running. Recycle before completing the finished instances, so the
+        # preparation phase does not launch new VMs for the pending instances in the meantime.
+        recycled_instances = utils.recycle_instance_vms(finished_instances, provider, prepare_pool)
+        shutdown_instances = [instance for instance in finished_instances if instance not in recycled_instances]
+        utils.stop_snap_collectors(shutdown_instances)
+        with metrics.provider_call(provider, 'shutdown_instances'):
+            provider.shutdown_instances(shutdown_instances)
+        utils.close_api_sessions(shutdown_instances)
         utils.update_instance_status(finished_instances, Instance.Status.COMPLETE.name)
+        __forget_finished(finished_instances, pipeline_manager)
 
 
-def __poll_for_reconstruction(simulation_providers):
+def __poll_for_reconstruction(simulation_providers, pipeline_manager):
     """
     Polls instances ready for reconstruction and runs reconstructPar command on them.
     
@@ -121,61 +230,75 @@ def __poll_for_reconstruction(simulation_providers):
         provider_id = provider.get_provider_id()
         print "Using provider %s" % provider_id
 
-        running_mpi_instances, orphaned_instances = provider.split_running_and_orphaned_instances(
-            Instance.objects.filter(status=Instance.Status.RUNNING_MPI.name, provider=provider_id))
+        running_mpi_instances, orphaned_instances = provider.split_running_and_orphaned_instances(__exclude_managed(
+            Instance.objects.filter(status=Instance.Status.RUNNING_MPI.name, provider=provider_id), pipeline_manager))
 
+        utils.close_api_sessions(orphaned_instances)
         utils.update_instance_status(orphaned_instances, Instance.Status.COMPLETE.name)
+        __forget_finished(orphaned_instances, pipeline_manager)
 
         ready_for_reconstruction = utils.get_instances_with_finished_openfoam_thread(running_mpi_instances)
 
         for instance in ready_for_reconstruction:
-            provider.run_reconstruction(instance)
+            with metrics.provider_call(provider, 'run_reconstruction'):
+                provider.run_reconstruction(instance)
 
 
-def __poll_for_prepare(simulation_providers):
+def __poll_for_prepare(prepare_pool):
     """
     Polls instances ready for preparation of openFOAM.
     
-    Instances qualify for preparation if they are in Instance.Status.PENDING state.
+    Instances qualify for preparation if they are in Instance.Status.PENDING state. Qualified instances are claimed
+    and handed over to the preparation pool, which prepares up to SCHEDULER_PREPARE_POOL_SIZE batches of at most
+    SCHEDULER_LAUNCH_BATCH_SIZE instances of the same simulation at once.
     
-    :param simulation_providers: 
+    :param prepare_pool: PreparePool used for preparing the instances
     :return: 
     """
     print "Polling instances for preparation"
 
-    pending_instances = Instance.objects.filter(status=Instance.Status.PENDING.name)
+    pending_instances = Instance.objects.filter(status=Instance.Status.PENDING.name).select_related('simulation')
     print('Found %d instances in PENDING state.' % len(pending_instances))
 
-    for instance in pending_instances:
-        utils.prepare_simulation_instance(instance, simulation_providers)
+    submitted = prepare_pool.dispatch(pending_instances)
+    print('Submitted %d instances for preparation, %d being prepared.' % (submitted, prepare_pool.in_flight_count()))
 
 
-def __poll_for_run(simulation_providers):
+def __poll_for_run(simulation_providers, pipeline_manager):
     """
     Polls instances ready to run openFOAM simulations. 
     
     Instances qualify for running if they are in Instance.Status.READY state or in Instance.Status.DECOMPOSING state
-    with openFOAM thread terminated.
+    with openFOAM thread terminated. In OPENFOAM_PIPELINE_MODE, pipelines are started first for the instances in
+    pipeline.PIPELINE_STATUSES which did not have one yet, e.g. after a restart of the scheduler or recycled VMs.
     
     :param simulation_providers: 
+    :param pipeline_manager: PipelineManager or None if the pipeline mode is disabled
     :return: 
     """
-
-    decomposing_instances = Instance.objects.filter(status=Instance.Status.DECOMPOSING.name)
+    if pipeline_manager:
+        for instance in Instance.objects.filter(status__in=pipeline.PIPELINE_STATUSES).select_related('simulation'):
+            instance_provider = [provider for provider in simulation_providers if provider.id == instance.provider]
+            if instance_provider and pipeline_manager.can_start(instance.id):
+                pipeline_manager.start(instance, instance_provider[0])
+
+    decomposing_instances = __exclude_managed(Instance.objects.filter(status=Instance.Status.DECOMPOSING.name),
+                                              pipeline_manager)
     finished_decomposing_instances = utils.get_instances_with_finished_openfoam_thread(decomposing_instances)
 
     utils.update_instance_status(finished_decomposing_instances, Instance.Status.READY.name)
 
     print "Polling instances for run simulation"
 
-    ready_instances = Instance.objects.filter(status=Instance.Status.READY.name)
+    ready_instances = __exclude_managed(Instance.objects.filter(status=Instance.Status.READY.name), pipeline_manager)
 
     print('Found %d instances in READY state.' % len(ready_instances))
 
     for ready_instance in ready_instances:
         instance_provider = [provider for provider in simulation_providers if
                              provider.id == ready_instance.provider]
-        instance_provider[0].run_simulation(ready_instance)
+        with metrics.provider_call(instance_provider[0], 'run_simulation'):
+            instance_provider[0].run_simulation(ready_instance)
 
 
 def __kill_and_wait(pid):
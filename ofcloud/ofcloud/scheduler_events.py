@@ -0,0 +1,144 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Work queue of the scheduler daemon.
+
+Every scheduler phase (shutdown, reconstruct, run, prepare) is triggered by an event as soon as there is work for it,
+instead of waiting for the next refresh interval. Events are published with notify(). Inside the scheduler daemon
+process they are put directly on the work queue, other processes (the REST API) send them to the daemon as UDP
+datagrams on SCHEDULER_EVENT_ADDRESS.
+"""
+
+import Queue
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+
+from ofcloud.models import Instance
+
+PHASE_SHUTDOWN = 'shutdown'
+PHASE_RECONSTRUCT = 'reconstruct'
+PHASE_RUN = 'run'
+PHASE_PREPARE = 'prepare'
+PHASE_WATCH = 'watch'
+
+PHASES = (PHASE_SHUTDOWN, PHASE_RECONSTRUCT, PHASE_RUN, PHASE_PREPARE, PHASE_WATCH)
+
+# Event without a phase, only wakes up the scheduler loop
+WAKE_UP = 'wake'
+
+DEFAULT_EVENT_ADDRESS = ('127.0.0.1', 8009)
+
+# The phase that has to act on an instance which has just entered the given status. Completed and failed instances
+# free resources, so pending instances might become runnable.
+STATUS_PHASES = {
+    Instance.Status.PENDING.name: PHASE_PREPARE,
+    Instance.Status.READY.name: PHASE_RUN,
+    Instance.Status.DECOMPOSING.name: PHASE_WATCH,
+    Instance.Status.RUNNING.name: PHASE_WATCH,
+    Instance.Status.RUNNING_MPI.name: PHASE_WATCH,
+    Instance.Status.RECONSTRUCTING.name: PHASE_WATCH,
+    Instance.Status.COMPLETE.name: PHASE_PREPARE,
+    Instance.Status.FAILED.name: PHASE_PREPARE,
+}
+
+# The phase that has to act on an instance in the given status once its openFOAM thread has terminated
+THREAD_FINISHED_PHASES = {
+    Instance.Status.DECOMPOSING.name: PHASE_RUN,
+    Instance.Status.RUNNING.name: PHASE_SHUTDOWN,
+    Instance.Status.RUNNING_MPI.name: PHASE_RECONSTRUCT,
+    Instance.Status.RECONSTRUCTING.name: PHASE_SHUTDOWN,
+}
+
+__event_queue = None
+
+
+def get_event_address():
+    return getattr(settings, 'SCHEDULER_EVENT_ADDRESS', DEFAULT_EVENT_ADDRESS)
+
+
+def start_listener():
+    """
+    Creates the work queue of this process and starts listening for events sent from other processes. Should only be
+    called by the scheduler daemon.
+
+    :return: The work queue
+    """
+    global __event_queue
+    __event_queue = Queue.Queue()
+
+    listener = threading.Thread(target=__listen, args=(__event_queue, get_event_address()))
+    listener.daemon = True
+    listener.start()
+
+    return __event_queue
+
+
+def notify(phase):
+    """
+    Publishes an event for the given scheduler phase.
+
+    :param phase: One of PHASES or WAKE_UP
+    :return:
+    """
+    if __event_queue is not None:
+        __event_queue.put(phase)
+        return
+
+    # Not running inside the scheduler daemon, forward the event. Events are only hints, the daemon will still pick up
+    # the work on its next refresh, so any error is ignored.
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(phase, get_event_address())
+        finally:
+            sock.close()
+    except socket.error:
+        pass
+
+
+def notify_instance_status(status):
+    """
+    Publishes an event for the phase acting on instances in the given status.
+
+    :param status: Instance.Status value. Should be string value, not Enum. Example: Instance.Status.PENDING.name
+    :return:
+    """
+    phase = STATUS_PHASES.get(status)
+    if phase:
+        notify(phase)
+
+
+def __listen(event_queue, address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(address)
+    except socket.error:
+        print "Could not listen for scheduler events on %s:%d, relying on periodic refresh only" % address
+        print traceback.format_exc()
+        return
+
+    print "Listening for scheduler events on %s:%d" % address
+    while True:
+        try:
+            data, _ = sock.recvfrom(64)
+            if data in PHASES:
+                event_queue.put(data)
+        except socket.error:
+            print traceback.format_exc()
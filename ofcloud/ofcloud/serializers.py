@@ -17,6 +17,8 @@ from django.conf import settings
 from rest_framework import serializers
 
 from ofcloud import models
+from ofcloud import residual_collector
+from ofcloud.convergence import ConvergencePolicy
 
 
 class InstanceSerializer(serializers.ModelSerializer):
@@ -38,6 +40,7 @@ class InstanceSerializer(serializers.ModelSerializer):
             'local_case_location',
             'nfs_case_location',
             'retry_attempts',
+            'stop_reason',
             'grafana_url',
             'download_case_url'
         )
@@ -69,5 +72,17 @@ class SimulationSerializer(serializers.ModelSerializer):
             'cases',
             'status',
             'instances',
-            'decomposition'
+            'decomposition',
+            'convergence'
         )
+
+    def validate_convergence(self, value):
+        try:
+            policy = ConvergencePolicy.parse(value)
+        except (ValueError, TypeError) as e:
+            raise serializers.ValidationError("Invalid convergence policy: %s" % e)
+        if policy is not None and residual_collector.get_collector_type() != residual_collector.COLLECTOR_BUILTIN:
+            # only the built-in collector feeds the residuals to the convergence watcher
+            raise serializers.ValidationError("Convergence policies need RESIDUAL_COLLECTOR = '%s'" %
+                                              residual_collector.COLLECTOR_BUILTIN)
+        return value
@@ -0,0 +1,40 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+
+from ofcloud import scheduler_events
+from ofcloud import transitions
+from ofcloud.models import Instance
+
+
+@receiver(post_init, sender=Instance)
+def instance_loaded(sender, instance, **kwargs):
+    # status might be deferred, do not load it
+    transitions.set_recorded_status(instance, instance.__dict__.get('status'))
+
+
+@receiver(post_save, sender=Instance)
+def instance_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    if created:
+        transitions.record_transition(instance, None, instance.status)
+    elif update_fields is None or 'status' in update_fields:
+        recorded_status = transitions.get_recorded_status(instance)
+        if recorded_status is not None and recorded_status != instance.status:
+            transitions.record_transition(instance, recorded_status, instance.status)
+
+    # Let the scheduler act on the new instance status immediately
+    scheduler_events.notify_instance_status(instance.status)
@@ -0,0 +1,248 @@
+# Copyright (C) 2015-2017 XLAB, Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Status transition history of instances and the phase breakdowns computed from it.
+
+Every status change of an instance is appended to InstanceTransition, both when an Instance is saved (see signals.py)
+and when statuses are updated in bulk (utils.update_instance_status, instance claims). The time an instance spent in
+each status is summed into phases:
+
+    queue_wait  - PENDING
+    deploy      - DEPLOYING, UP, READY
+    decompose   - DECOMPOSING
+    solve       - RUNNING, RUNNING_MPI
+    reconstruct - RECONSTRUCTING
+
+The phase of a simulation is the longest phase of its instances, as the instances run side by side.
+"""
+
+import math
+import traceback
+from collections import OrderedDict, namedtuple
+
+from django.db.models import Max
+from django.utils import timezone
+
+from ofcloud.models import Instance, InstanceTransition
+
+PHASES = OrderedDict([
+    ('queue_wait', [Instance.Status.PENDING.name]),
+    ('deploy', [Instance.Status.DEPLOYING.name, Instance.Status.UP.name, Instance.Status.READY.name]),
+    ('decompose', [Instance.Status.DECOMPOSING.name]),
+    ('solve', [Instance.Status.RUNNING.name, Instance.Status.RUNNING_MPI.name]),
+    ('reconstruct', [Instance.Status.RECONSTRUCTING.name]),
+])
+
+FINAL_STATUSES = [Instance.Status.COMPLETE.name, Instance.Status.FAILED.name]
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+# transition fields loaded by phase_percentiles, which does not need the instances
+TransitionRow = namedtuple('TransitionRow', ['simulation_id', 'instance_id', 'from_status', 'to_status', 'timestamp',
+                                             'duration'])
+
+# attribute of Instance objects holding the status last loaded from or written to the database
+RECORDED_STATUS_ATTRIBUTE = '_recorded_status'
+
+
+def get_recorded_status(instance):
+    return getattr(instance, RECORDED_STATUS_ATTRIBUTE, None)
+
+
+def set_recorded_status(instance, status):
+    setattr(instance, RECORDED_STATUS_ATTRIBUTE, status)
+
+
+def __seconds_between(start, end):
+    if start is None:
+        return None
+    return (end - start).total_seconds()
+
+
+def record_transition(instance, from_status, to_status):
+    """
+    Appends one status change of the instance to the transition history. Failures are only logged, the history must
+    not get in the way of the scheduler.
+
+    :param instance: Instance, already in to_status in the database
+    :param from_status: Previous status, None for new instances
+    :param to_status: New status
+    """
+    try:
+        now = timezone.now()
+        previous = InstanceTransition.objects.filter(instance_id=instance.id).aggregate(Max('timestamp'))
+        InstanceTransition.objects.create(instance_id=instance.id,
+                                          from_status=from_status or '',
+                                          to_status=to_status,
+                                          timestamp=now,
+                                          provider=instance.provider or '',
+                                          duration=__seconds_between(previous['timestamp__max'], now))
+        set_recorded_status(instance, to_status)
+    except:
+        print "Could not record transition of instance %s to %s" % (instance.id, to_status)
+        print traceback.format_exc()
+
+
+def record_transitions(instances, to_status):
+    """
+    Bulk version of record_transition, used after updating the status of many instances with one query. Instances
+    already in to_status are skipped.
+
+    :param instances: List of instances, already in to_status in the database
+    :param to_status: New status
+    """
+    changed = [instance for instance in instances
+               if (get_recorded_status(instance) or instance.status) != to_status]
+    if not changed:
+        return
+
+    try:
+        now = timezone.now()
+        previous = dict(InstanceTransition.objects
+                        .filter(instance_id__in=[instance.id for instance in changed])
+                        .order_by()
+                        .values_list('instance_id')
+                        .annotate(Max('timestamp')))
+        InstanceTransition.objects.bulk_create([
+            InstanceTransition(instance_id=instance.id,
+                               from_status=get_recorded_status(instance) or instance.status,
+                               to_status=to_status,
+                               timestamp=now,
+                               provider=instance.provider or '',
+                               duration=__seconds_between(previous.get(instance.id), now))
+            for instance in changed])
+        for instance in changed:
+            set_recorded_status(instance, to_status)
+    except:
+        print "Could not record transitions of %d instances to %s" % (len(changed), to_status)
+        print traceback.format_exc()
+
+
+def instance_phases(transitions, now):
+    """
+    Sums the time spent in each phase.
+
+    :param transitions: Transitions of one instance, ordered by timestamp
+    :param now: Current time, the time spent in the current status of an unfinished instance is counted up to now
+    :return: OrderedDict phase name -> seconds
+    """
+    phases = OrderedDict((phase, 0.0) for phase in PHASES)
+    status_phase = dict((status, phase) for phase, statuses in PHASES.iteritems() for status in statuses)
+
+    for transition in transitions:
+        if transition.from_status in status_phase and transition.duration is not None:
+            phases[status_phase[transition.from_status]] += transition.duration
+
+    if transitions and transitions[-1].to_status in status_phase:
+        phases[status_phase[transitions[-1].to_status]] += __seconds_between(transitions[-1].timestamp, now)
+    return phases
+
+
+def __group_by_instance(transitions):
+    grouped = OrderedDict()
+    for transition in transitions:
+        grouped.setdefault(transition.instance_id, []).append(transition)
+    return grouped
+
+
+def __simulation_summary(instance_transitions, now):
+    """
+    :param instance_transitions: dictionary instance id -> transitions of the instance, ordered by timestamp
+    :return: (phases, turnaround) tuple, turnaround is None if the simulation has no transitions
+    """
+    phases = OrderedDict((phase, 0.0) for phase in PHASES)
+    started = finished = None
+    for instance_id, transitions in instance_transitions.iteritems():
+        for phase, seconds in instance_phases(transitions, now).iteritems():
+            phases[phase] = max(phases[phase], seconds)
+
+        first, last = transitions[0].timestamp, transitions[-1]
+        started = first if started is None else min(started, first)
+        end = last.timestamp if last.to_status in FINAL_STATUSES else now
+        finished = end if finished is None else max(finished, end)
+
+    return phases, __seconds_between(started, finished)
+
+
+def simulation_phase_breakdown(simulation):
+    """
+    :param simulation: Simulation
+    :return: dictionary with the phases and the turnaround time of the simulation and the phases of every instance
+    """
+    now = timezone.now()
+    instances = list(simulation.instance_set.all())
+    transitions = __group_by_instance(
+        InstanceTransition.objects.filter(instance__simulation=simulation).order_by('instance', 'timestamp'))
+
+    phases, turnaround = __simulation_summary(transitions, now)
+    return OrderedDict([
+        ('simulation', simulation.id),
+        ('status', simulation.status),
+        ('turnaround', turnaround),
+        ('phases', phases),
+        ('instances', [OrderedDict([('id', instance.id),
+                                    ('name', instance.name),
+                                    ('status', instance.status),
+                                    ('provider', instance.provider),
+                                    ('transitions', len(transitions.get(instance.id, []))),
+                                    ('phases', instance_phases(transitions.get(instance.id, []), now))])
+                       for instance in instances]),
+    ])
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile.
+
+    :param sorted_values: non-empty list of sorted values
+    :param p: percentile, 0 < p <= 100
+    """
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def phase_percentiles(simulations, percentiles=DEFAULT_PERCENTILES):
+    """
+    Computes percentiles of the simulation phases and turnaround times across simulations. Simulations without
+    transitions are left out.
+
+    :param simulations: QuerySet of simulations
+    :param percentiles: percentiles to compute, e.g. (50, 90)
+    :return: dictionary with the number of simulations and the percentiles of every phase and of the turnaround time
+    """
+    now = timezone.now()
+    by_simulation = OrderedDict()
+    for row in (InstanceTransition.objects
+                .filter(instance__simulation__in=simulations)
+                .order_by('instance__simulation', 'instance', 'timestamp')
+                .values_list('instance__simulation', 'instance_id', 'from_status', 'to_status', 'timestamp',
+                             'duration')):
+        transition = TransitionRow(*row)
+        by_simulation.setdefault(transition.simulation_id, []).append(transition)
+
+    values = OrderedDict((name, []) for name in list(PHASES) + ['turnaround'])
+    for simulation_id, transitions in by_simulation.iteritems():
+        phases, turnaround = __simulation_summary(__group_by_instance(transitions), now)
+        for phase, seconds in phases.iteritems():
+            values[phase].append(seconds)
+        values['turnaround'].append(turnaround)
+
+    result = OrderedDict([('simulations', len(by_simulation))])
+    for name, name_values in values.iteritems():
+        name_values.sort()
+        result[name] = OrderedDict(('p%g' % p, percentile(name_values, p) if name_values else None)
+                                   for p in percentiles)
+    return result
@@ -33,7 +33,7 @@ from django.contrib import admin
 from rest_framework import routers
 
 from ofcloud.api import SimulationViewSet, InstanceViewSet
-from ofcloud.views import download_instance_case, download_instance_log
+from ofcloud.views import download_instance_case, download_instance_log, metrics_view
 
 router = routers.DefaultRouter()
 router.register(r'simulations', SimulationViewSet)
@@ -44,6 +44,7 @@ urlpatterns = [
 
     url(r'^instances/(?P<instance_id>[0-9]+)/download/$', download_instance_case, name='download'),
     url(r'^instances/(?P<instance_id>[0-9]+)/log/$', download_instance_log, name='instance-log'),
+    url(r'^metrics/$', metrics_view, name='metrics'),
 
     url(r'^admin/', admin.site.urls),
 ]
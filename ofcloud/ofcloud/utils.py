@@ -15,19 +15,33 @@
 
 import json
 import logging
-import tempfile
+import threading
 import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import requests
 from django.conf import settings
 
-from ofcloud import capstan_utils, case_utils, openstack_utils
+from ofcloud import capstan_utils, case_utils, metrics, openstack_utils, readiness, scheduler_events, transitions
 from ofcloud.models import Instance, Simulation
 from ofcloud.provider.dto import ProviderLaunchDto
+from osv import api as osv_api
 from snap import api as snap_api
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_THREAD_PROBE_WORKERS = 32
+# (connect, read) timeout in seconds
+DEFAULT_THREAD_PROBE_TIMEOUT = (3, 10)
+DEFAULT_VM_RECYCLING_ENABLED = False
+
+OSV_UMOUNT_COMMAND = "/tools/umount.so %s"
+
+__probe_lock = threading.Lock()
+__probe_pool = None
+__probe_session = None
+
 
 def rest_api_for(ip):
     return "http://%s:8000" % ip
@@ -61,74 +75,195 @@ def __create_simulation_instances(simulation):
     return instances
 
 
-def prepare_simulation_instance(simulation_instance, simulation_providers):
-    is_runnable = False
+def claim_simulation_instance(simulation_instance, simulation_providers):
+    """
+    Finds the first provider with enough free resources for the simulation instance and claims the instance for it.
+
+    The instance is claimed by moving it from Instance.Status.PENDING to Instance.Status.DEPLOYING state with a
+    conditional update, so an instance can never be claimed twice.
+
+    :param simulation_instance: Instance in Instance.Status.PENDING state
+    :param simulation_providers: List of providers to try, in order of preference
+    :return: Provider the instance was claimed for, None if no provider can run the instance at the moment
+    """
     for provider in simulation_providers:
-        if provider.is_simulation_instance_runnable(simulation_instance):
-            is_runnable = True
+        if provider.reserve_resources(simulation_instance):
+            claimed = Instance.objects.filter(id=simulation_instance.id, status=Instance.Status.PENDING.name).update(
+                status=Instance.Status.DEPLOYING.name,
+                provider=provider.get_provider_id())
 
-            simulation = Simulation.objects.get(id=simulation_instance.simulation_id)
-            simulation.status = Simulation.Status.DEPLOYING.name
-            simulation.save()
+            if not claimed:
+                print "Instance %s is no longer pending, skipping" % simulation_instance.id
+                provider.release_resources(simulation_instance)
+                return None
 
             simulation_instance.provider = provider.get_provider_id()
             simulation_instance.status = Instance.Status.DEPLOYING.name
-            simulation_instance.save()
+            transitions.record_transition(simulation_instance, Instance.Status.PENDING.name,
+                                          Instance.Status.DEPLOYING.name)
+            return provider
+        else:
+            print "No more free quotas!"
+
+    print("Maximum number of simulation instances already running! "
+          "Pending instances will be run after currently running instances finish")
+    return None
 
-            try:
-                print "Launching instance %s with provider %s" % (simulation_instance.id, provider.get_provider_id())
 
-                simulation_instance.parallelisation = provider.get_instance_cpus(simulation_instance.simulation)
-                simulation_instance.save()
+def prepare_simulation_instance(simulation_instance, provider):
+    """
+    Prepares case files and OSv image of a claimed simulation instance and launches it with the provider.
+
+    :param simulation_instance: Instance claimed with claim_simulation_instance
+    :param provider: Provider the instance was claimed for
+    :return: The prepared instance or None if the preparation failed
+    """
+    prepared_instances = prepare_simulation_instances([simulation_instance], provider)
+    return prepared_instances[0] if prepared_instances else None
 
-                # START preparing local files (OSv image, case files ...)
-                case_folder = case_utils.prepare_case_files(simulation, simulation_instance.parallelisation)
 
-                case_utils.copy_case_files_to_nfs_location(
+def prepare_simulation_instances(simulation_instances, provider):
+    """
+    Prepares case files of claimed instances of one simulation and launches them together with the provider.
+
+    The OSv image of the solver is acquired once for the whole batch and the provider launches all the instances at
+    once (see Provider.prepare_instances). A failure of one instance does not affect the others.
+
+    :param simulation_instances: Instances of the same simulation claimed with claim_simulation_instance
+    :param provider: Provider the instances were claimed for
+    :return: List of prepared instances
+    """
+    simulation = Simulation.objects.get(id=simulation_instances[0].simulation_id)
+    simulation.status = Simulation.Status.DEPLOYING.name
+    simulation.save()
+
+    # START preparing local files (OSv image, case files ...)
+    staged = []
+    for simulation_instance in simulation_instances:
+        try:
+            print "Launching instance %s with provider %s" % (simulation_instance.id, provider.get_provider_id())
+
+            simulation_instance.parallelisation = provider.get_instance_cpus(simulation_instance.simulation)
+            simulation_instance.save()
+
+            timings = OrderedDict()
+            with readiness.timed_stage(timings, 'case_files'):
+                case_utils.stage_case_files(
+                    simulation,
                     simulation_instance,
-                    case_folder,
                     provider.local_nfs_mount_location,
                     provider.nfs_server_mount_folder)
+            staged.append((simulation_instance, timings))
+        except:
+            print traceback.format_exc()
+            __handle_launch_instance_exception(simulation, simulation_instance, provider)
 
-                capstan_package_folder = tempfile.mkdtemp(prefix='ofcloud-capstan-')
+    if not staged:
+        return []
 
-                image_name = capstan_utils.init_and_compose_capstan_package(
-                    simulation.simulation_name,
-                    capstan_package_folder,
-                    simulation.solver
-                )
-                # FINISH preparing local files (OSv image, case files ...)
+    image_timings = OrderedDict()
+    try:
+        with readiness.timed_stage(image_timings, 'solver_image'):
+            image_name, image_file = capstan_utils.acquire_solver_image(simulation.solver)
+    except:
+        print traceback.format_exc()
+        for simulation_instance, _ in staged:
+            __handle_launch_instance_exception(simulation, simulation_instance, provider)
+        return []
+    # FINISH preparing local files (OSv image, case files ...)
 
-                launch_dto = ProviderLaunchDto(
-                    simulation_instance=simulation_instance,
-                    image_name=image_name,
-                    capstan_package_folder=capstan_package_folder
-                )
+    try:
+        launch_dtos = []
+        for simulation_instance, timings in staged:
+            launch_dto = ProviderLaunchDto(
+                simulation_instance=simulation_instance,
+                image_name=image_name,
+                image_file=image_file
+            )
+            launch_dto.timings.update(timings)
+            launch_dto.timings.update(image_timings)
+            launch_dtos.append(launch_dto)
+
+        # Launch the instances
+        launch_timings = OrderedDict()
+        try:
+            with readiness.timed_stage(launch_timings, 'launch'):
+                with metrics.provider_call(provider, 'prepare_instances'):
+                    results = provider.prepare_instances(launch_dtos)
+        except Exception as e:
+            print traceback.format_exc()
+            results = [(launch_dto, e) for launch_dto in launch_dtos]
+    finally:
+        capstan_utils.release_solver_image(image_name)
+
+    prepared_instances = []
+    for launch_dto, error in results:
+        simulation_instance = launch_dto.simulation_instance
+        if error is not None:
+            print "Launching instance %s failed: %s" % (simulation_instance.id, error)
+            __handle_launch_instance_exception(simulation, simulation_instance, provider)
+            continue
 
-                # Prepare instances
-                provider.prepare_instance(launch_dto)
+        try:
+            launch_dto.timings.update(launch_timings)
 
-                # Customize with case parameters
+            # Do not talk to the instance before its REST API answers
+            with readiness.timed_stage(launch_dto.timings, 'api'):
+                readiness.wait_for_osv_api(rest_api_for(simulation_instance.ip))
+
+            # Customize with case parameters
+            with readiness.timed_stage(launch_dto.timings, 'environment'), \
+                    metrics.provider_call(provider, 'prepare_instance_env'):
                 provider.prepare_instance_env(launch_dto)
-                return launch_dto.simulation_instance
 
-            except:
-                print traceback.format_exc()
-                __handle_launch_instance_exception(simulation, simulation_instance, provider)
+            print "Instance %s prepared, stage timings: %s" % (simulation_instance.id,
+                                                               readiness.format_timings(launch_dto.timings))
+            prepared_instances.append(simulation_instance)
+        except:
+            print traceback.format_exc()
+            __handle_launch_instance_exception(simulation, simulation_instance, provider)
+
+    return prepared_instances
 
-            break
-        else:
-            print "No more free quotas!"
 
-    if not is_runnable:
-        print("Maximum number of simulation instances already running! "
-              "Pending instances will be run after currently running instances finish")
+def recycle_instance_vms(finished_instances, provider, prepare_pool):
+    """
+    Hands the VMs of finished instances over to pending instances of the same simulation, if VM_RECYCLING_ENABLED.
+
+    A pending instance taking over a VM skips composing, uploading and booting the image: only its case files are
+    staged, the case folder of the VM is remounted and the environment is reset. VMs are only shut down once no pending
+    instance of their simulation is left.
+
+    Only the claims are made here, the pending instances are prepared by the workers of the preparation pool.
+
+    :param finished_instances: Instances of the provider with a terminated openFOAM thread
+    :param provider: Provider the instances are running on
+    :param prepare_pool: PreparePool preparing the instances taking over the VMs
+    :return: List of the finished instances whose VM was handed over, they must not be shut down
+    """
+    if not getattr(settings, 'VM_RECYCLING_ENABLED', DEFAULT_VM_RECYCLING_ENABLED):
+        return []
+
+    recycled_instances = []
+    for finished_instance in finished_instances:
+        pending_instances = Instance.objects.filter(simulation_id=finished_instance.simulation_id,
+                                                    status=Instance.Status.PENDING.name).select_related('simulation')
+        for pending_instance in pending_instances:
+            if prepare_pool.is_in_flight(pending_instance):
+                continue
+            if __claim_instance_vm(pending_instance, finished_instance, provider):
+                recycled_instances.append(finished_instance)
+                prepare_pool.submit_recycled(pending_instance, finished_instance, provider)
+                break
+
+    return recycled_instances
 
 
 def destroy_simulation(simulation):
     nova = openstack_utils.get_nova_client()
 
-    for instance in simulation.instance_set.all():
+    instances = list(simulation.instance_set.all())
+    for instance in instances:
         try:
             server = nova.servers.get(instance.instance_id)
             nova.servers.delete(server)
@@ -136,6 +271,36 @@ def destroy_simulation(simulation):
             snap_api.stop_openfoam_task(instance.snap_task_id)
         except:
             print "Instance not found"
+    close_api_sessions(instances)
+
+
+def stop_snap_collectors(instances):
+    """
+    Stops and removes the Snap tasks collecting the residuals of the instances.
+
+    :param instances: List of instances
+    :return:
+    """
+    for instance in instances:
+        if not instance.snap_task_id:
+            continue
+        try:
+            snap_api.stop_openfoam_task(instance.snap_task_id)
+        except requests.RequestException:
+            print "Could not stop snap task %s of instance %s" % (instance.snap_task_id, instance.id)
+            print traceback.format_exc()
+
+
+def close_api_sessions(instances):
+    """
+    Closes the OSv REST API sessions of the instances, called once their VMs are shut down.
+
+    :param instances: List of instances
+    :return:
+    """
+    for instance in instances:
+        if instance.ip:
+            osv_api.close_session(instance.ip)
 
 
 def update_instance_status(instances, status):
@@ -146,7 +311,12 @@ def update_instance_status(instances, status):
     :param status: Instance.Status value. Should be string value, not Enum. Example: Instance.Status.PENDING.name
     :return:
     """
+    if not instances:
+        return
+
     Instance.objects.filter(id__in=[instance.id for instance in instances]).update(status=status)
+    transitions.record_transitions(instances, status)
+    scheduler_events.notify_instance_status(status)
 
 
 def get_instances_with_finished_openfoam_thread(instances):
@@ -158,28 +328,117 @@ def get_instances_with_finished_openfoam_thread(instances):
     """
 
     finished_instances = []
-    for instance in instances:
-        try:
-            if __is_openfoam_thread_finished(instance):
-                finished_instances.append(instance)
-        except:
-            print "Could not determine status of openFOAM thread on instance %s" % instance.id
-            print traceback.format_exc()
+    for instance, (thread_list, error) in zip(instances, probe_instance_threads(instances)):
+        if error:
+            print "Could not determine status of openFOAM thread on instance %s: %s" % (instance.id, error)
+        elif is_openfoam_thread_finished(instance, thread_list):
+            finished_instances.append(instance)
     if len(finished_instances):
         print "Instances with finished openFOAM thread: %s" % [instance.id for instance in finished_instances]
     return finished_instances
 
 
+def probe_instance_threads(instances):
+    """
+    Retrieves the OSv VM thread info of all the provided instances concurrently.
+
+    Requests are made by a bounded pool of workers sharing keep-alive connections, each request is limited by
+    OSV_THREAD_PROBE_TIMEOUT, so an unresponsive VM only delays its own result.
+
+    :param instances: List of instances. The instances should contain the IP field.
+    :return: List of (thread_list, error) tuples in the same order as the instances. Exactly one of the tuple values
+    is None.
+    """
+    instances = list(instances)
+    if not instances:
+        return []
+    return __get_probe_pool().map(__probe_instance_threads, instances)
+
+
 def mount_instance_case_folder(instance_api, nfs_address, simulation_instance, simulation_instance_case_folder):
     nfs_mount = 'nfs://%s%s %s' % (nfs_address, simulation_instance.nfs_case_location, simulation_instance_case_folder)
     print "\t\tmounting network file storage with %s" % nfs_mount
     mount_command = "/tools/mount-nfs.so %s" % nfs_mount
-    requests.put(
+    osv_api.get_session(simulation_instance.ip).put(
         "%s/app" % instance_api,
         data={"command": mount_command}
     )
 
 
+def unmount_instance_case_folder(instance_api, simulation_instance, simulation_instance_case_folder):
+    print "\t\tunmounting network file storage from %s" % simulation_instance_case_folder
+    req = osv_api.get_session(simulation_instance.ip).put(
+        "%s/app" % instance_api,
+        data={"command": OSV_UMOUNT_COMMAND % simulation_instance_case_folder}
+    )
+    umount_thread_id = int(req.text.strip('"'))
+
+    # /app only starts the command, the folder must be unmounted before the next case is mounted on it
+    readiness.wait_until(
+        lambda: is_thread_terminated(__get_instance_thread_info(simulation_instance), umount_thread_id),
+        getattr(settings, 'READINESS_API_DEADLINE_SECONDS', readiness.DEFAULT_API_DEADLINE_SECONDS),
+        "umount of %s on %s" % (simulation_instance_case_folder, simulation_instance.ip))
+
+
+def __claim_instance_vm(simulation_instance, finished_instance, provider):
+    # The VM already exists, so the claim does not reserve any provider resources
+    claimed = Instance.objects.filter(id=simulation_instance.id, status=Instance.Status.PENDING.name).update(
+        status=Instance.Status.DEPLOYING.name,
+        provider=provider.get_provider_id(),
+        instance_id=finished_instance.instance_id,
+        ip=finished_instance.ip,
+        parallelisation=finished_instance.parallelisation)
+
+    if not claimed:
+        return False
+
+    simulation_instance.status = Instance.Status.DEPLOYING.name
+    simulation_instance.provider = provider.get_provider_id()
+    simulation_instance.instance_id = finished_instance.instance_id
+    simulation_instance.ip = finished_instance.ip
+    simulation_instance.parallelisation = finished_instance.parallelisation
+    transitions.record_transition(simulation_instance, Instance.Status.PENDING.name, Instance.Status.DEPLOYING.name)
+    return True
+
+
+def prepare_recycled_instance(simulation_instance, finished_instance, provider):
+    """
+    Prepares a pending instance claimed for the VM of a finished instance, see recycle_instance_vms.
+
+    :return: True if the instance was prepared
+    """
+    simulation = simulation_instance.simulation
+    try:
+        print "Recycling VM %s of instance %s for instance %s" % (finished_instance.instance_id, finished_instance.id,
+                                                                 simulation_instance.id)
+        stop_snap_collectors([finished_instance])
+
+        launch_dto = ProviderLaunchDto(simulation_instance=simulation_instance, image_name=None, image_file=None)
+        launch_dto.unique_server_name = '%s-%s' % (finished_instance.name, str(finished_instance.id))
+
+        with readiness.timed_stage(launch_dto.timings, 'case_files'):
+            case_utils.stage_case_files(
+                simulation,
+                simulation_instance,
+                provider.local_nfs_mount_location,
+                provider.nfs_server_mount_folder)
+
+        with readiness.timed_stage(launch_dto.timings, 'unmount'):
+            provider.unmount_instance_case_folder(simulation_instance)
+
+        # Mounts the new case folder and resets the environment
+        with readiness.timed_stage(launch_dto.timings, 'environment'):
+            provider.prepare_instance_env(launch_dto)
+
+        print "Instance %s prepared on a recycled VM, stage timings: %s" % (
+            simulation_instance.id, readiness.format_timings(launch_dto.timings))
+        return True
+    except:
+        print traceback.format_exc()
+        __handle_launch_instance_exception(simulation, simulation_instance, provider)
+        return False
+
+
 def __handle_launch_instance_exception(simulation, simulation_instance, provider):
     simulation_instance.retry_attempts += 1
     print "Setting instance %s retry attempts to %d/%d" % \
@@ -187,6 +446,8 @@ def __handle_launch_instance_exception(simulation, simulation_instance, provider
 
     if simulation_instance.instance_id:
         provider.shutdown_instances([simulation_instance])
+        close_api_sessions([simulation_instance])
+    provider.release_resources(simulation_instance)
 
     max_retries = settings.OPENFOAM_SIMULATION_MAX_RETRIES
     if simulation_instance.retry_attempts < max_retries:
@@ -214,6 +475,32 @@ def __handle_launch_instance_exception(simulation, simulation_instance, provider
             simulation.save()
 
 
+def __get_probe_pool():
+    global __probe_pool
+    with __probe_lock:
+        if __probe_pool is None:
+            __probe_pool = ThreadPool(getattr(settings, 'OSV_THREAD_PROBE_WORKERS', DEFAULT_THREAD_PROBE_WORKERS))
+        return __probe_pool
+
+
+def __get_probe_session():
+    global __probe_session
+    with __probe_lock:
+        if __probe_session is None:
+            workers = getattr(settings, 'OSV_THREAD_PROBE_WORKERS', DEFAULT_THREAD_PROBE_WORKERS)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            __probe_session = requests.Session()
+            __probe_session.mount('http://', adapter)
+        return __probe_session
+
+
+def __probe_instance_threads(instance):
+    try:
+        return __get_instance_thread_info(instance), None
+    except Exception as ex:
+        return None, "%s: %s" % (type(ex).__name__, ex)
+
+
 def __get_instance_thread_info(instance):
     """
     Retrieves the OSv VM thread info through its REST api.
@@ -222,30 +509,36 @@ def __get_instance_thread_info(instance):
     IP field.
     :return: A list of thread info objects.
     """
-    try:
-        threads_rest_api = "%s/os/threads" % rest_api_for(instance.ip)
-        print "Querying threads api on %s" % threads_rest_api
-        response = requests.get(threads_rest_api)
-        json_response = json.loads(response.text)
+    threads_rest_api = "%s/os/threads" % rest_api_for(instance.ip)
+    response = __get_probe_session().get(
+        threads_rest_api,
+        timeout=getattr(settings, 'OSV_THREAD_PROBE_TIMEOUT', DEFAULT_THREAD_PROBE_TIMEOUT))
+    response.raise_for_status()
+    json_response = json.loads(response.text)
 
-        thread_list = json_response['list']
-        return thread_list
-    except:
-        print "Instance api not available"
-        print traceback.format_exc()
+    return json_response['list']
 
 
-def __is_openfoam_thread_finished(instance):
+def is_openfoam_thread_finished(instance, thread_list):
     """
     Takes a OSv VM thread list and checks if the OpenFOAM solver thread is still executing.
 
     :param instance: Instance object of the simulation we query for thread info
+    :param thread_list: Thread info objects of the instance VM
     :return: True if the thread is terminated or not present, False if it is still executing
     """
-    thread_list = __get_instance_thread_info(instance)
-    openfoam_threads = filter(lambda t: t['id'] == instance.thread_id, thread_list)
+    return is_thread_terminated(thread_list, instance.thread_id)
+
+
+def is_thread_terminated(thread_list, thread_id):
+    """
+    :param thread_list: Thread info objects of an OSv VM
+    :param thread_id: id of the thread
+    :return: True if the thread is terminated or not present
+    """
+    threads = filter(lambda t: t['id'] == thread_id, thread_list)
 
-    if len(openfoam_threads) == 0:
+    if len(threads) == 0:
         return True
     else:
-        return openfoam_threads[0]['status'] == 'terminated'
+        return threads[0]['status'] == 'terminated'
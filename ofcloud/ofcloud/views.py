@@ -13,47 +13,119 @@
 # limitations under the License.
 
 
-import io
-import shutil
-import tarfile
-import tempfile
+import os
+import traceback
 
-from django.http import HttpResponse
+import requests
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 
+from ofcloud import archive_utils
+from ofcloud import http_utils
+from ofcloud import metrics
 from ofcloud.models import Instance
+from ofcloud.provider.provider import SIMULATION_INSTANCE_CASE_FOLDER, SIMULATION_INSTANCE_LOG_FILE
+from osv.api import FileTail
 from osv.vm import VM
 
 
-def download_instance_case(request, instance_id):
-    instance = Instance.objects.get(pk=instance_id)
+# (connect, read) timeout in seconds of metrics requests to the scheduler daemon
+METRICS_TIMEOUT = (1, 5)
 
-    vm = VM.connect_to_existing(instance.ip)
-    file_api = vm.file_api()
 
-    temppath = tempfile.mkdtemp()
-    print temppath
-    file_api.download_directory(['/case'], temppath)
+def __get_local_case_location(instance):
+    # the case folder of the VM is mounted from NFS, the local copy stays available after the VM is shut down
+    if instance.local_case_location and os.path.isdir(instance.local_case_location):
+        return instance.local_case_location
+    return None
 
-    tar_bytes = io.BytesIO()
-    tar = tarfile.open(fileobj=tar_bytes, mode="w:gz")
-    tar.add(temppath, arcname="case")
-    tar.close()
 
-    shutil.rmtree(temppath)
+def download_instance_case(request, instance_id):
+    instance = Instance.objects.get(pk=instance_id)
 
-    response = HttpResponse(tar_bytes.getvalue(), content_type='application/x-gzip')
+    local_case_location = __get_local_case_location(instance)
+    etag = last_modified = None
+    if local_case_location:
+        etag, last_modified = http_utils.tree_etag_and_last_modified(local_case_location)
+        response = http_utils.not_modified_response(request, etag, last_modified)
+        if response is not None:
+            return response
+        source = archive_utils.LocalCaseSource(local_case_location)
+    else:
+        vm = VM.connect_to_existing(instance.ip)
+        source = archive_utils.VmCaseSource(vm.file_api(), SIMULATION_INSTANCE_CASE_FOLDER)
+
+    response = StreamingHttpResponse(archive_utils.stream_tar_gz(source, 'case'), content_type='application/x-gzip')
     response['Content-Disposition'] = 'attachment; filename=%s.tar.gz' % instance.name
+    # the archive is compressed on the fly, a range could only be sent after compressing everything before it
+    response['Accept-Ranges'] = 'none'
+    http_utils.set_validators(response, etag, last_modified)
     return response
 
 
 def download_instance_log(request, instance_id):
+    """
+    Sends run.log of the instance. With the 'offset' query parameter only the bytes appended after offset are sent and
+    the offset to continue from is returned in the X-Log-Offset header, so clients can follow the log incrementally.
+    """
     instance = Instance.objects.get(pk=instance_id)
 
+    local_case_location = __get_local_case_location(instance)
+    if 'offset' in request.GET:
+        return __tail_instance_log(request, instance, local_case_location)
+
+    local_log_path = local_case_location and os.path.join(local_case_location, SIMULATION_INSTANCE_LOG_FILE)
+    if local_log_path and os.path.isfile(local_log_path):
+        return http_utils.ranged_file_response(request, local_log_path, 'text/plain')
+
     vm = VM.connect_to_existing(instance.ip)
     file_api = vm.file_api()
 
-    content = file_api.get('/case/run.log')
+    content = file_api.get(os.path.join(SIMULATION_INSTANCE_CASE_FOLDER, SIMULATION_INSTANCE_LOG_FILE))
+
+    return http_utils.ranged_content_response(request, content, 'text/plain')
+
 
-    response = HttpResponse(content)
+def __tail_instance_log(request, instance, local_case_location):
+    try:
+        offset = int(request.GET['offset'])
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        return HttpResponseBadRequest('offset must be a non-negative integer')
 
+    log_path = os.path.join(SIMULATION_INSTANCE_CASE_FOLDER, SIMULATION_INSTANCE_LOG_FILE)
+    local_log_path = local_case_location and os.path.join(local_case_location, SIMULATION_INSTANCE_LOG_FILE)
+    if local_log_path and os.path.isfile(local_log_path):
+        tail = FileTail(None, log_path, offset, local_path=local_log_path)
+    else:
+        tail = VM.connect_to_existing(instance.ip).file_api().tail(log_path, offset)
+
+    response = HttpResponse(tail.read(), content_type='text/plain')
+    response['X-Log-Offset'] = str(tail.offset)
     return response
+
+
+def metrics_view(request):
+    """
+    Sends the metrics of the scheduler daemon in the Prometheus text format. When the daemon does not respond, only the
+    instance and simulation counts are sent, computed from the database, and ofcloud_scheduler_up is 0.
+    """
+    address = metrics.get_metrics_address()
+    body = None
+    if address:
+        try:
+            r = requests.get('http://%s:%d/metrics' % tuple(address), timeout=METRICS_TIMEOUT)
+            if r.status_code == 200:
+                body = r.content
+        except requests.RequestException:
+            print "Could not get metrics of the scheduler daemon"
+            print traceback.format_exc()
+
+    scheduler_up = body is not None
+    if not scheduler_up:
+        body = '\n'.join(metrics.INSTANCES.expose() + metrics.SIMULATIONS.expose()) + '\n'
+
+    body += '# HELP ofcloud_scheduler_up Whether the metrics of the scheduler daemon could be collected.\n' \
+            '# TYPE ofcloud_scheduler_up gauge\n' \
+            'ofcloud_scheduler_up %d\n' % scheduler_up
+    return HttpResponse(body, content_type=metrics.CONTENT_TYPE)
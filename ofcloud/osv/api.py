@@ -23,16 +23,57 @@ REST api to access OSv VM.
 import settings
 import requests
 # import requests.exceptions
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import ast
 from urllib import urlencode
 import logging
 from distutils.version import StrictVersion
-from time import sleep
+from time import sleep, time
+import threading
+from multiprocessing.pool import ThreadPool
 import simplejson
 import sys
 import os
 import os.path
 
+_sessions_lock = threading.Lock()
+# (ip, port) -> requests.Session
+_sessions = {}
+
+
+def get_session(ip, port=settings.OSV_API_PORT):
+    '''
+    Return HTTP session for REST api of VM at ip.
+    There is one session per VM, shared by all api objects (Env, App, Os, File) and threads. Connections to the VM are
+    kept alive (up to OSV_API_POOL_SIZE), failed connection attempts are retried with backoff. Requests which reached
+    the VM are never retried, so commands are not executed twice.
+    '''
+    key = (ip, port)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            retry = Retry(total=settings.OSV_API_CONNECT_RETRIES,
+                          connect=settings.OSV_API_CONNECT_RETRIES,
+                          read=0,
+                          redirect=0,
+                          backoff_factor=settings.OSV_API_RETRY_BACKOFF)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.OSV_API_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            _sessions[key] = session
+        return session
+
+
+def close_session(ip, port=settings.OSV_API_PORT):
+    '''
+    Close HTTP session of VM at ip, e.g. after the VM was terminated.
+    '''
+    with _sessions_lock:
+        session = _sessions.pop((ip, port), None)
+    if session is not None:
+        session.close()
+
 
 class ApiError(Exception):
     pass
@@ -44,6 +85,37 @@ class ApiResponseError(ApiError):
         self.response = response
 
 
+class DownloadStats:
+    '''
+    Number of files and bytes downloaded and the throughput of the download.
+    '''
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._start = time()
+        self.seconds = 0.0
+
+    def add_file(self, size):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def finish(self):
+        self.seconds = time() - self._start
+
+    def throughput(self):
+        # bytes per second
+        if self.seconds <= 0:
+            return 0.0
+        return self.bytes / self.seconds
+
+    def __str__(self):
+        return '%d files, %d bytes in %.2f s (%.2f MB/s)' % (self.files, self.bytes, self.seconds,
+                                                             self.throughput() / (1024 * 1024))
+
+
 class BaseApi:
     def __init__(self, vm):
         # TODO - why asserts if python -m osv.vm 192.168.122.89 get /usr ./tmp
@@ -58,19 +130,29 @@ class BaseApi:
             '''
             requests.exceptions.ConnectionError occures if VM is not up yet (stdout/err are not redirected to file, and
             we only blindly set vm._ip to expected static ip.
+            Poll with backoff, reusing the pooled connection of the VM.
             '''
-            iimax = 50
-            for ii in range(1, iimax):
+            uri = 'http://%s:%d' % (self.vm._ip, settings.OSV_API_PORT)
+            uri += '/os/uptime'
+            deadline = time() + settings.OSV_API_WAIT_UP_SECONDS
+            delay = 0.05
+            ii = 0
+            while True:
+                ii += 1
                 try:
                     # dummy request, just to wait on service up
-                    uri = 'http://%s:%d' % (self.vm._ip, settings.OSV_API_PORT)
-                    uri += '/os/uptime'
-                    resp = requests.get(uri)
+                    self.session().get(uri, timeout=settings.OSV_API_WAIT_UP_SECONDS)
                     self.vm._api_up = True
                     return
                 except requests.exceptions.ConnectionError:
-                    log.debug('API wait_up requests.exceptions.ConnectionError %d/%d, uri %s', ii, iimax, uri)
-                    sleep(0.1)
+                    log.debug('API wait_up requests.exceptions.ConnectionError %d, uri %s', ii, uri)
+                    if time() + delay > deadline:
+                        return
+                    sleep(delay)
+                    delay = min(delay * 2, 1.0)
+
+    def session(self):
+        return get_session(self.vm._ip)
 
     def uri(self):
         return 'http://%s:%d' % (self.vm._ip, settings.OSV_API_PORT) + self.base_path
@@ -82,7 +164,7 @@ class BaseApi:
         if params:
             url_all += '?' + urlencode(params)
 
-        resp = requests.get(url_all, **kwargs)
+        resp = self.session().get(url_all, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
@@ -95,24 +177,37 @@ class BaseApi:
         if params:
             url_all += '?' + urlencode(params)
         ## log.debug('http_post %s, data "%s"', url_all, str(data))
-        resp = requests.post(url_all, data, **kwargs)
+        resp = self.session().post(url_all, data, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
 
+    # response is returned unread, content is fetched while iterating over it (resp.iter_content)
+    def http_get_stream(self, params=None, path_extra='', **kwargs):
+        self.wait_up()
+        url_all = self.uri() + path_extra
+        if params:
+            url_all += '?' + urlencode(params)
+
+        resp = self.session().get(url_all, stream=True, **kwargs)
+        if resp.status_code != 200:
+            resp.close()
+            raise ApiResponseError('HTTP call failed', resp)
+        return resp
+
     def http_put(self, params=None, data=None, path_extra='', **kwargs):
         self.wait_up()
         url_all = self.uri() + path_extra
         if params:
             url_all += '?' + urlencode(params)
-        resp = requests.put(url_all, data, **kwargs)
+        resp = self.session().put(url_all, data, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
 
     def http_delete(self, path_extra='', **kwargs):
         self.wait_up()
-        resp = requests.delete(self.uri() + path_extra, **kwargs)
+        resp = self.session().delete(self.uri() + path_extra, **kwargs)
         if resp.status_code != 200:
             raise ApiResponseError('HTTP call failed', resp)
         return resp.content
@@ -240,36 +335,190 @@ class File(BaseApi):
         content = self.http_get(params, path_extra=dir_path)
         return simplejson.loads(content)
 
-    def get_dir(self, path, dest):
+    '''
+    Generator of the content of file at file_path, in chunks of at most chunk_size bytes.
+    The HTTP response is closed when the generator is exhausted or closed.
+    '''
+
+    def iter_file(self, file_path, chunk_size=None):
+        params = {'op': 'GET'}
+        resp = self.http_get_stream(params, path_extra=file_path)
+        try:
+            for chunk in resp.iter_content(chunk_size=chunk_size or settings.OSV_DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            resp.close()
+
+    '''
+    Read file at file_path from byte offset on, at most max_bytes bytes.
+    The bytes are requested with a Range header, if the server ignores it and sends the whole file, the first offset
+    bytes are skipped while streaming the response. Returns '' if there is nothing new at offset.
+    '''
+
+    def read_from(self, file_path, offset, max_bytes=None):
+        return self.read_range(file_path, offset, max_bytes)[0]
+
+    '''
+    Like read_from, returns tuple (data, ranged). ranged is False if the server ignored the Range header and sent the
+    whole file. With use_range=False no Range header is sent, for servers known to ignore it.
+    '''
+
+    def read_range(self, file_path, offset, max_bytes=None, use_range=True):
+        max_bytes = max_bytes or settings.OSV_TAIL_MAX_READ
+        self.wait_up()
+        url_all = self.uri() + file_path + '?' + urlencode({'op': 'GET'})
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + max_bytes - 1)} if use_range else {}
+        resp = self.session().get(url_all, stream=True, headers=headers)
+        try:
+            if resp.status_code == 416:
+                # range not satisfiable, file did not grow
+                return '', True
+            if resp.status_code == 206:
+                skip = 0
+            elif resp.status_code == 200:
+                skip = offset
+            else:
+                raise ApiResponseError('HTTP call failed', resp)
+
+            data = []
+            size = 0
+            for chunk in resp.iter_content(chunk_size=settings.OSV_DOWNLOAD_CHUNK_SIZE):
+                if skip:
+                    skipped = min(skip, len(chunk))
+                    chunk = chunk[skipped:]
+                    skip -= skipped
+                chunk = chunk[:max_bytes - size]
+                data.append(chunk)
+                size += len(chunk)
+                if size >= max_bytes:
+                    break
+            return ''.join(data), resp.status_code == 206
+        finally:
+            resp.close()
+
+    '''
+    Size in bytes of file at file_path, from the listing of its directory. Returns None if there is no such file.
+    '''
+
+    def file_length(self, file_path):
+        name = os.path.basename(file_path)
+        for entry in self._list_dir(os.path.dirname(file_path) or '/'):
+            if entry['pathSuffix'] == name and entry['type'] == 'FILE':
+                return int(entry['length'])
+        return None
+
+    '''
+    Follow file at file_path from byte offset on, see FileTail.
+    '''
+
+    def tail(self, file_path, offset=0, local_path=None):
+        return FileTail(self, file_path, offset, local_path)
+
+    # get file, streamed to dest in chunks. Returns number of bytes written.
+    def _download_file(self, file_path, dest):
+        size = 0
+        with open(dest, 'wb') as fd:
+            for chunk in self.iter_file(file_path):
+                fd.write(chunk)
+                size += len(chunk)
+        return size
+
+    '''
+    Walk VM directory tree at path depth-first, in the order of the listing.
+    Yields (vm_path, entry) for path itself and every file and directory below it, entry is the LISTSTATUS json data
+    (type, length, permission, modificationTime ...). For path itself only type is set.
+    '''
+
+    def walk(self, path):
+        yield path, {'type': 'DIRECTORY'}
+        for entry in self._list_dir(path):
+            name = entry['pathSuffix']
+            if name in ['.', '..']:
+                continue
+            entry_path = os.path.join(path, name)
+            if entry['type'] == 'DIRECTORY':
+                if path == '/' and name in ['dev', 'proc']:
+                    # do not 'download' /dev/urandom etc
+                    yield entry_path, entry
+                    continue
+                for sub_path, sub_entry in self.walk(entry_path):
+                    if sub_path == entry_path:
+                        sub_entry = entry
+                    yield sub_path, sub_entry
+            else:
+                yield entry_path, entry
+
+    def _list_tree_entries(self, path, dest):
+        # list one directory, returns (subdirectories, files) as lists of (vm_path, host_path)
         log = logging.getLogger(__name__)
-        # list dir, get it recursively
-        # TODO - symlinks
-        log.info('Downloading VM dir %s', path)
-        if not os.path.exists(dest):
-            log.info('host mkdir %s', dest)
-            os.mkdir(dest)
-        dir_content = self._list_dir(path)
-        for entry in dir_content:
+        subdirs = []
+        files = []
+        for entry in self._list_dir(path):
+            name = entry['pathSuffix']
             if entry['type'] == 'DIRECTORY':
-                subdir_name = entry['pathSuffix']
-                if subdir_name in ['.', '..']:
+                if name in ['.', '..']:
                     continue
-                if path == '/' and subdir_name in ['dev', 'proc']:
-                    # do not 'download' /dev/urandom etc
-                    dev_dir = os.path.join(dest, subdir_name)
-                    if os.path.exists(dev_dir):
-                        os.removedirs(dev_dir)
-                    log.info('Only mkdir %s on destination side', dev_dir)
-                    os.mkdir(dev_dir)
+                if path == '/' and name in ['dev', 'proc']:
+                    # do not 'download' /dev/urandom etc, only mkdir on destination side
+                    if not os.path.exists(os.path.join(dest, name)):
+                        os.mkdir(os.path.join(dest, name))
                     continue
-                log.debug('Recurse in dir %s', os.path.join(path, subdir_name))
-                self.get_dir(os.path.join(path, subdir_name), os.path.join(dest, subdir_name))
+                subdirs.append((os.path.join(path, name), os.path.join(dest, name)))
             elif entry['type'] == 'FILE':
-                file_name = entry['pathSuffix']
-                log.debug('GET file %s/%s', path, file_name)
-                self._get_file(os.path.join(path, file_name), os.path.join(dest, file_name))
+                files.append((os.path.join(path, name), os.path.join(dest, name)))
             else:
                 log.error('Unknown type %s (json data %s)', entry['type'], simplejson.dumps(entry))
+        return subdirs, files
+
+    '''
+    Download VM directory tree at path to host directory dest.
+    Directories are listed concurrently, level by level, and files are fetched by a bounded pool of workers while the
+    listing goes on. Each file is streamed to disk in chunks, so memory use does not depend on file sizes.
+    Returns DownloadStats.
+    '''
+
+    def download_tree(self, path, dest, workers=None):
+        log = logging.getLogger(__name__)
+        workers = workers or settings.OSV_DOWNLOAD_WORKERS
+        stats = DownloadStats()
+        log.info('Downloading VM dir %s with %d workers', path, workers)
+
+        list_pool = ThreadPool(workers)
+        file_pool = ThreadPool(workers)
+        try:
+            downloads = []
+            level = [(path, dest)]
+            while level:
+                for _, level_dest in level:
+                    if not os.path.exists(level_dest):
+                        log.info('host mkdir %s', level_dest)
+                        os.makedirs(level_dest)
+                next_level = []
+                for subdirs, files in list_pool.map(lambda dirs: self._list_tree_entries(*dirs), level):
+                    next_level.extend(subdirs)
+                    for file_path, file_dest in files:
+                        log.debug('GET file %s', file_path)
+                        downloads.append(file_pool.apply_async(self._download_file, (file_path, file_dest)))
+                level = next_level
+
+            for download in downloads:
+                stats.add_file(download.get())
+        finally:
+            list_pool.close()
+            file_pool.close()
+            file_pool.join()
+            list_pool.join()
+
+        stats.finish()
+        log.info('Downloaded VM dir %s: %s', path, stats)
+        return stats
+
+    '''
+    Download VM directory tree at path to host directory dest, see download_tree.
+    '''
+
+    def get_dir(self, path, dest):
+        return self.download_tree(path, dest)
 
     '''
     Copy file or directory from VM at path src, to host to path dest.
@@ -284,7 +533,7 @@ class File(BaseApi):
                 return self._get_file(src, dest)
             else:
                 # src is directory
-                self.get_dir(src, dest)
+                return self.download_tree(src, dest)
         except ApiResponseError:
             print('The src "%s" does not exist', src, file=sys.stderr)
             raise
@@ -295,6 +544,8 @@ class File(BaseApi):
         # multiple src files/directories, dest should be a dir.
         # or dest ends with '/' - cp to dir was requested
         dest_is_dir = len(src) > 1 or dest.endswith(os.path.sep)
+        # DownloadStats of every downloaded directory
+        stats = []
         if dest_is_dir:
             if os.path.exists(dest):
                 if os.path.isdir(dest):
@@ -310,6 +561,84 @@ class File(BaseApi):
                 dest_filename = os.path.join(dest, src_filename)  # name of dest file or directory
             else:
                 dest_filename = dest
-            self.get(src, dest_filename)
+            tree_stats = self.get(src, dest_filename)
+            if isinstance(tree_stats, DownloadStats):
+                stats.append(tree_stats)
+        return stats
+
+
+class FileTail:
+    """
+    Incremental reader of a growing file, e.g. the solver log /case/run.log.
+    Every read returns only the bytes appended since the previous read. If local_path is given (the NFS copy of the
+    VM file), the file is read from the local file system, otherwise through File.read_range with Range requests.
+    The size of the VM file is checked first, so the file is only fetched when it grew. A server which ignores Range
+    (the OSv httpserver answers 200 with the whole file) gets no more Range headers for this file.
+    """
+
+    def __init__(self, file_api, file_path, offset=0, local_path=None):
+        self.file_api = file_api
+        self.file_path = file_path
+        self.local_path = local_path
+        self.offset = offset
+        # incomplete last line, returned by lines() once it is terminated
+        self._partial = ''
+        self._use_range = True
+
+    '''
+    Return new bytes since the previous read, at most OSV_TAIL_MAX_READ bytes per call.
+    '''
+
+    def read(self):
+        if self.local_path:
+            data = self._read_local()
+        else:
+            data = self._read_remote()
+        self.offset += len(data)
+        return data
+
+    '''
+    Generator of the complete lines appended since the previous call, without line terminators.
+    '''
+
+    def lines(self):
+        # read first, a truncated file resets the partial line
+        data = self.read()
+        data = self._partial + data
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+
+    def _read_remote(self):
+        size = self.file_api.file_length(self.file_path)
+        if size is None:
+            return ''
+        if size < self.offset:
+            self._reset()
+        if size == self.offset:
+            return ''
+
+        data, ranged = self.file_api.read_range(self.file_path, self.offset, use_range=self._use_range)
+        if self._use_range and not ranged and data:
+            logging.getLogger(__name__).info('Server ignores Range for %s, not sending it anymore', self.file_path)
+            self._use_range = False
+        return data
+
+    def _reset(self):
+        # file was truncated or replaced, start from the beginning
+        logging.getLogger(__name__).info('File %s was truncated, reading from start', self.file_path)
+        self.offset = 0
+        self._partial = ''
+
+    def _read_local(self):
+        if not os.path.exists(self.local_path):
+            return ''
+        with open(self.local_path, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            if fd.tell() < self.offset:
+                self._reset()
+            fd.seek(self.offset)
+            return fd.read(settings.OSV_TAIL_MAX_READ)
 
 ##
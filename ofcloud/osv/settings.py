@@ -24,5 +24,20 @@ OSV_SRC = '/opt/osv-src'
 OSV_BRIDGE = 'virbr0'
 OSV_CLI_APP = '/cli/cli.so'  # path to cli app inside OSv VMs
 OSV_API_PORT = 8000
+# HTTP connections kept alive per VM, connection retries with backoff factor (seconds), time to wait for REST api up
+OSV_API_POOL_SIZE = 8
+OSV_API_CONNECT_RETRIES = 3
+OSV_API_RETRY_BACKOFF = 0.1
+OSV_API_WAIT_UP_SECONDS = 5
+# parallel directory downloads (File.download_tree) - number of workers, and chunk size in bytes for writing files
+OSV_DOWNLOAD_WORKERS = 8
+OSV_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# maximum number of bytes returned by one incremental read of a growing file (File.read_from, FileTail)
+OSV_TAIL_MAX_READ = 16 * 1024 * 1024
+
+# VMs with their own image (use_image_copy) get a thin qcow2 overlay backed by the original image instead of a full
+# copy. Requires qemu-img, falls back to copying.
+OSV_IMAGE_OVERLAY = True
+OSV_IMAGE_FORMAT = 'qcow2'
 
 OSV_WORK_DIR = os.environ['HOME'] + '/osv-work'  # can be auto-generated
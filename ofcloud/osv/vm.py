@@ -22,7 +22,7 @@ import os
 import math
 from uuid import uuid4
 import settings
-from subprocess import check_call
+from subprocess import check_call, CalledProcessError
 from time import sleep
 from random import randint
 import shutil
@@ -58,6 +58,7 @@ class VMParam:
                  command='',
                  image='',
                  use_image_copy=False,
+                 use_image_overlay=settings.OSV_IMAGE_OVERLAY,
                  cpus=1,
                  memory=512,
 
@@ -100,8 +101,9 @@ class VMParam:
             # Put image to directory owned by current user.
             # Image will be later owned by root, and we still have to remove it.
             self._in_use_image = '%s/%s-usr.img' % (settings.OSV_WORK_DIR, self._vm_name)
-            log.info('Copy image %s -> %s', self._image_orig, self._in_use_image)
-            shutil.copy(self._image_orig, self._in_use_image)
+            if not (use_image_overlay and self._create_image_overlay()):
+                log.info('Copy image %s -> %s', self._image_orig, self._in_use_image)
+                shutil.copy(self._image_orig, self._in_use_image)
         else:
             self._in_use_image = self._image_orig
 
@@ -127,17 +129,45 @@ class VMParam:
             self._net_mac = ''
         log.info('VM MAC %s', self._net_mac)
 
+    '''
+    Create thin qcow2 overlay of the original image, so the VM gets its own image without copying the original one.
+    The original image is only read, writes of the VM go to the overlay.
+    Returns False if the overlay could not be created (e.g. qemu-img is not installed).
+    '''
+
+    def _create_image_overlay(self):
+        log = logging.getLogger(__name__)
+        cmd = ['qemu-img', 'create', '-f', 'qcow2',
+               '-b', self._image_orig, '-F', settings.OSV_IMAGE_FORMAT,
+               self._in_use_image]
+        log.info('Create image overlay %s -> %s', self._image_orig, self._in_use_image)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                check_call(cmd, stdout=devnull)
+            return True
+        except (OSError, CalledProcessError) as ex:
+            log.info('Image overlay %s failed (msg: %s), falling back to copy', self._in_use_image, ex)
+            if os.path.exists(self._in_use_image):
+                os.remove(self._in_use_image)
+            return False
+
+    def vm_name(self):
+        """
+        Name of the libvirt domain, also used for the image copy and the console log.
+        """
+        return self._vm_name
+
     def remove_image_copy(self):
         log = logging.getLogger(__name__)
         if self._use_image_copy:
             if self._in_use_image != self._image_orig:
-                log.info("Remove image copy %s", self._in_use_image)
+                log.info("Remove image copy/overlay %s", self._in_use_image)
                 # image file is now owned by root, or libvirt or whoever user
                 # os.remove works if we own directory
                 try:
                     os.remove(self._in_use_image)
                 except Exception as ex:
-                    log.info('Image %s remove failed (msg: %s)', self._in_use_image, ex.get_error_message())
+                    log.info('Image %s remove failed (msg: %s)', self._in_use_image, ex)
 
     '''
     Build command for run.py.
@@ -275,7 +305,7 @@ class VM:
                     'cpu_pin': self._param._cpu_pin,
                     'gdb_port': self._param._gdb_port,
                     }
-        tmpl_env = Environment(loader=PackageLoader('lin_proxy', 'templates'))
+        tmpl_env = Environment(loader=PackageLoader('osv', 'templates'))
         template = tmpl_env.get_template('osv-libvirt.template.xml')
         xml = template.render(vm=vm_param)
         # print xml
@@ -294,6 +324,26 @@ class VM:
             stdout_data = self.wait_up()
         return stdout_data
 
+    def name(self):
+        """
+        Name of the libvirt domain of the VM.
+        """
+        return self._param.vm_name()
+
+    def ip(self):
+        """
+        IP of the VM without netmask, '' while it is not known yet (see wait_ip).
+        """
+        return self._ip
+
+    def close_console_log(self):
+        """
+        Stop reading the console log. The IP is read from the console, so wait_ip should have succeeded before.
+        """
+        if self._console_log_fd:
+            self._console_log_fd.close()
+            self._console_log_fd = None
+
     def is_up(self):
         """
         Is VM still up, or did it already exit (kill to qemu, main app terminated)?
@@ -337,9 +387,7 @@ class VM:
                 log.info('VM %s destroy/undefine failed: %s', self._log_name(), ex.get_error_message())
             self._vm = None
         sys.stdout.flush()
-        if self._console_log_fd:
-            self._console_log_fd.close()
-            self._console_log_fd = None
+        self.close_console_log()
         self._param.remove_image_copy()
         # the console log file is left
 
@@ -544,7 +592,8 @@ if __name__ == '__main__':
         parser2.add_argument('dest', help='Host destination file/directory to copy to')
         args2 = parser2.parse_args(cmd_argv)
 
-        file_api.download_directory(args2.src, args2.dest)
+        for stats in file_api.download_directory(args2.src, args2.dest):
+            print('Downloaded %s' % stats)
 
     elif args.cmd in ['ls']:
         parser2 = argparse.ArgumentParser(prog='osv.vm IP ls')